@@ -9,6 +9,7 @@ from datetime import datetime
 from typing import Any, Callable, Iterable, Iterator, Literal, Optional, Sequence, Union
 
 import pandas as pd
+import pyarrow as pa
 from pydantic import (
   BaseModel,
   ConfigDict,
@@ -72,19 +73,69 @@ MEDIA_AVG_TEXT_LEN = 150
 DELETED_LABEL_NAME = '__deleted__'
 
 
+# The rows of a select rows query, or of a batch of a streamed select rows query.
+SelectRowsData = Union[pd.DataFrame, pa.Table, list[Item]]
+
+
+def _iter_rows(data: SelectRowsData) -> Iterator[Item]:
+  if isinstance(data, pa.Table):
+    return (row for batch in data.to_batches() for row in batch.to_pylist())
+  if isinstance(data, list):
+    return iter(data)
+  # Replace NaT timestamps with Nones.
+  df = data.replace({pd.NaT: None})
+  return (row.to_dict() for _, row in df.iterrows())
+
+
 class SelectRowsResult:
-  """The result of a select rows query."""
+  """The result of a select rows query.
+
+  The rows are backed either by an Arrow table, a list of items, or a pandas DataFrame, depending on
+  how the query was computed. Arrow tables are iterated batch by batch without going through pandas.
+
+  When the query is streamed with a `batch_size`, the result holds an iterator of batches that are
+  computed lazily, and can only be iterated once. The database cursor of a streamed result is
+  released when the stream is exhausted, or by `close()` when the stream is abandoned early. The
+  result can be used as a context manager to close it.
+  """
 
-  def __init__(self, df: pd.DataFrame, total_num_rows: int) -> None:
+  def __init__(
+    self,
+    data: Union[SelectRowsData, Iterator[SelectRowsData]],
+    total_num_rows: int,
+    next_cursor: Optional[str] = None,
+    close: Optional[Callable[[], None]] = None,
+  ) -> None:
     """Initialize the result."""
-    self._df = df
+    self._data = data
     self.total_num_rows = total_num_rows
+    # An opaque cursor to pass to `select_rows` to fetch the next page, when there is one.
+    self.next_cursor = next_cursor
     self._next_iter: Optional[Iterator] = None
+    self._close = close
+
+  def close(self) -> None:
+    """Release the resources held by a streamed result. Closing twice is a no-op."""
+    if self._close:
+      self._close()
+      self._close = None
+
+  def __enter__(self) -> 'SelectRowsResult':
+    return self
+
+  def __exit__(self, *args: Any) -> None:
+    self.close()
+
+  def __del__(self) -> None:
+    self.close()
+
+  def _iter_data(self) -> Iterator[SelectRowsData]:
+    if isinstance(self._data, (pd.DataFrame, pa.Table, list)):
+      return iter([self._data])
+    return self._data
 
   def __iter__(self) -> Iterator:
-    # Replace NaT timestamps with Nones.
-    df = self._df.replace({pd.NaT: None})
-    return (row.to_dict() for _, row in df.iterrows())
+    return (row for data in self._iter_data() for row in _iter_rows(data))
 
   def __next__(self) -> Item:
     if not self._next_iter:
@@ -95,9 +146,28 @@ class SelectRowsResult:
       self._next_iter = None
       raise
 
+  def arrow(self) -> pa.Table:
+    """Convert the result to an Arrow table."""
+    if isinstance(self._data, pa.Table):
+      return self._data
+    return pa.Table.from_pylist(list(self))
+
+  def iter_batches(self, batch_size: Optional[int] = None) -> Iterator[pa.RecordBatch]:
+    """Iterate over the result as Arrow record batches of at most `batch_size` rows.
+
+    Streamed results yield their batches as they are computed.
+    """
+    for data in self._iter_data():
+      table = data if isinstance(data, pa.Table) else pa.Table.from_pylist(list(_iter_rows(data)))
+      yield from table.to_batches(max_chunksize=batch_size)
+
   def df(self) -> pd.DataFrame:
     """Convert the result to a pandas DataFrame."""
-    return self._df
+    if isinstance(self._data, pd.DataFrame):
+      return self._data
+    if isinstance(self._data, pa.Table):
+      return pd.DataFrame.from_records(list(self), columns=self._data.column_names)
+    return pd.DataFrame.from_records(list(self))
 
 
 class StatsResult(BaseModel):
@@ -269,6 +339,20 @@ class SelectGroupsResult(BaseModel):
   too_many_distinct: bool
   counts: list[tuple[Optional[FeatureValue], int]]
   bins: Optional[list[Bin]] = None
+  # Whether the counts are estimated from a sample of the rows.
+  is_approximate: bool = False
+  # The half-width of the 95% confidence interval of each count, when the counts are approximate.
+  count_errors: Optional[list[int]] = None
+
+
+class CountResult(BaseModel):
+  """The result of a count query."""
+
+  count: int
+  # Whether the count is estimated from a sample of the rows.
+  is_approximate: bool = False
+  # The half-width of the 95% confidence interval of the count, when the count is approximate.
+  count_error: Optional[int] = None
 
 
 class Filter(BaseModel):
@@ -502,6 +586,8 @@ class Dataset(abc.ABC):
     sort_order: Optional[SortOrder] = SortOrder.DESC,
     limit: Optional[int] = None,
     bins: Optional[Union[Sequence[Bin], Sequence[float]]] = None,
+    include_deleted: bool = False,
+    approximate: bool = False,
   ) -> SelectGroupsResult:
     """Select grouped columns to power a histogram.
 
@@ -513,12 +599,63 @@ class Dataset(abc.ABC):
       sort_order: The sort order.
       limit: The maximum number of rows to return.
       bins: The bins to use when bucketizing a float column.
+      include_deleted: Whether to include deleted rows.
+      approximate: Whether to estimate the counts from a sample of the rows of large datasets. The
+        exact counts are computed in the background, and returned by later calls once ready.
 
     Returns:
       A `SelectGroupsResult` iterator where each row is a group.
     """
     raise NotImplementedError
 
+  @abc.abstractmethod
+  def select_groups_many(
+    self,
+    leaf_paths: Sequence[Path],
+    filters: Optional[Sequence[FilterLike]] = None,
+    sort_by: Optional[GroupsSortBy] = None,
+    sort_order: Optional[SortOrder] = SortOrder.DESC,
+    limit: Optional[int] = None,
+    include_deleted: bool = False,
+    approximate: bool = False,
+  ) -> list[SelectGroupsResult]:
+    """Select the groups of many leafs at once, to power all the histograms of a view.
+
+    Args:
+      leaf_paths: The leaf paths to group by.
+      filters: The filters to apply to the query.
+      sort_by: What to sort the groups of each leaf by, either "count" or "value".
+      sort_order: The sort order.
+      limit: The maximum number of groups to return per leaf.
+      include_deleted: Whether to include deleted rows.
+      approximate: Whether to estimate the counts from a sample of the rows of large datasets. The
+        exact counts are computed in the background, and returned by later calls once ready.
+
+    Returns:
+      A `SelectGroupsResult` for each leaf path, in the same order as `leaf_paths`.
+    """
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def count(
+    self,
+    filters: Optional[Sequence[FilterLike]] = None,
+    include_deleted: bool = False,
+    approximate: bool = False,
+  ) -> CountResult:
+    """Count the rows that match the filters.
+
+    Args:
+      filters: The filters to apply to the query.
+      include_deleted: Whether to include deleted rows.
+      approximate: Whether to estimate the count from a sample of the rows of large datasets. The
+        exact count is computed in the background, and returned by later calls once ready.
+
+    Returns:
+      A `CountResult`.
+    """
+    raise NotImplementedError
+
   @abc.abstractmethod
   def select_rows(
     self,
@@ -534,6 +671,8 @@ class Dataset(abc.ABC):
     combine_columns: bool = False,
     include_deleted: bool = False,
     user: Optional[UserInfo] = None,
+    cursor: Optional[str] = None,
+    batch_size: Optional[int] = None,
   ) -> SelectRowsResult:
     """Select a set of rows that match the provided filters, analogous to SQL SELECT.
 
@@ -561,6 +700,14 @@ class Dataset(abc.ABC):
       include_deleted: Whether to include deleted rows in the query.
       user: The authenticated user, if auth is enabled and the user is logged in. This is used to
         apply ACL to the query, especially for concepts.
+      cursor: The `next_cursor` of the previous page, to fetch the page after it. Unlike `offset`,
+        the cost of fetching a page with a cursor doesn't grow with the page number. Cursors are
+        returned when the rows are sorted by columns of the dataset and `limit` is set. A cursor is
+        only valid for the same query, and replaces `offset`.
+      batch_size: When defined, the rows are streamed from the database in batches of this many
+        rows, and signal UDFs are computed one batch at a time, so memory stays bounded for large
+        selections. The returned result can only be iterated once. Not supported when filtering or
+        sorting by a signal UDF.
 
     Returns:
       A `SelectRowsResult` iterator with rows of `Item`s.
@@ -681,12 +828,14 @@ class Dataset(abc.ABC):
     include_deleted: bool = False,
     num_jobs: int = 1,
     execution_type: TaskExecutionType = 'threads',
+    max_concurrency: int = 16,
   ) -> Iterable[Item]:
     """Maps a function over all rows in the dataset and writes the result to a new column.
 
     Args:
       map_fn: A callable that takes a full row item dictionary, and returns an Item for the
-        result. The result Item can be a primitive, like a string.
+        result. The result Item can be a primitive, like a string. The callable can be an
+        `async def` function, which is useful for calling an LLM or another HTTP service.
       input_path: The path to the input column to map over. If not specified, the map function will
         be called with the full row item dictionary. If specified, the map function will be called
         with the value at the given path, flattened. The output column will be written in the same
@@ -714,9 +863,15 @@ class Dataset(abc.ABC):
       num_jobs: The number of jobs to shard the work, defaults to 1. When set to -1, the number of
         jobs will correspond to the number of processors. If `num_jobs` is greater than the number
         of processors, it split the work into `num_jobs` and distribute amongst processors.
-      execution_type: The local execution type of the map. Either "threads" or "processes". Threads
-        are better for network bound tasks like making requests to an external server, while
-        processes are better for CPU bound tasks, like running a local LLM.
+      execution_type: The local execution type of the map. Either "threads", "processes" or
+        "process_pool". Threads are better for network bound tasks like making requests to an
+        external server, while processes are better for CPU bound tasks, like running a local LLM.
+        "process_pool" runs each job in its own local process, without dask. Only `map_fn` and the
+        shard of each job are sent to the process, which reads its rows from the dataset files
+        itself. This suits CPU bound Python functions, like regex parsing or tokenization.
+      max_concurrency: When `map_fn` is an `async def` function, the number of calls each job awaits
+        at once. Outputs are written in the order of the rows, and a call that raises is retried
+        with exponential backoff.
 
     Returns:
       An iterable of items that are the result of map. The result item does not have the column name
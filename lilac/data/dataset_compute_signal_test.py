@@ -10,9 +10,11 @@ from typing_extensions import override
 
 from ..concepts.concept import ExampleIn
 from ..concepts.db_concept import ConceptUpdate, DiskConceptDB
+from ..embeddings.vector_store_hnsw import HNSWSettings, HNSWVectorStore
 from ..schema import (
   EMBEDDING_KEY,
   PATH_WILDCARD,
+  ROWID,
   Field,
   Item,
   RichData,
@@ -25,8 +27,10 @@ from ..schema import (
 from ..signal import TextEmbeddingSignal, TextSignal, clear_signal_registry, register_signal
 from ..signals.concept_scorer import ConceptSignal
 from ..source import clear_source_registry, register_source
+from . import dataset_duckdb as dataset_duckdb_module
 from . import dataset_utils as dataset_utils_module
 from .dataset import Column, DatasetManifest, GroupsSortBy, SortOrder
+from .dataset_duckdb import DatasetDuckDB
 from .dataset_test_utils import (
   TEST_DATASET_NAME,
   TEST_NAMESPACE,
@@ -496,6 +500,60 @@ def test_source_joined_with_signal(make_test_data: TestDataMaker) -> None:
   ]
 
 
+def test_new_signal_does_not_copy_joined_table(make_test_data: TestDataMaker) -> None:
+  dataset = cast(DatasetDuckDB, make_test_data(SIMPLE_ITEMS))
+  dataset.compute_signal(TestSignal(), 'str')
+  dataset.manifest()
+
+  def get_table_oids() -> dict[str, int]:
+    return dict(dataset.con.execute('SELECT table_name, table_oid FROM duckdb_tables()').fetchall())
+
+  table_oids = get_table_oids()
+  dataset.compute_signal(TestParamSignal(param='a'), 'str')
+  dataset.manifest()
+
+  # Only the table of the new signal is created. The source and the first signal aren't copied.
+  new_table_oids = get_table_oids()
+  assert len(new_table_oids) == len(table_oids) + 1
+  assert {name: new_table_oids[name] for name in table_oids} == table_oids
+
+  result = dataset.select_rows(['str'], combine_columns=True)
+  assert list(result) == [
+    {
+      'str': enriched_item(
+        'a', {'test_signal': {'len': 1, 'flen': 1.0}, 'param_signal(param=a)': 'a_a'}
+      )
+    },
+    {
+      'str': enriched_item(
+        'b', {'test_signal': {'len': 1, 'flen': 1.0}, 'param_signal(param=a)': 'b_a'}
+      )
+    },
+    {
+      'str': enriched_item(
+        'b', {'test_signal': {'len': 1, 'flen': 1.0}, 'param_signal(param=a)': 'b_a'}
+      )
+    },
+  ]
+
+
+def test_manifest_is_refreshed_from_version_file(
+  make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  dataset = cast(DatasetDuckDB, make_test_data(SIMPLE_ITEMS))
+  iglob_spy = mocker.spy(dataset_duckdb_module.glob, 'iglob')
+
+  # Another instance of the dataset, e.g. in another process, computes a signal.
+  other_dataset = DatasetDuckDB(
+    dataset.namespace, dataset.dataset_name, project_dir=dataset.project_dir
+  )
+  other_dataset.compute_signal(TestSignal(), 'str')
+
+  assert dataset.manifest().data_schema.has_field(('str', 'test_signal'))
+  # Freshness is checked with the version file, without scanning the dataset directory.
+  iglob_spy.assert_not_called()
+
+
 def test_parameterized_signal(make_test_data: TestDataMaker) -> None:
   dataset = make_test_data([{'text': 'hello'}, {'text': 'everybody'}])
   test_signal_a = TestParamSignal(param='a')
@@ -691,6 +749,93 @@ def test_embedding_signal(make_test_data: TestDataMaker, mocker: MockerFixture)
   assert list(result) == expected_result
 
 
+def test_embedding_continuation(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  dataset = make_test_data([{'text': 'hello.'}, {'text': 'hello2.'}, {'text': 'hello3.'}])
+
+  # Write each row as its own chunk so the first row is checkpointed before the failure.
+  mocker.patch(f'{dataset_utils_module.__name__}.EMBEDDINGS_WRITE_CHUNK_SIZE', 1)
+
+  first_run = True
+  processed_text: list[RichData] = []
+  compute = TestEmbedding.compute
+
+  def _compute(self: TestEmbedding, data: Iterable[RichData]) -> Iterable[Item]:
+    for text in data:
+      if first_run and text == 'hello2.':
+        raise ValueError('Throwing')
+      processed_text.append(text)
+      yield from compute(self, [text])
+
+  mocker.patch.object(TestEmbedding, 'compute', _compute)
+
+  with pytest.raises(Exception):
+    dataset.compute_embedding('test_embedding', 'text')
+  assert processed_text == ['hello.']
+
+  first_run = False
+  processed_text = []
+  dataset.compute_embedding('test_embedding', 'text')
+
+  # Only the rows that were not embedded by the first run are embedded again.
+  assert processed_text == ['hello2.', 'hello3.']
+
+  vector_index = cast(DatasetDuckDB, dataset)._get_vector_db_index('test_embedding', ('text',))
+  rowids = [row[ROWID] for row in dataset.select_rows([ROWID])]
+  span_vectors = [list(spans) for spans in vector_index.get([(rowid,) for rowid in rowids])]
+  assert [[sv['vector'].tolist() for sv in spans] for spans in span_vectors] == [
+    [[1.0, 0.0, 0.0]],
+    [[1.0, 1.0, 0.0]],
+    [[0.0, 0.0, 1.0]],
+  ]
+
+
+def test_compute_embedding_hnsw_settings(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'text': 'hello.'}, {'text': 'hello2.'}])
+  dataset = DatasetDuckDB(
+    dataset.namespace,
+    dataset.dataset_name,
+    project_dir=dataset.project_dir,
+    hnsw_settings=HNSWSettings(m=8, construction_ef=40),
+  )
+  dataset.compute_embedding('test_embedding', 'text')
+
+  vector_index = dataset._get_vector_db_index('test_embedding', ('text',))
+  vector_store = cast(HNSWVectorStore, vector_index.get_vector_store())
+  assert vector_store.settings == HNSWSettings(m=8, construction_ef=40)
+
+
+def test_embedding_continuation_with_limit(
+  make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  dataset = make_test_data([{'text': 'hello.'}, {'text': 'hello2.'}, {'text': 'hello3.'}])
+  mocker.patch(f'{dataset_utils_module.__name__}.EMBEDDINGS_WRITE_CHUNK_SIZE', 1)
+
+  first_run = True
+  processed_text: list[RichData] = []
+  compute = TestEmbedding.compute
+
+  def _compute(self: TestEmbedding, data: Iterable[RichData]) -> Iterable[Item]:
+    for text in data:
+      if first_run and text == 'hello2.':
+        raise ValueError('Throwing')
+      processed_text.append(text)
+      yield from compute(self, [text])
+
+  mocker.patch.object(TestEmbedding, 'compute', _compute)
+
+  with pytest.raises(Exception):
+    dataset.compute_embedding('test_embedding', 'text', limit=2)
+
+  first_run = False
+  processed_text = []
+  dataset.compute_embedding('test_embedding', 'text', limit=2)
+
+  # The checkpointed row counts towards the limit, so only one more row is embedded.
+  assert processed_text == ['hello2.']
+  vector_index = cast(DatasetDuckDB, dataset)._get_vector_db_index('test_embedding', ('text',))
+  assert sorted(vector_index.rowids()) == ['1', '2']
+
+
 def test_compute_embedding_over_non_string(make_test_data: TestDataMaker) -> None:
   dataset = make_test_data([{'text': 'hello. hello2.'}, {'text': 'hello world. hello world2.'}])
 
@@ -1,4 +1,5 @@
 """The DuckDB implementation of the dataset database."""
+import base64
 import functools
 import gc
 import glob
@@ -9,23 +10,29 @@ import math
 import os
 import pathlib
 import re
+import secrets
 import shutil
 import sqlite3
 import tempfile
 import threading
+import time
 import urllib.parse
 from collections import defaultdict
-from contextlib import closing
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from datetime import date, datetime
 from importlib import metadata
 from typing import Any, Callable, Iterable, Iterator, Literal, Optional, Sequence, Union, cast
 
 import duckdb
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import yaml
 from pandas.api.types import is_object_dtype
-from pydantic import BaseModel, SerializeAsAny, field_validator
+from pydantic import BaseModel, SerializeAsAny, ValidationError, field_validator
 from typing_extensions import override
 
 from lilac.data.dataset import DELETED_LABEL_NAME
@@ -41,6 +48,7 @@ from ..config import (
 )
 from ..db_manager import remove_dataset_from_cache
 from ..embeddings.vector_store import VectorDBIndex
+from ..embeddings.vector_store_hnsw import HNSWSettings, HNSWVectorStore
 from ..env import env
 from ..project import (
   add_project_dataset_config,
@@ -64,6 +72,7 @@ from ..schema import (
   TIMESTAMP,
   VALUE_KEY,
   Bin,
+  DataType,
   Field,
   Item,
   MapFn,
@@ -82,9 +91,10 @@ from ..schema import (
   is_temporal,
   merge_schemas,
   normalize_path,
+  schema_to_arrow_schema,
   signal_type_supports_dtype,
 )
-from ..schema_duckdb import duckdb_schema, escape_col_name, escape_string_literal
+from ..schema_duckdb import escape_col_name, escape_string_literal
 from ..signal import Signal, TextEmbeddingSignal, VectorSignal, get_signal_by_type, resolve_signal
 from ..signals.concept_labels import ConceptLabelsSignal
 from ..signals.concept_scorer import ConceptSignal
@@ -98,6 +108,7 @@ from ..tasks import (
   TaskStepId,
   TaskType,
   get_is_dask_worker,
+  get_is_process_pool_worker,
   get_task_manager,
   report_progress,
   show_progress,
@@ -118,13 +129,12 @@ from .dataset import (
   MAX_TEXT_LEN_DISTINCT_COUNT,
   MEDIA_AVG_TEXT_LEN,
   RAW_SQL_OPS,
-  SAMPLE_AVG_TEXT_LENGTH,
   STRING_OPS,
-  TOO_MANY_DISTINCT,
   UNARY_OPS,
   BinaryOp,
   Column,
   ColumnId,
+  CountResult,
   Dataset,
   DatasetManifest,
   FeatureListValue,
@@ -136,6 +146,7 @@ from .dataset import (
   Search,
   SearchResultInfo,
   SelectGroupsResult,
+  SelectRowsData,
   SelectRowsResult,
   SelectRowsSchemaResult,
   SelectRowsSchemaUDF,
@@ -149,10 +160,12 @@ from .dataset import (
 )
 from .dataset_format import infer_formats
 from .dataset_utils import (
+  async_map_ordered,
   count_primitives,
   create_signal_schema,
   flatten_keys,
   get_parquet_filename,
+  load_embeddings_checkpoint,
   schema_contains_path,
   shard_id_to_range,
   sparse_to_dense_compute,
@@ -161,14 +174,57 @@ from .dataset_utils import (
 )
 
 SIGNAL_MANIFEST_FILENAME = 'signal_manifest.json'
+# A file with a random token that changes whenever the files of the dataset change. Writers replace
+# it after every write, so readers can tell their manifest is fresh by reading a single file instead
+# of scanning the dataset directory.
+DATASET_VERSION_FILENAME = 'version.txt'
 MAP_MANIFEST_SUFFIX = 'map_manifest.json'
 LABELS_SQLITE_SUFFIX = '.labels.sqlite'
 DATASET_SETTINGS_FILENAME = 'settings.json'
+# The stats of the leafs of the dataset, persisted so they survive restarts. See `StatsStore`.
+STATS_FILENAME = 'stats.json'
+# The rowids of the uniform sample of rows that answers approximate queries. See `_sample_table`.
+SAMPLE_ROWIDS_FILENAME = 'sample_rowids.parquet'
+APPROXIMATE_SAMPLE_PERCENT = 1.0
+APPROXIMATE_SAMPLE_SEED = 42
+# Approximate queries on datasets with fewer rows are answered exactly.
+APPROXIMATE_MIN_ROWS = 1_000_000
+# The z-score of the 95% confidence interval of approximate counts.
+APPROXIMATE_Z_SCORE = 1.96
+# Map and signal shards cache their outputs to a directory of parquet fragments. A fragment is
+# flushed after this many rows, or after this many seconds for slow functions, so an interrupted
+# computation resumes from the last flush. See `_write_cache_fragments`.
+SHARD_CACHE_FLUSH_ROWS = 10_000
+SHARD_CACHE_FLUSH_SECONDS = 30.0
+# Cached values of mixed types are stored JSON-encoded. They are marked with the large string type,
+# which is never inferred from Python values. See `_merge_arrow_types`.
+_JSON_ENCODED_TYPE = pa.large_string()
+# The shard caches are resharded into parquet files of whole row groups, so scans of the output can
+# be split across files and row groups. A file is closed once it reaches this size. The row groups
+# have the number of rows of a DuckDB row group, and bound the memory of the resharding. See
+# `_ParquetOutputWriter`.
+RESHARD_FILE_MAX_BYTES = 128 * 1024 * 1024
+RESHARD_ROW_GROUP_ROWS = 122_880
 SOURCE_VIEW_NAME = 'source'
+# The materialized tables that make up the joined table `t`. See `_create_joint_table`.
+_JOINT_SOURCE_TABLE = '__joint_source__'
+_JOINT_COLUMN_TABLE_PREFIX = '__joint_column__.'
+_JOINT_POSITION_COLUMN = '__joint_position__'
+# The source, and the joined table `t`, with the position of each row in the source files. The
+# positions are used to shard computations.
+_POSITIONED_SOURCE_VIEW = '__positioned_source__'
+_JOINT_POSITIONED_VIEW = '__joint_positioned__'
+_SAMPLE_TABLE = '__sample__'
 
 SQLITE_LABEL_COLNAME = 'label'
 SQLITE_CREATED_COLNAME = 'created'
 NUM_AUTO_BINS = 15
+# The number of distinct filtered row counts to cache per dataset.
+COUNT_CACHE_SIZE = 128
+# The temporary column that holds the sort keys of a row, used to make the cursor of the next page.
+CURSOR_COLUMN = '__cursor__'
+# The number of rows in a DuckDB vector.
+DUCKDB_VECTOR_SIZE = 2048
 
 BINARY_OP_TO_SQL: dict[BinaryOp, str] = {
   'equals': '=',
@@ -204,6 +260,18 @@ class DuckDBSearchUDFs(BaseModel):
   sorts: list[tuple[PathTuple, SortOrder]]
 
 
+class DuckDBGroupsQuery(BaseModel):
+  """The SQL that groups the values of a leaf, for `select_groups`."""
+
+  path: PathTuple
+  # Selects the values of the leaf from `t`.
+  inner_select: str
+  # Maps a selected value to its group, e.g. the label of its bin.
+  group_select: str
+  bins: Optional[list[Bin]] = None
+  is_temporal: bool = False
+
+
 class SignalManifest(BaseModel):
   """The manifest that describes a signal computation including schema and parquet files."""
 
@@ -247,6 +315,23 @@ class MapManifest(BaseModel):
   py_version: Optional[str] = None
 
 
+class LeafStats(BaseModel):
+  """The stats of a leaf, with the (mtime, size) of the files they were computed from."""
+
+  stamps: list[tuple[int, int]]
+  stats: StatsResult
+
+
+class StatsStore(BaseModel):
+  """The stats of the leafs of a dataset, persisted in `STATS_FILENAME`.
+
+  Entries are keyed by `_stats_key` and stay valid as long as the files of the leaf are unchanged,
+  so adding a column only computes the stats of the new leafs.
+  """
+
+  leafs: dict[str, LeafStats] = {}
+
+
 class DuckDBMapOutput:
   """The output of a map computation."""
 
@@ -264,6 +349,129 @@ class DuckDBMapOutput:
     pyarrow_reader.close()
 
 
+class _ParquetOutputWriter:
+  """Streams the parquet fragments of shard caches into the parquet files of a map or signal.
+
+  Rows are buffered one row group at a time, so memory is bounded by the size of a row group, not of
+  the output. A file is closed at a row group boundary once it reaches `RESHARD_FILE_MAX_BYTES`.
+  The files are written with temporary names, and are moved into place by `close`.
+  """
+
+  def __init__(self, filepath_prefix: str) -> None:
+    self._filepath_prefix = filepath_prefix
+    self._tmp_suffix = secrets.token_hex(8)
+    # The temporary files, and the schema each was written with.
+    self._filepaths: list[str] = []
+    self._file_schemas: list[pa.Schema] = []
+    self._writer: Optional[pq.ParquetWriter] = None
+    self._schema: Optional[pa.Schema] = None
+    self._row_group: list[pa.RecordBatch] = []
+    self._row_group_rows = 0
+
+  def write_shard_caches(self, shard_cache_dirs: list[str], task_id: Optional[str] = None) -> None:
+    """Writes the fragments of each shard cache, in the order of the shards.
+
+    When a task is given, the fragments of each shard are written as soon as the shard of the task
+    is completed, while the later shards are still computing.
+    """
+    for shard_id, shard_cache_dir in enumerate(shard_cache_dirs):
+      if task_id is not None:
+        get_task_manager().wait_shard(task_id, shard_id)
+      for filepath in _cache_fragment_filepaths(shard_cache_dir):
+        self.write_fragment(filepath)
+
+  def write_fragment(self, filepath: str) -> None:
+    """Appends the rows of a fragment to the output."""
+    fragment = pq.ParquetFile(filepath)
+    schema = fragment.schema_arrow
+    if self._schema is None:
+      self._schema = schema
+    elif not schema.equals(self._schema):
+      merged = pa.schema(
+        list(_merge_arrow_types(pa.struct(list(self._schema)), pa.struct(list(schema))))
+      )
+      if not merged.equals(self._schema):
+        # The files written so far are rewritten with the merged schema by `close`.
+        self._flush_row_group()
+        self._close_file()
+        self._schema = merged
+
+    for fragment_batch in fragment.iter_batches(batch_size=RESHARD_ROW_GROUP_ROWS):
+      batches = [fragment_batch]
+      if not fragment_batch.schema.equals(self._schema):
+        batches = _widen_table(fragment_batch, self._schema).to_batches()
+      for batch in batches:
+        self._append_to_row_group(batch)
+
+  def _append_to_row_group(self, batch: pa.RecordBatch) -> None:
+    while batch.num_rows:
+      num_rows = min(batch.num_rows, RESHARD_ROW_GROUP_ROWS - self._row_group_rows)
+      self._row_group.append(batch.slice(0, num_rows))
+      self._row_group_rows += num_rows
+      batch = batch.slice(num_rows)
+      if self._row_group_rows == RESHARD_ROW_GROUP_ROWS:
+        self._flush_row_group()
+
+  def close(self) -> list[str]:
+    """Moves the files into place, and returns them."""
+    self._flush_row_group()
+    if not self._filepaths:
+      # An output without rows still writes a file so it has a schema to read.
+      self._open_file()
+    self._close_file()
+
+    for filepath, schema in zip(self._filepaths, self._file_schemas):
+      if not schema.equals(self._schema):
+        _rewrite_parquet_file(filepath, cast(pa.Schema, self._schema))
+
+    output_dir, filename_prefix = os.path.split(self._filepath_prefix)
+    output_filepaths: list[str] = []
+    for i, filepath in enumerate(self._filepaths):
+      output_filepath = os.path.join(
+        output_dir,
+        get_parquet_filename(filename_prefix, shard_index=i, num_shards=len(self._filepaths)),
+      )
+      os.replace(filepath, output_filepath)
+      output_filepaths.append(output_filepath)
+    return output_filepaths
+
+  def abort(self) -> None:
+    """Deletes the files written so far."""
+    self._close_file()
+    for filepath in self._filepaths:
+      if os.path.exists(filepath):
+        os.remove(filepath)
+
+  def _open_file(self) -> None:
+    filepath = f'{self._filepath_prefix}-{len(self._filepaths):05d}.{self._tmp_suffix}.tmp'
+    schema = self._schema or pa.schema({ROWID: pa.string()})
+    self._schema = schema
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    self._writer = pq.ParquetWriter(filepath, schema)
+    self._filepaths.append(filepath)
+    self._file_schemas.append(schema)
+
+  def _close_file(self) -> None:
+    if self._writer:
+      self._writer.close()
+      self._writer = None
+
+  def _flush_row_group(self) -> None:
+    if not self._row_group_rows:
+      return
+    if not self._writer:
+      self._open_file()
+    assert self._writer is not None
+    self._writer.write_table(
+      pa.Table.from_batches(self._row_group, schema=self._schema),
+      row_group_size=self._row_group_rows,
+    )
+    self._row_group = []
+    self._row_group_rows = 0
+    if os.path.getsize(self._filepaths[-1]) >= RESHARD_FILE_MAX_BYTES:
+      self._close_file()
+
+
 class DuckDBQueryParams(BaseModel):
   """Representation of a DuckDB select query.
 
@@ -314,6 +522,7 @@ class DatasetDuckDB(Dataset):
     dataset_name: str,
     vector_store: str = 'hnsw',
     project_dir: Optional[Union[str, pathlib.Path]] = None,
+    hnsw_settings: Optional[HNSWSettings] = None,
   ):
     super().__init__(namespace, dataset_name, project_dir)
     self.dataset_path = get_dataset_output_dir(self.project_dir, namespace, dataset_name)
@@ -324,14 +533,43 @@ class DatasetDuckDB(Dataset):
     self._map_manifests: list[MapManifest] = []
     self._label_schemas: dict[str, Schema] = {}
     self.con = duckdb.connect(database=':memory:')
+    # Maps the name of a materialized table of the joined table `t` to the (mtime, size) of the
+    # files it was copied from. See `_create_joint_table`.
+    self._joint_table_stamps: dict[str, list[tuple[int, int]]] = {}
 
     # Maps a path and embedding to the vector index. This is lazily generated as needed.
     self._vector_indices: dict[tuple[PathKey, str], VectorDBIndex] = {}
     self.vector_store = vector_store
+    # The settings of new HNSW indices, and the query ef of loaded ones. Only used with 'hnsw'.
+    self.hnsw_settings = hnsw_settings
     self._manifest_lock = threading.Lock()
+    # The version the last manifest was computed from. Used to invalidate caches of query results.
+    self._manifest_version = ''
     self._config_lock = threading.Lock()
     self._vector_index_lock = threading.Lock()
     self._label_file_lock: dict[str, threading.Lock] = defaultdict(threading.Lock)
+    # The schema and files of each signal, map and label. Used to tell when the stats of a leaf are
+    # out of date.
+    self._column_groups: list[tuple[Schema, list[str]]] = []
+    self._stats_lock = threading.Lock()
+    # The fraction of rows in the sample table, and the version it was materialized for.
+    self._sample_lock = threading.Lock()
+    self._sample_rate = 0.0
+    self._sample_version = ''
+    # The exact results of approximate queries, computed in the background for the current version.
+    self._refinement_executor = ThreadPoolExecutor(max_workers=1)
+    self._refinement_lock = threading.Lock()
+    self._refinements: dict[str, Future] = {}
+    self._refinement_version = ''
+
+    # Datasets written before the version file existed start with one, so their freshness checks
+    # don't scan the dataset directory.
+    if not os.path.exists(os.path.join(self.dataset_path, DATASET_VERSION_FILENAME)):
+      try:
+        self._bump_version()
+      except OSError:
+        # The dataset is read-only, so manifest() falls back to scanning the dataset directory.
+        pass
 
     # Create a join table from all the parquet files.
     manifest = self.manifest()
@@ -361,6 +599,7 @@ class DatasetDuckDB(Dataset):
       'dataset_name': self.dataset_name,
       'vector_store': self.vector_store,
       'project_dir': self.project_dir,
+      'hnsw_settings': self.hnsw_settings,
     }
 
   def __setstate__(self, state: dict[str, Any]) -> None:
@@ -396,21 +635,20 @@ class DatasetDuckDB(Dataset):
     """
     )
 
-  # NOTE: This is cached, but when the latest mtime of any file in the dataset directory changes
-  # the results are invalidated.
+  # NOTE: This is cached, but when the version of the dataset changes the results are invalidated.
   @functools.lru_cache(maxsize=1)
-  def _recompute_joint_table(self, latest_mtime_micro_sec: int) -> DatasetManifest:
-    del latest_mtime_micro_sec  # This is used as the cache key.
+  def _recompute_joint_table(self, version: str) -> DatasetManifest:
+    del version  # This is used as the cache key.
     merged_schema = self._source_manifest.data_schema.model_copy(deep=True)
     self._signal_manifests = []
     self._label_schemas = {}
     self._map_manifests = []
+    # Maps each column of the joined table to the files of its column group.
+    column_files: dict[str, list[str]] = {}
     # Make a joined view of all the column groups.
-    self._create_view(
-      SOURCE_VIEW_NAME,
-      [os.path.join(self.dataset_path, f) for f in self._source_manifest.files],
-      type='parquet',
-    )
+    source_files = [os.path.join(self.dataset_path, f) for f in self._source_manifest.files]
+    self._create_view(SOURCE_VIEW_NAME, source_files, type='parquet')
+    self._create_positioned_source_view(source_files)
 
     # Add the signal column groups.
     for root, _, files in os.walk(self.dataset_path):
@@ -420,11 +658,13 @@ class DatasetDuckDB(Dataset):
             signal_manifest = SignalManifest.model_validate_json(f.read())
           self._signal_manifests.append(signal_manifest)
           signal_files = [os.path.join(root, f) for f in signal_manifest.files]
+          column_files[signal_manifest.parquet_id] = signal_files
           if signal_files:
             self._create_view(signal_manifest.parquet_id, signal_files, type='parquet')
         elif file.endswith(LABELS_SQLITE_SUFFIX):
           label_name = file[0 : -len(LABELS_SQLITE_SUFFIX)]
           self._create_view(label_name, [os.path.join(root, file)], type='sqlite')
+          column_files[label_name] = [os.path.join(root, file)]
           # This mirrors the structure in DuckDBDatasetLabel.
           self._label_schemas[label_name] = Schema(
             fields={
@@ -441,6 +681,7 @@ class DatasetDuckDB(Dataset):
           with open_file(os.path.join(root, file)) as f:
             map_manifest = MapManifest.model_validate_json(f.read())
           map_files = [os.path.join(root, f) for f in map_manifest.files]
+          column_files[map_manifest.parquet_id] = map_files
           self._create_view(map_manifest.parquet_id, map_files, type='parquet')
           if map_files:
             self._map_manifests.append(map_manifest)
@@ -450,73 +691,52 @@ class DatasetDuckDB(Dataset):
       + [m.data_schema for m in self._signal_manifests + self._map_manifests]
       + list(self._label_schemas.values())
     )
+    self._column_groups = [
+      (m.data_schema, column_files[m.parquet_id])
+      for m in self._signal_manifests + self._map_manifests
+    ] + [
+      (label_schema, column_files[label_name])
+      for label_name, label_schema in self._label_schemas.items()
+    ]
 
-    # The logic below generates the following example query:
-    # CREATE OR REPLACE VIEW t AS (
-    #   SELECT
-    #     source.*,
-    #     "parquet_id1"."root_column" AS "parquet_id1",
-    #     "parquet_id2"."root_column" AS "parquet_id2"
-    #   FROM source JOIN "parquet_id1" USING (rowid,) JOIN "parquet_id2" USING (rowid,)
-    # );
-    # NOTE: "root_column" for each signal is defined as the top-level column.
-    signal_column_selects = [
-      (
-        f'{escape_col_name(manifest.parquet_id)}.{escape_col_name(_root_column(manifest))} '
-        f'AS {escape_col_name(manifest.parquet_id)}'
+    # Each signal, map and label adds one column to the joined table `t`, with the name of its
+    # parquet id (or label name). Each column is a tuple of:
+    #   (column name, view with the column group, select expression, files of the column group)
+    # NOTE: The select expression for signals and maps is the top-level column of the group.
+    columns: list[tuple[str, str, str, list[str]]] = []
+    for manifest in self._signal_manifests + self._map_manifests:
+      if not manifest.files:
+        continue
+      root_select = (
+        f'{escape_col_name(manifest.parquet_id)}.{escape_col_name(_root_column(manifest))}'
       )
-      for manifest in self._signal_manifests
-      if manifest.files
-    ]
-    map_column_selects = [
-      (
-        f'{escape_col_name(manifest.parquet_id)}.{escape_col_name(_root_column(manifest))} '
-        f'AS {escape_col_name(manifest.parquet_id)}'
+      columns.append(
+        (manifest.parquet_id, manifest.parquet_id, root_select, column_files[manifest.parquet_id])
       )
-      for manifest in self._map_manifests
-      if manifest.files
-    ]
-    label_column_selects = []
     for label_name in self._label_schemas.keys():
       col_name = escape_col_name(label_name)
       # We use a case here because labels are sparse and we don't want to return an object at all
       # when there is no label.
-      label_column_selects.append(
-        f"""
+      label_select = f"""
         (CASE WHEN {col_name}.{SQLITE_LABEL_COLNAME} IS NULL THEN NULL ELSE {{
           {SQLITE_LABEL_COLNAME}: {col_name}.{SQLITE_LABEL_COLNAME},
           {SQLITE_CREATED_COLNAME}: {col_name}.{SQLITE_CREATED_COLNAME}
-        }} END) as {col_name}
+        }} END)
       """
-      )
+      columns.append((label_name, label_name, label_select, column_files[label_name]))
 
-    select_sql = ', '.join(
-      [f'{SOURCE_VIEW_NAME}.*'] + signal_column_selects + map_column_selects + label_column_selects
-    )
-
-    # Get parquet ids for signals, maps, and labels.
-    parquet_ids = [
-      manifest.parquet_id
-      for manifest in self._signal_manifests + self._map_manifests
-      if manifest.files
-    ] + list(self._label_schemas.keys())
-    join_sql = ' '.join(
-      [SOURCE_VIEW_NAME]
-      + [f'LEFT JOIN {escape_col_name(parquet_id)} USING ({ROWID})' for parquet_id in parquet_ids]
-    )
-    view_or_table = 'TABLE'
-    # When in a dask worker, always use views to reduce memory overhead.
-    if get_is_dask_worker():
+    # When in a dask or process pool worker, always use views to reduce memory overhead. Each worker
+    # only reads the rows of its shard.
+    if get_is_dask_worker() or get_is_process_pool_worker():
       use_views = True
     else:
-      use_views = bool(env('DUCKDB_USE_VIEWS', 0) or 0)
+      use_views = bool(int(env('DUCKDB_USE_VIEWS', 0) or 0))
 
     if use_views:
-      view_or_table = 'VIEW'
-    sql_cmd = f"""
-      CREATE OR REPLACE {view_or_table} t AS (SELECT {select_sql} FROM {join_sql})
-    """
-    self.con.execute(sql_cmd)
+      self._create_joint_view(columns)
+    else:
+      self._create_joint_table(columns)
+
     # Get the total size of the table.
     size_query = 'SELECT COUNT() as count FROM t'
     size_query_result = cast(Any, self._query(size_query)[0])
@@ -542,6 +762,144 @@ class DatasetDuckDB(Dataset):
       dataset_format=dataset_format,
     )
 
+  def _create_positioned_source_view(self, files: list[str]) -> None:
+    """Create a view of the source with the position of each row across all the source files.
+
+    The position is computed from the row number within each file and the row counts in the parquet
+    footers, so it is the same in every process that opens the dataset.
+    """
+    position = escape_col_name(_JOINT_POSITION_COLUMN)
+    file_selects: list[str] = []
+    offset = 0
+    for file in files:
+      file_selects.append(
+        f"""
+        SELECT * EXCLUDE (file_row_number), file_row_number + {offset} AS {position}
+        FROM read_parquet('{file}', file_row_number=true)
+      """
+      )
+      offset += pq.read_metadata(file).num_rows
+    self.con.execute(
+      f"""
+      CREATE OR REPLACE VIEW {escape_col_name(_POSITIONED_SOURCE_VIEW)} AS (
+        {' UNION ALL '.join(file_selects)}
+      )
+    """
+    )
+
+  def _create_joint_view(self, columns: list[tuple[str, str, str, list[str]]]) -> None:
+    """Create `t` as a view that joins the source with each column group on the rowid.
+
+    The logic below generates the following example query:
+    CREATE OR REPLACE VIEW t AS (
+      SELECT
+        source.*,
+        "parquet_id1"."root_column" AS "parquet_id1",
+        "parquet_id2"."root_column" AS "parquet_id2"
+      FROM source LEFT JOIN "parquet_id1" USING (rowid,) LEFT JOIN "parquet_id2" USING (rowid,)
+    );
+    """
+    select_sql = ', '.join(
+      [f'{SOURCE_VIEW_NAME}.*']
+      + [f'{select} AS {escape_col_name(col_name)}' for col_name, _, select, _ in columns]
+    )
+    join_sql = ' '.join(
+      [SOURCE_VIEW_NAME]
+      + [
+        f'LEFT JOIN {escape_col_name(view_name)} USING ({ROWID})' for _, view_name, _, _ in columns
+      ]
+    )
+    self.con.execute(f'CREATE OR REPLACE VIEW t AS (SELECT {select_sql} FROM {join_sql})')
+
+    positioned_source = escape_col_name(_POSITIONED_SOURCE_VIEW)
+    positioned_select_sql = ', '.join(
+      [f'{positioned_source}.*']
+      + [f'{select} AS {escape_col_name(col_name)}' for col_name, _, select, _ in columns]
+    )
+    positioned_join_sql = ' '.join(
+      [positioned_source]
+      + [
+        f'LEFT JOIN {escape_col_name(view_name)} USING ({ROWID})' for _, view_name, _, _ in columns
+      ]
+    )
+    self.con.execute(
+      f"""
+      CREATE OR REPLACE VIEW {escape_col_name(_JOINT_POSITIONED_VIEW)} AS (
+        SELECT {positioned_select_sql} FROM {positioned_join_sql}
+      )
+    """
+    )
+
+  def _create_joint_table(self, columns: list[tuple[str, str, str, list[str]]]) -> None:
+    """Create `t` from materialized tables, without re-copying data that hasn't changed.
+
+    The source and each column are copied into their own table. The source table numbers its rows
+    with an explicit position column, and every column table is keyed by that position, so `t` is a
+    view that joins the tables on a dense integer instead of the rowid. When a signal, map or label
+    changes, only its column table is copied again.
+    """
+    source_files = [os.path.join(self.dataset_path, f) for f in self._source_manifest.files]
+    source_stamps = _file_stamps(source_files)
+    source_table = escape_col_name(_JOINT_SOURCE_TABLE)
+    position = escape_col_name(_JOINT_POSITION_COLUMN)
+    source_changed = self._joint_table_stamps.get(_JOINT_SOURCE_TABLE) != source_stamps
+    if source_changed:
+      self.con.execute(
+        f"""
+        CREATE OR REPLACE TABLE {source_table} AS (
+          SELECT * FROM {escape_col_name(_POSITIONED_SOURCE_VIEW)}
+        )
+      """
+      )
+      self._joint_table_stamps[_JOINT_SOURCE_TABLE] = source_stamps
+
+    column_tables: list[tuple[str, str]] = []
+    for col_name, view_name, select, files in columns:
+      table_name = _JOINT_COLUMN_TABLE_PREFIX + col_name
+      stamps = _file_stamps(files)
+      if source_changed or self._joint_table_stamps.get(table_name) != stamps:
+        self.con.execute(
+          f"""
+          CREATE OR REPLACE TABLE {escape_col_name(table_name)} AS (
+            SELECT {source_table}.{position}, {select} AS {escape_col_name(col_name)}
+            FROM {source_table} LEFT JOIN {escape_col_name(view_name)} USING ({ROWID})
+          )
+        """
+        )
+        self._joint_table_stamps[table_name] = stamps
+      column_tables.append((col_name, table_name))
+
+    # Drop the tables of columns that were deleted.
+    current_tables = {_JOINT_SOURCE_TABLE} | {table_name for _, table_name in column_tables}
+    for table_name in list(self._joint_table_stamps.keys()):
+      if table_name not in current_tables:
+        self.con.execute(f'DROP TABLE IF EXISTS {escape_col_name(table_name)}')
+        del self._joint_table_stamps[table_name]
+
+    select_sql = ', '.join(
+      [f'{source_table}.* EXCLUDE ({position})']
+      + [
+        f'{escape_col_name(table_name)}.{escape_col_name(col_name)}'
+        for col_name, table_name in column_tables
+      ]
+    )
+    join_sql = ' '.join(
+      [source_table]
+      + [
+        f'JOIN {escape_col_name(table_name)} USING ({position})' for _, table_name in column_tables
+      ]
+    )
+    self.con.execute(f'CREATE OR REPLACE VIEW t AS (SELECT {select_sql} FROM {join_sql})')
+    # The position column is monotonic in the source table, so a range filter on it skips every
+    # row group of the joined tables outside of the range.
+    self.con.execute(
+      f"""
+      CREATE OR REPLACE VIEW {escape_col_name(_JOINT_POSITIONED_VIEW)} AS (
+        SELECT {select_sql}, {source_table}.{position} FROM {join_sql}
+      )
+    """
+    )
+
   def _add_map_keys_to_schema(self, path: PathTuple, field: Field, merged_schema: Schema) -> None:
     """Adds the keys of a map to the schema."""
     value_column = 'key'
@@ -562,17 +920,29 @@ class DatasetDuckDB(Dataset):
 
   @override
   def manifest(self) -> DatasetManifest:
-    # Use the latest modification time of all files under the dataset path as the cache key for
-    # re-computing the manifest and the joined view.
+    # Use the version of the dataset as the cache key for re-computing the manifest and the joined
+    # view. Reading the version file is O(1), no matter how many files the dataset has.
     with self._manifest_lock:
-      all_dataset_files = glob.iglob(os.path.join(self.dataset_path, '**'), recursive=True)
-      latest_mtime = max(map(os.path.getmtime, all_dataset_files))
-      latest_mtime_micro_sec = int(latest_mtime * 1e6)
-      return self._recompute_joint_table(latest_mtime_micro_sec)
-
-  def count(self, filters: Optional[list[FilterLike]] = None) -> int:
-    """Count the number of rows."""
-    raise NotImplementedError('count is not yet implemented for DuckDB.')
+      try:
+        with open(os.path.join(self.dataset_path, DATASET_VERSION_FILENAME)) as f:
+          version = f.read()
+      except FileNotFoundError:
+        # Fall back to the latest modification time of all files under the dataset path.
+        all_dataset_files = glob.iglob(os.path.join(self.dataset_path, '**'), recursive=True)
+        latest_mtime = max(map(os.path.getmtime, all_dataset_files))
+        version = f'mtime:{int(latest_mtime * 1e6)}'
+      self._manifest_version = version
+      return self._recompute_joint_table(version)
+
+  def _bump_version(self) -> None:
+    """Mark the files of the dataset as changed. This must be called after every write."""
+    version_filepath = os.path.join(self.dataset_path, DATASET_VERSION_FILENAME)
+    # Write to a unique temporary file and rename, so concurrent writers and readers never see a
+    # partially written version.
+    tmp_version_filepath = f'{version_filepath}.{secrets.token_hex(8)}.tmp'
+    with open(tmp_version_filepath, 'w') as f:
+      f.write(secrets.token_hex(16))
+    os.replace(tmp_version_filepath, version_filepath)
 
   def _get_vector_db_index(self, embedding: str, path: PathTuple) -> VectorDBIndex:
     # Refresh the manifest to make sure we have the latest signal manifests.
@@ -608,24 +978,35 @@ class DatasetDuckDB(Dataset):
         f'Loading vector store "{manifest.vector_store}" for {path_id}'
         f' with embedding "{embedding}"'
       ):
-        vector_index = VectorDBIndex(manifest.vector_store)
+        vector_index = VectorDBIndex(
+          manifest.vector_store, self._hnsw_settings_for(manifest.vector_store)
+        )
         vector_index.load(base_path)
       # Cache the vector index.
       self._vector_indices[index_key] = vector_index
       return vector_index
 
+  def _hnsw_settings_for(self, vector_store: str) -> Optional[HNSWSettings]:
+    """Return the HNSW settings to create an index of the given vector store with."""
+    return self.hnsw_settings if vector_store == HNSWVectorStore.name else None
+
   def _select_iterable_values(
     self,
     unnest_input_path: Optional[PathTuple] = None,
     combine_columns: bool = False,
     resolve_span: bool = False,
-    shard_cache_filepath: Optional[str] = None,
+    shard_cache_dir: Optional[str] = None,
     overwrite: bool = False,
     query_options: Optional[DuckDBQueryParams] = None,
     shard_id: Optional[int] = None,
     shard_count: Optional[int] = None,
+    skip_rowids: Optional[Sequence[str]] = None,
   ) -> Iterable[tuple[str, Item]]:
-    """Returns an iterable of (rowid, item), discluding results in the cache filepath."""
+    """Returns an iterable of (rowid, item), discluding results in the cache directory.
+
+    Rows in `skip_rowids` are also excluded, which is used to resume computations that are not
+    cached to a file.
+    """
     manifest = self.manifest()
     num_items = self.manifest().num_items
 
@@ -685,44 +1066,48 @@ class DatasetDuckDB(Dataset):
 
     # Create a view for the work of the shard before anti-joining.
     t_shard_table = f't_shard_{shard_id}'
-    con.execute(
-      f"""
-      CREATE OR REPLACE VIEW {t_shard_table} as (
+    if not (query_options and query_options.limit):
+      # Each shard reads a contiguous range of source positions, which only touches the row groups
+      # of that range, and then filters it.
+      position = escape_col_name(_JOINT_POSITION_COLUMN)
+      shard_sql = f"""
+        SELECT * EXCLUDE ({position}) FROM (
+          SELECT * FROM {escape_col_name(_JOINT_POSITIONED_VIEW)}
+          WHERE {position} >= {shard_start_idx} AND {position} < {shard_end_idx}
+        ) {options_clause}
+        ORDER BY {position}
+      """
+    else:
+      # A limit applies to the rows sorted by rowid, so each shard is an offset into them, which
+      # scans and sorts every row before the shard.
+      shard_sql = f"""
         SELECT * FROM (
           SELECT * FROM t {options_clause}
         )
         ORDER BY {ROWID}
         LIMIT {shard_end_idx - shard_start_idx}
         OFFSET {shard_start_idx}
-      );
-    """
-    )
+      """
+    con.execute(f'CREATE OR REPLACE VIEW {t_shard_table} as ({shard_sql});')
     select_sql = ', '.join(select_queries)
 
     # Anti-join removes input rows that are already in the cache so they do not get passed to the
     # map function.
     anti_join = ''
-    use_jsonl_cache = False
-    if not overwrite and shard_cache_filepath and os.path.exists(shard_cache_filepath):
-      with open_file(shard_cache_filepath, 'r') as f:
-        # Read the first line of the file
-        first_line = f.readline()
-      use_jsonl_cache = True if first_line.strip() else False
+    cache_filepaths: list[str] = []
+    if not overwrite and shard_cache_dir:
+      cache_filepaths = _cache_fragment_filepaths(shard_cache_dir)
 
     t_cache_table = f't_cache_{shard_id}'
-    if use_jsonl_cache:
-      con.execute(
-        f"""
-        CREATE OR REPLACE VIEW {t_cache_table} as (
-          SELECT {ROWID} FROM read_json_auto(
-            '{shard_cache_filepath}',
-            IGNORE_ERRORS=true,
-            hive_partitioning=false,
-            format='newline_delimited')
-        );
-      """
+    if cache_filepaths:
+      # Only the rowid column of each fragment is read.
+      cached_rowids = pa.concat_tables(
+        [pq.read_table(filepath, columns=[ROWID]) for filepath in cache_filepaths]
       )
-
+      con.register(t_cache_table, cached_rowids)
+      anti_join = f'ANTI JOIN {t_cache_table} USING({ROWID})'
+    elif skip_rowids:
+      con.register(t_cache_table, pd.DataFrame({ROWID: list(skip_rowids)}))
       anti_join = f'ANTI JOIN {t_cache_table} USING({ROWID})'
 
     result = con.execute(
@@ -776,7 +1161,7 @@ class DatasetDuckDB(Dataset):
     self,
     transform_fn: Union[Signal, Callable[[Iterable[Item]], Iterable[Optional[Item]]]],
     output_path: PathTuple,
-    jsonl_cache_filepath: str,
+    shard_cache_dir: str,
     unnest_input_path: Optional[PathTuple] = None,
     overwrite: bool = False,
     query_options: Optional[DuckDBQueryParams] = None,
@@ -786,42 +1171,40 @@ class DatasetDuckDB(Dataset):
     shard_count: Optional[int] = None,
     task_step_id: Optional[TaskStepId] = None,
     task_step_description: Optional[str] = None,
+    skip_rowids: Optional[Sequence[str]] = None,
+    schema: Optional[Schema] = None,
   ) -> Iterable[Item]:
-    manifest = self.manifest()
+    """Computes the transform over the rows of a shard, caching the outputs to parquet fragments.
 
-    os.makedirs(os.path.dirname(jsonl_cache_filepath), exist_ok=True)
-    # Overwrite the file if overwrite is True.
-    if overwrite and os.path.exists(jsonl_cache_filepath):
-      delete_file(jsonl_cache_filepath)
+    When a schema is given, the fragments are written with it. Otherwise each fragment is written
+    with the schema inferred from its items, and `_reshard_cache` unifies them.
+    """
+    manifest = self.manifest()
 
-    use_jsonl_cache = not overwrite and os.path.exists(jsonl_cache_filepath)
+    # Overwrite the cache if overwrite is True.
+    if overwrite and os.path.exists(shard_cache_dir):
+      shutil.rmtree(shard_cache_dir)
 
-    # Compute the start index where the cache file left off.
+    # Compute the start index where the cache left off, from the row counts in the parquet footers.
     start_idx = 0
-    if use_jsonl_cache:
-      con = self.con.cursor()
-      count_result = con.execute(
-        f"""
-        SELECT COUNT(*) FROM read_json_auto(
-          '{jsonl_cache_filepath}',
-          IGNORE_ERRORS=true,
-          hive_partitioning=false,
-          format='newline_delimited')
-        """
-      ).fetchone()
-      if count_result:
-        (start_idx,) = count_result
-      con.close()
+    if not overwrite and os.path.exists(shard_cache_dir):
+      start_idx = sum(
+        pq.read_metadata(filepath).num_rows
+        for filepath in _cache_fragment_filepaths(shard_cache_dir)
+      )
+    elif skip_rowids:
+      start_idx = len(skip_rowids)
 
     rows = self._select_iterable_values(
       unnest_input_path=unnest_input_path,
       combine_columns=combine_columns,
       resolve_span=resolve_span,
-      shard_cache_filepath=jsonl_cache_filepath,
+      shard_cache_dir=shard_cache_dir,
       overwrite=overwrite,
       query_options=query_options,
       shard_id=shard_id,
       shard_count=shard_count,
+      skip_rowids=skip_rowids,
     )
 
     # Tee the results so we can zip the row ids with the outputs.
@@ -893,14 +1276,17 @@ class DatasetDuckDB(Dataset):
         step_description=task_step_description,
       )
 
-    output_items, jsonl_cache_items = itertools.tee(output_items, 2)
-    # TODO(nsthorat): Support continuation of embeddings.
+    output_items, cache_items = itertools.tee(output_items, 2)
     try:
+      # Embeddings are not cached to parquet fragments. They are resumed from the checkpoint of the
+      # vector index instead, see `compute_embedding`.
       if not isinstance(transform_fn, TextEmbeddingSignal):
-        with open_file(jsonl_cache_filepath, 'a') as file:
-          for item in output_items:
-            json.dump(item, file)
-            file.write('\n')
+        arrow_schema: Optional[pa.Schema] = None
+        if schema:
+          schema = schema.model_copy(deep=True)
+          schema.fields[ROWID] = Field(dtype=STRING)
+          arrow_schema = schema_to_arrow_schema(schema)
+        _write_cache_fragments(output_items, shard_cache_dir, arrow_schema)
     except RuntimeError as e:
       # NOTE: A RuntimeError exception is thrown when the output_items iterator, which is a zip of
       # input and output items, yields a StopIterator exception.
@@ -912,29 +1298,23 @@ class DatasetDuckDB(Dataset):
     except Exception as e:
       raise e
 
-    return jsonl_cache_items
+    return cache_items
 
   def _reshard_cache(
     self,
     output_path: PathTuple,
-    jsonl_cache_filepaths: list[str],
-    schema: Optional[Schema] = None,
+    shard_cache_dirs: list[str],
     is_tmp_output: bool = False,
     parquet_filename_prefix: Optional[str] = None,
     overwrite: bool = False,
-  ) -> tuple[str, Schema, Optional[str]]:
-    """Reshards the jsonl cache files into a single parquet file.
+    output_writer: Optional[_ParquetOutputWriter] = None,
+  ) -> tuple[str, Schema, list[str]]:
+    """Reshards the parquet fragments of the shard caches into the parquet files of the output.
 
-    When is_tmp_output is true, the results are still merged to a single iterable PyArrow reader.
+    The output files are written by streaming the fragments through a `_ParquetOutputWriter`, in
+    the order of the shards. When an output writer is given, it has already written the fragments.
+    When is_tmp_output is true, no files are written and the query reads the fragments instead.
     """
-    # Merge all the shard outputs.
-    jsonl_view_name = 'tmp_output'
-    con = self.con.cursor()
-
-    if schema and ROWID not in schema.fields:
-      schema = schema.model_copy(deep=True)
-      schema.fields[ROWID] = Field(dtype=STRING)
-
     # Potential bug: if a computation is interrupted, and then the num-workers, filtering, or limits
     # are updated, then shard assignment may not be consistent. Then, two workers may have processed
     # the same row, leading to duplicate rows in the result. A further complication is if
@@ -943,45 +1323,43 @@ class DatasetDuckDB(Dataset):
     # bug, interrupted it, updated and reran.
     #
     # Anyway this seems like a lot of unusual things have to happen so I'll leave the bug unfixed.
-    json_query = f"""
-      SELECT * FROM {'read_json' if schema else 'read_json_auto'}(
-        {jsonl_cache_filepaths},
-        {f'columns={duckdb_schema(schema)},' if schema else ''}
-        hive_partitioning=false,
-        ignore_errors=true,
-        format='newline_delimited'
-      )
-    """
-    con.execute(f'CREATE OR REPLACE VIEW "{jsonl_view_name}" as ({json_query});')
-
-    parquet_filepath: Optional[str] = None
-    reader = con.execute(f'SELECT * from {jsonl_view_name}').fetch_record_batch(
-      rows_per_batch=10_000
-    )
-    output_schema = arrow_schema_to_schema(reader.schema)
-
-    if not is_tmp_output:
-      parquet_filepath = _get_parquet_filepath(
+    parquet_filepaths: list[str] = []
+    if is_tmp_output:
+      cache_filepaths = [
+        filepath
+        for shard_cache_dir in shard_cache_dirs
+        for filepath in _cache_fragment_filepaths(shard_cache_dir)
+      ]
+      _unify_cache_fragments(cache_filepaths)
+      cache_query = f'SELECT * FROM read_parquet({cache_filepaths})'
+    else:
+      filepath_prefix = _get_parquet_filepath_prefix(
         dataset_path=self.dataset_path,
         output_path=output_path,
         parquet_filename_prefix=parquet_filename_prefix,
       )
-      if overwrite and os.path.exists(parquet_filepath):
-        # Delete the parquet file if it exists.
-        delete_file(parquet_filepath)
-
-      os.makedirs(os.path.dirname(parquet_filepath), exist_ok=True)
-
-      con.execute(
-        f"""COPY (SELECT * FROM '{jsonl_view_name}') TO '{parquet_filepath}' (FORMAT PARQUET);"""
-      )
+      try:
+        if output_writer is None:
+          output_writer = _ParquetOutputWriter(filepath_prefix)
+          output_writer.write_shard_caches(shard_cache_dirs)
+        if overwrite:
+          _delete_parquet_files(filepath_prefix)
+        parquet_filepaths = output_writer.close()
+      except BaseException:
+        if output_writer:
+          output_writer.abort()
+        raise
+      cache_query = f'SELECT * FROM read_parquet({parquet_filepaths})'
 
-      con.close()
+    con = self.con.cursor()
+    reader = con.execute(f'{cache_query} LIMIT 0').fetch_record_batch()
+    output_schema = arrow_schema_to_schema(reader.schema)
+    con.close()
 
     if ROWID in output_schema.fields:
       del output_schema.fields[ROWID]
 
-    return json_query, output_schema, parquet_filepath
+    return cache_query, output_schema, parquet_filepaths
 
   @override
   def compute_signal(
@@ -1028,7 +1406,9 @@ class DatasetDuckDB(Dataset):
 
     signal.setup()
 
-    jsonl_cache_filepath = _jsonl_cache_filepath(
+    signal_schema = create_signal_schema(signal, input_path, manifest.data_schema)
+
+    shard_cache_dir = _shard_cache_dir(
       namespace=self.namespace,
       dataset_name=self.dataset_name,
       key=output_path,
@@ -1037,7 +1417,7 @@ class DatasetDuckDB(Dataset):
     self._compute_disk_cached(
       transform_fn=signal,
       output_path=output_path,
-      jsonl_cache_filepath=jsonl_cache_filepath,
+      shard_cache_dir=shard_cache_dir,
       unnest_input_path=input_path,
       overwrite=overwrite,
       query_options=DuckDBQueryParams(
@@ -1045,14 +1425,12 @@ class DatasetDuckDB(Dataset):
       ),
       task_step_id=task_step_id,
       task_step_description=f'Computing signal {signal} over {input_path}',
+      schema=signal_schema,
     )
 
-    signal_schema = create_signal_schema(signal, input_path, manifest.data_schema)
-
-    _, inferred_schema, parquet_filepath = self._reshard_cache(
+    _, inferred_schema, parquet_filepaths = self._reshard_cache(
       output_path=output_path,
-      schema=signal_schema,
-      jsonl_cache_filepaths=[jsonl_cache_filepath],
+      shard_cache_dirs=[shard_cache_dir],
       parquet_filename_prefix='data',
       overwrite=overwrite,
     )
@@ -1061,14 +1439,12 @@ class DatasetDuckDB(Dataset):
       signal_schema = inferred_schema
       signal_schema.get_field(output_path).signal = signal.model_dump()
 
-    assert parquet_filepath is not None
-    parquet_filename = os.path.basename(parquet_filepath)
-    output_dir = os.path.dirname(parquet_filepath)
+    output_dir = os.path.dirname(parquet_filepaths[0])
 
     signal_manifest_filepath = os.path.join(output_dir, SIGNAL_MANIFEST_FILENAME)
 
     signal_manifest = SignalManifest(
-      files=[parquet_filename],
+      files=[os.path.basename(filepath) for filepath in parquet_filepaths],
       data_schema=signal_schema,
       signal=signal,
       enriched_path=input_path,
@@ -1077,6 +1453,7 @@ class DatasetDuckDB(Dataset):
     )
     with open_file(signal_manifest_filepath, 'w') as f:
       f.write(signal_manifest.model_dump_json(exclude_none=True, indent=2))
+    self._bump_version()
 
     log(f'Wrote signal output to {output_dir}')
 
@@ -1117,7 +1494,18 @@ class DatasetDuckDB(Dataset):
 
     output_path = _col_destination_path(signal_col, is_computed_signal=True)
 
-    jsonl_cache_filepath = _jsonl_cache_filepath(
+    output_dir = os.path.join(self.dataset_path, _signal_dir(output_path))
+
+    # Resume from the chunks written by a previous, interrupted, computation of this embedding.
+    checkpoint = None
+    if not overwrite:
+      checkpoint = load_embeddings_checkpoint(
+        self.vector_store, output_dir, self._hnsw_settings_for(self.vector_store)
+      )
+    if checkpoint:
+      log(f'Resuming embedding {signal} over {input_path} from {output_dir}')
+
+    shard_cache_dir = _shard_cache_dir(
       namespace=self.namespace,
       dataset_name=self.dataset_name,
       key=output_path,
@@ -1126,7 +1514,7 @@ class DatasetDuckDB(Dataset):
     output_items = self._compute_disk_cached(
       signal,
       output_path=output_path,
-      jsonl_cache_filepath=jsonl_cache_filepath,
+      shard_cache_dir=shard_cache_dir,
       unnest_input_path=input_path,
       overwrite=overwrite,
       query_options=DuckDBQueryParams(
@@ -1134,9 +1522,9 @@ class DatasetDuckDB(Dataset):
       ),
       task_step_id=task_step_id,
       task_step_description=f'Computing embedding {signal} over {input_path}',
+      skip_rowids=checkpoint.rowids() if checkpoint else None,
     )
 
-    output_dir = os.path.join(self.dataset_path, _signal_dir(output_path))
     signal_schema = create_signal_schema(signal, input_path, manifest.data_schema)
 
     assert signal_schema, 'Signal schema should be defined for `TextEmbeddingSignal`.'
@@ -1148,6 +1536,8 @@ class DatasetDuckDB(Dataset):
       rowids=row_ids,
       signal_items=output_items,
       output_dir=output_dir,
+      checkpoint=checkpoint,
+      hnsw_settings=self._hnsw_settings_for(self.vector_store),
     )
 
     gc.collect()
@@ -1157,6 +1547,7 @@ class DatasetDuckDB(Dataset):
     # outputs are run.
     if os.path.exists(signal_manifest_filepath):
       os.remove(signal_manifest_filepath)
+      self._bump_version()
       # Call manifest() to recreate all the views, otherwise this could be stale and point to a non
       # existent file.
       self.manifest()
@@ -1173,6 +1564,7 @@ class DatasetDuckDB(Dataset):
 
     with open_file(signal_manifest_filepath, 'w') as f:
       f.write(signal_manifest.model_dump_json(exclude_none=True, indent=2))
+    self._bump_version()
 
     log(f'Wrote embedding index to {output_dir}')
 
@@ -1191,14 +1583,13 @@ class DatasetDuckDB(Dataset):
       raise ValueError(f'{signal_path} is not a signal.')
 
     # Delete the cache files.
-    shard_cache_filepath = _jsonl_cache_filepath(
+    shard_cache_dir = _shard_cache_dir(
       namespace=self.namespace,
       dataset_name=self.dataset_name,
       key=signal_path,
       project_dir=self.project_dir,
     )
-    if os.path.exists(shard_cache_filepath):
-      os.remove(shard_cache_filepath)
+    shutil.rmtree(shard_cache_dir, ignore_errors=True)
 
     delete_project_signal_config(
       self.namespace,
@@ -1209,6 +1600,7 @@ class DatasetDuckDB(Dataset):
 
     output_dir = os.path.join(self.dataset_path, _signal_dir(signal_path))
     shutil.rmtree(output_dir, ignore_errors=True)
+    self._bump_version()
 
   def _validate_filters(
     self, filters: Sequence[Filter], col_aliases: dict[str, PathTuple], manifest: DatasetManifest
@@ -1362,7 +1754,6 @@ class DatasetDuckDB(Dataset):
       raise ValueError(f'Unable to sort by path {path}. The field has no value.')
 
   @override
-  @functools.cache  # Cache stats for leaf paths since we ask on every dataset page refresh.
   def stats(self, leaf_path: Path, include_deleted: bool = False) -> StatsResult:
     if not leaf_path:
       raise ValueError('leaf_path must be provided')
@@ -1383,74 +1774,156 @@ class DatasetDuckDB(Dataset):
         'Provide a path to a key in that map instead.'
       )
 
-    duckdb_path = self._leaf_path_to_duckdb_path(path, manifest.data_schema)
-    inner_select = _select_sql(
-      duckdb_path,
-      flatten=True,
-      unnest=True,
-      path=path,
-      schema=manifest.data_schema,
-      span_from=self._resolve_span(path, manifest),
-    )
-
-    if manifest.data_schema.has_field((DELETED_LABEL_NAME,)) and not include_deleted:
-      where_clause = f'WHERE {DELETED_LABEL_NAME} IS NULL'
-    else:
-      where_clause = ''
+    # Hold the lock while computing, so concurrent requests for different leafs share one scan.
+    with self._stats_lock:
+      all_stats = self._all_stats(self._manifest_version, include_deleted)
+      if path not in all_stats:
+        # Leafs that are not computed eagerly, like binary values, are computed on their own.
+        all_stats[path] = self._compute_stats({path: leaf}, include_deleted, manifest)[path]
+      return all_stats[path]
+
+  # NOTE: The version of the dataset is part of the cache key, so writes invalidate the cache.
+  @functools.lru_cache(maxsize=2)
+  def _all_stats(self, version: str, include_deleted: bool) -> dict[PathTuple, StatsResult]:
+    """Return the stats of every leaf, reading them from the persisted stats store when fresh.
+
+    The leafs whose files changed since their stats were persisted are computed together, and
+    written back to the store.
+    """
+    del version
+    manifest = self.manifest()
+    stats_filepath = os.path.join(self.dataset_path, STATS_FILENAME)
+    try:
+      with open(stats_filepath) as f:
+        store = StatsStore.model_validate_json(f.read())
+    except (FileNotFoundError, ValidationError):
+      store = StatsStore()
+
+    source_files = [os.path.join(self.dataset_path, f) for f in self._source_manifest.files]
+    source_stamps = _file_stamps(source_files)
+    group_stamps = [(schema, _file_stamps(files)) for schema, files in self._column_groups]
+    deleted_stamps: list[tuple[int, int]] = []
+    if not include_deleted and manifest.data_schema.has_field((DELETED_LABEL_NAME,)):
+      deleted_stamps = _file_stamps(
+        [get_labels_sqlite_filename(self.dataset_path, DELETED_LABEL_NAME)]
+      )
 
-    # Compute the average length of text fields.
-    avg_text_length: Optional[int] = None
-    if leaf.dtype in (STRING, STRING_SPAN):
-      avg_length_query = f"""
-        SELECT avg(length(val))
-        FROM (SELECT {inner_select} AS val FROM t {where_clause})
-        USING SAMPLE {SAMPLE_AVG_TEXT_LENGTH};
-      """
-      row = self._query(avg_length_query)[0]
-      if row[0] is not None:
-        avg_text_length = int(row[0])
+    result: dict[PathTuple, StatsResult] = {}
+    leaf_stamps: dict[PathTuple, list[tuple[int, int]]] = {}
+    stale_leafs: dict[PathTuple, Field] = {}
+    for path, leaf in manifest.data_schema.leafs.items():
+      if path == (ROWID,) or not leaf.dtype or not _has_eager_stats(leaf.dtype):
+        continue
+      # Skip leafs that are not stored in the joined table, like the spans of embeddings.
+      if not self._column_to_duckdb_paths(Column(path), manifest.data_schema, False):
+        continue
+      # A leaf depends on the source, which aligns the rows, and on the column groups it is in.
+      stamps = source_stamps + deleted_stamps
+      for schema, group_stamp in group_stamps:
+        if any(path[:i] in schema.leafs for i in range(1, len(path) + 1)):
+          stamps = stamps + group_stamp
+      leaf_stamps[path] = stamps
+      persisted = store.leafs.get(_stats_key(path, include_deleted))
+      if persisted and persisted.stamps == stamps:
+        result[path] = persisted.stats
+      else:
+        stale_leafs[path] = leaf
 
-    total_count_query = (
-      f'SELECT count(val) FROM (SELECT {inner_select} as val FROM t {where_clause})'
-    )
-    total_count = int(self._query(total_count_query)[0][0])
+    if not stale_leafs:
+      return result
 
-    # Compute approximate count by sampling the data to avoid OOM.
-    if avg_text_length and avg_text_length > MAX_TEXT_LEN_DISTINCT_COUNT:
-      # Assume that every text field is unique.
-      approx_count_distinct = manifest.num_items
-    elif leaf.dtype == BOOLEAN:
-      approx_count_distinct = 2
-    else:
-      sample_size = TOO_MANY_DISTINCT
-      approx_count_query = f"""
-        SELECT approx_count_distinct(val) as approxCountDistinct
-        FROM (SELECT {inner_select} AS val FROM t {where_clause}) USING SAMPLE {sample_size};
-      """
-      row = self._query(approx_count_query)[0]
-      approx_count_distinct = int(row[0])
+    computed = self._compute_stats(stale_leafs, include_deleted, manifest)
+    result.update(computed)
+    # Drop the stats of leafs that no longer exist.
+    current_keys = {_stats_key(path, deleted) for path in leaf_stamps for deleted in (True, False)}
+    store.leafs = {key: value for key, value in store.leafs.items() if key in current_keys}
+    for path, stats in computed.items():
+      store.leafs[_stats_key(path, include_deleted)] = LeafStats(
+        stamps=leaf_stamps[path], stats=stats
+      )
+    # Write to a unique temporary file and rename, so concurrent readers never see a partial store.
+    tmp_stats_filepath = f'{stats_filepath}.{secrets.token_hex(8)}.tmp'
+    try:
+      with open(tmp_stats_filepath, 'w') as f:
+        f.write(store.model_dump_json(exclude_none=True))
+      os.replace(tmp_stats_filepath, stats_filepath)
+    except OSError:
+      # The dataset is read-only, so the stats are only cached in memory.
+      pass
+    return result
 
-      # Adjust the counts for the sample size.
-      factor = max(1, total_count / sample_size)
-      approx_count_distinct = round(approx_count_distinct * factor)
+  def _compute_stats(
+    self, leafs: dict[PathTuple, Field], include_deleted: bool, manifest: DatasetManifest
+  ) -> dict[PathTuple, StatsResult]:
+    """Compute the stats of leafs with one multi-aggregate query per scan of `t`.
 
-    result = StatsResult(
-      path=path,
-      total_count=total_count,
-      approx_count_distinct=approx_count_distinct,
-      avg_text_length=avg_text_length,
-    )
+    The leafs that are not repeated are computed in a single scan. Repeated leafs are unnested, so
+    each of them needs its own scan.
+    """
+    if manifest.data_schema.has_field((DELETED_LABEL_NAME,)) and not include_deleted:
+      where_clause = f'WHERE {DELETED_LABEL_NAME} IS NULL'
+    else:
+      where_clause = ''
 
-    # Compute min/max values for ordinal leafs, without sampling the data.
-    if is_ordinal(leaf.dtype):
-      min_max_query = f"""
-        SELECT MIN(val) AS minVal, MAX(val) AS maxVal
-        FROM (SELECT {inner_select} as val FROM t {where_clause})
-        {'WHERE NOT isnan(val)' if is_float(leaf.dtype) else ''}
+    scans: list[list[PathTuple]] = []
+    flat_paths = [path for path in leafs if PATH_WILDCARD not in path]
+    if flat_paths:
+      scans.append(flat_paths)
+    scans.extend([path] for path in leafs if PATH_WILDCARD in path)
+
+    result: dict[PathTuple, StatsResult] = {}
+    for paths in scans:
+      selects: list[str] = []
+      aggregates: list[str] = []
+      for i, path in enumerate(paths):
+        dtype = cast(DataType, leafs[path].dtype)
+        duckdb_path = self._leaf_path_to_duckdb_path(path, manifest.data_schema)
+        inner_select = _select_sql(
+          duckdb_path,
+          flatten=True,
+          unnest=True,
+          path=path,
+          schema=manifest.data_schema,
+          span_from=self._resolve_span(path, manifest),
+        )
+        val = f'val{i}'
+        selects.append(f'{inner_select} AS {val}')
+        # Compute min/max values for ordinal leafs, ignoring NaNs.
+        min_max_filter = f' FILTER (WHERE NOT isnan({val}))' if is_float(dtype) else ''
+        aggregates.extend(
+          [
+            f'count({val})',
+            f'approx_count_distinct({val})',
+            f'avg(length({val}))' if dtype in (STRING, STRING_SPAN) else 'NULL',
+            f'min({val}){min_max_filter}' if is_ordinal(dtype) else 'NULL',
+            f'max({val}){min_max_filter}' if is_ordinal(dtype) else 'NULL',
+          ]
+        )
+      row = self._query(
+        f"""
+        SELECT {', '.join(aggregates)}
+        FROM (SELECT {', '.join(selects)} FROM t {where_clause})
       """
-      row = self._query(min_max_query)[0]
-      result.min_val, result.max_val = row
-
+      )[0]
+
+      for i, path in enumerate(paths):
+        dtype = cast(DataType, leafs[path].dtype)
+        total_count, approx_count_distinct, avg_length, min_val, max_val = row[i * 5 : i * 5 + 5]
+        avg_text_length = int(avg_length) if avg_length is not None else None
+        if avg_text_length and avg_text_length > MAX_TEXT_LEN_DISTINCT_COUNT:
+          # Assume that every text field is unique.
+          approx_count_distinct = manifest.num_items
+        elif dtype == BOOLEAN:
+          approx_count_distinct = 2
+        stats = StatsResult(
+          path=path,
+          total_count=int(total_count),
+          approx_count_distinct=int(approx_count_distinct),
+          avg_text_length=avg_text_length,
+        )
+        if is_ordinal(dtype):
+          stats.min_val, stats.max_val = min_val, max_val
+        result[path] = stats
     return result
 
   @override
@@ -1463,13 +1936,269 @@ class DatasetDuckDB(Dataset):
     limit: Optional[int] = None,
     bins: Optional[Union[Sequence[Bin], Sequence[float]]] = None,
     include_deleted: bool = False,
+    approximate: bool = False,
   ) -> SelectGroupsResult:
-    if not leaf_path:
-      raise ValueError('leaf_path must be provided')
     sort_by = sort_by or GroupsSortBy.COUNT
     sort_order = sort_order or SortOrder.DESC
-    path = normalize_path(leaf_path)
     manifest = self.manifest()
+    sample = self._sample_table() if approximate else None
+    if sample:
+      exact_result = self._refined(
+        repr(
+          ('select_groups', leaf_path, filters, sort_by, sort_order, limit, bins, include_deleted)
+        ),
+        lambda: self.select_groups(
+          leaf_path, filters, sort_by, sort_order, limit, bins, include_deleted
+        ),
+      )
+      if exact_result:
+        return exact_result
+    table, sample_rate = sample or ('t', None)
+    inner_val = 'inner_val'
+    groups_query = self._groups_query(leaf_path, bins, include_deleted, manifest, inner_val)
+    if isinstance(groups_query, SelectGroupsResult):
+      return groups_query
+
+    count_column = GroupsSortBy.COUNT.value
+    value_column = GroupsSortBy.VALUE.value
+
+    limit_query = f'LIMIT {limit}' if limit else ''
+    where_query = self._groups_where_query(filters, include_deleted, manifest)
+    query = f"""
+      SELECT {groups_query.group_select} AS {value_column}, COUNT() AS {count_column}
+      FROM (SELECT {groups_query.inner_select} AS {inner_val} FROM {table} {where_query})
+      GROUP BY {value_column}
+      ORDER BY {sort_by.value} {sort_order.value}, {value_column}
+      {limit_query}
+    """
+    df = self._query_df(query)
+    counts = list(df.itertuples(index=False, name=None))
+    if groups_query.is_temporal:
+      # Replace any NaT with None and pd.Timestamp to native datetime objects.
+      counts = [(None if pd.isnull(val) else val.to_pydatetime(), count) for val, count in counts]
+
+    result = SelectGroupsResult(too_many_distinct=False, counts=counts, bins=groups_query.bins)
+    return _scale_groups(result, sample_rate) if sample_rate else result
+
+  @override
+  def select_groups_many(
+    self,
+    leaf_paths: Sequence[Path],
+    filters: Optional[Sequence[FilterLike]] = None,
+    sort_by: Optional[GroupsSortBy] = GroupsSortBy.COUNT,
+    sort_order: Optional[SortOrder] = SortOrder.DESC,
+    limit: Optional[int] = None,
+    include_deleted: bool = False,
+    approximate: bool = False,
+  ) -> list[SelectGroupsResult]:
+    manifest = self.manifest()
+    paths = tuple(normalize_path(leaf_path) for leaf_path in leaf_paths)
+    where_query = self._groups_where_query(filters, include_deleted, manifest)
+    args = (paths, where_query, sort_by or GroupsSortBy.COUNT, sort_order or SortOrder.DESC, limit)
+    version = self._manifest_version
+    sample = self._sample_table() if approximate else None
+    if sample:
+      exact_results = self._refined(
+        repr(('select_groups_many', *args, include_deleted)),
+        lambda: self._select_groups_many(version, *args, include_deleted, None),
+      )
+      if exact_results:
+        return list(exact_results)
+    return list(self._select_groups_many(version, *args, include_deleted, sample))
+
+  # NOTE: The version of the dataset and the filters are part of the cache key, so writes invalidate
+  # the cache.
+  @functools.lru_cache(maxsize=COUNT_CACHE_SIZE)
+  def _select_groups_many(
+    self,
+    version: str,
+    paths: tuple[PathTuple, ...],
+    where_query: str,
+    sort_by: GroupsSortBy,
+    sort_order: SortOrder,
+    limit: Optional[int],
+    include_deleted: bool,
+    sample: Optional[tuple[str, float]],
+  ) -> tuple[SelectGroupsResult, ...]:
+    """Compute the groups of many leafs with a `GROUPING SETS` query per scan of `t`.
+
+    The leafs that are not repeated are grouped in a single scan. Repeated leafs are unnested, so
+    each of them needs its own scan. When a sample table is given, the counts are estimated from it.
+    """
+    del version
+    table, sample_rate = sample or ('t', None)
+    manifest = self.manifest()
+    results: dict[int, SelectGroupsResult] = {}
+    groups_queries: dict[int, DuckDBGroupsQuery] = {}
+    for i, path in enumerate(paths):
+      groups_query = self._groups_query(path, None, include_deleted, manifest, f'val{i}')
+      if isinstance(groups_query, SelectGroupsResult):
+        results[i] = groups_query
+      else:
+        groups_queries[i] = groups_query
+
+    scans: list[list[int]] = []
+    flat_indices = [i for i, q in groups_queries.items() if PATH_WILDCARD not in q.path]
+    if flat_indices:
+      scans.append(flat_indices)
+    scans.extend([i] for i, q in groups_queries.items() if PATH_WILDCARD in q.path)
+
+    count_column = GroupsSortBy.COUNT.value
+    for indices in scans:
+      inner_selects = [f'{groups_queries[i].inner_select} AS val{i}' for i in indices]
+      group_selects = [f'{groups_queries[i].group_select} AS group{i}' for i in indices]
+      group_columns = [f'group{i}' for i in indices]
+      # Only the group column of its own grouping set is not NULL in a row, so sorting by all the
+      # group columns sorts the groups of each leaf by their value.
+      if sort_by == GroupsSortBy.COUNT:
+        order_sql = f'{count_column} {sort_order.value}'
+      else:
+        order_sql = ', '.join(f'{col} {sort_order.value}' for col in group_columns)
+      order_sql = ', '.join([order_sql, *group_columns])
+      set_index_sql = ' '.join(
+        f'WHEN GROUPING({col}) = 0 THEN {i}' for i, col in zip(indices, group_columns)
+      )
+      limit_query = (
+        f'QUALIFY row_number() OVER (PARTITION BY set_index ORDER BY {order_sql}) <= {limit}'
+        if limit
+        else ''
+      )
+      query = f"""
+        SELECT * FROM (
+          SELECT
+            CASE {set_index_sql} END AS set_index, {', '.join(group_columns)},
+            COUNT() AS {count_column}
+          FROM (
+            SELECT {', '.join(group_selects)}
+            FROM (SELECT {', '.join(inner_selects)} FROM {table} {where_query})
+          )
+          GROUP BY GROUPING SETS ({', '.join(f'({col})' for col in group_columns)})
+        )
+        {limit_query}
+        ORDER BY set_index, {order_sql}
+      """
+      counts: dict[int, list[tuple[Any, int]]] = {i: [] for i in indices}
+      for row in self._query(query):
+        set_index, count = row[0], row[-1]
+        counts[set_index].append((row[1 + indices.index(set_index)], count))
+      for i in indices:
+        result = SelectGroupsResult(
+          too_many_distinct=False, counts=counts[i], bins=groups_queries[i].bins
+        )
+        results[i] = _scale_groups(result, sample_rate) if sample_rate else result
+
+    return tuple(results[i] for i in range(len(paths)))
+
+  @override
+  def count(
+    self,
+    filters: Optional[Sequence[FilterLike]] = None,
+    include_deleted: bool = False,
+    approximate: bool = False,
+  ) -> CountResult:
+    manifest = self.manifest()
+    where_query = self._groups_where_query(filters, include_deleted, manifest)
+    version = self._manifest_version
+    sample = self._sample_table() if approximate else None
+    if not sample:
+      return CountResult(count=self._count_rows(version, where_query))
+
+    exact_count = self._refined(
+      repr(('count', where_query)), lambda: self._count_rows(version, where_query)
+    )
+    if exact_count is not None:
+      return CountResult(count=exact_count)
+    table, sample_rate = sample
+    sample_count = self._query(f'SELECT COUNT(*) FROM {table} {where_query}')[0][0]
+    count, count_error = _scale_count(sample_count, sample_rate)
+    return CountResult(count=count, is_approximate=True, count_error=count_error)
+
+  def _sample_table(self) -> Optional[tuple[str, float]]:
+    """Returns the table with the sample of rows that answers approximate queries, and its rate.
+
+    The sample is a uniform Bernoulli sample of `APPROXIMATE_SAMPLE_PERCENT` of the rows. Its rowids
+    are persisted with the dataset, so estimates are stable across restarts and versions. The rows
+    of the sample are copied from `t` once per version of the dataset. Returns None when the dataset
+    is small enough to be queried exactly.
+    """
+    manifest = self.manifest()
+    if manifest.num_items < APPROXIMATE_MIN_ROWS:
+      return None
+    with self._sample_lock:
+      if self._sample_version == self._manifest_version:
+        return _SAMPLE_TABLE, self._sample_rate
+
+      sample_filepath = os.path.join(self.dataset_path, SAMPLE_ROWIDS_FILENAME)
+      try:
+        sample_rowids = pq.read_table(sample_filepath)
+      except FileNotFoundError:
+        sample_rowids = self._execute(
+          f"""
+          SELECT {ROWID} FROM {SOURCE_VIEW_NAME}
+          USING SAMPLE {APPROXIMATE_SAMPLE_PERCENT} PERCENT (bernoulli, {APPROXIMATE_SAMPLE_SEED})
+        """
+        ).arrow()
+        # Write to a unique temporary file and rename, so concurrent readers never see a partial
+        # sample.
+        tmp_sample_filepath = f'{sample_filepath}.{secrets.token_hex(8)}.tmp'
+        try:
+          pq.write_table(sample_rowids, tmp_sample_filepath)
+          os.replace(tmp_sample_filepath, sample_filepath)
+        except OSError:
+          # The dataset is read-only, so the sample is only kept in memory.
+          pass
+
+      with closing(self.con.cursor()) as con:
+        con.register('sample_rowids', sample_rowids)
+        con.execute(
+          f"""
+          CREATE OR REPLACE TABLE {_SAMPLE_TABLE} AS (
+            SELECT * FROM t WHERE {ROWID} IN (SELECT {ROWID} FROM sample_rowids)
+          )
+        """
+        )
+        num_sampled = cast(tuple, con.execute(f'SELECT COUNT(*) FROM {_SAMPLE_TABLE}').fetchone())[
+          0
+        ]
+      # Scale by the fraction of rows that were actually sampled.
+      self._sample_rate = max(num_sampled, 1) / max(manifest.num_items, 1)
+      self._sample_version = self._manifest_version
+      return _SAMPLE_TABLE, self._sample_rate
+
+  def _refined(self, key: str, compute_exact: Callable[[], Any]) -> Any:
+    """Returns the exact result of an approximate query once it was computed in the background.
+
+    Until then, starts computing it in the background and returns None. Results are kept for the
+    current version of the dataset.
+    """
+    with self._refinement_lock:
+      if self._refinement_version != self._manifest_version:
+        self._refinements = {}
+        self._refinement_version = self._manifest_version
+      future = self._refinements.get(key)
+      # A refinement that failed is computed again, so the query is not approximate for good.
+      if future is None or (future.done() and future.exception()):
+        self._refinements[key] = self._refinement_executor.submit(compute_exact)
+        return None
+    if future.done() and not future.exception():
+      return future.result()
+    return None
+
+  def _groups_query(
+    self,
+    leaf_path: Path,
+    bins: Optional[Union[Sequence[Bin], Sequence[float]]],
+    include_deleted: bool,
+    manifest: DatasetManifest,
+    inner_val: str,
+  ) -> Union[DuckDBGroupsQuery, SelectGroupsResult]:
+    """Make the SQL that groups the values of a leaf, selected in the `inner_val` column.
+
+    Returns a `SelectGroupsResult` instead when the leaf has too many distinct values to group.
+    """
+    if not leaf_path:
+      raise ValueError('leaf_path must be provided')
+    path = normalize_path(leaf_path)
     leaf = manifest.data_schema.get_field(path)
     # Find the inner-most leaf in case this field is repeated.
     while leaf.repeated_field:
@@ -1485,8 +2214,7 @@ class DatasetDuckDB(Dataset):
         'Provide a path to a key in that map instead.'
       )
 
-    inner_val = 'inner_val'
-    outer_select = inner_val
+    group_select = inner_val
     # Normalize the bins to be `list[Bin]`.
     named_bins = _normalize_bins(bins or leaf.bins)
     stats = self.stats(leaf_path, include_deleted=include_deleted)
@@ -1495,70 +2223,65 @@ class DatasetDuckDB(Dataset):
     leaf_is_integer = is_integer(leaf.dtype)
     if not leaf.categorical and (leaf_is_float or leaf_is_integer):
       if named_bins is None:
-        # Auto-bin.
+        # Auto-bin. The bins are uniform, so the bin of a value is computed arithmetically.
         named_bins = _auto_bins(stats, NUM_AUTO_BINS)
-
-      sql_bounds = []
-      for label, start, end in named_bins:
-        if start is None:
-          start = cast(float, "'-Infinity'")
-        if end is None:
-          end = cast(float, "'Infinity'")
-        sql_bounds.append(f"('{label}', {start}, {end})")
-
-      bin_index_col = 'col0'
-      bin_min_col = 'col1'
-      bin_max_col = 'col2'
-      is_nan_filter = f'NOT isnan({inner_val}) AND' if leaf_is_float else ''
-
-      # We cast the field to `double` so binning works for both `float` and `int` fields.
-      outer_select = f"""(
-        SELECT {bin_index_col} FROM (
-          VALUES {', '.join(sql_bounds)}
-        ) WHERE {is_nan_filter}
-           {inner_val}::DOUBLE >= {bin_min_col} AND {inner_val}::DOUBLE < {bin_max_col}
-      )"""
+        group_select = _auto_bin_sql(inner_val, stats, NUM_AUTO_BINS, leaf_is_float)
+      else:
+        sql_bounds = []
+        for label, start, end in named_bins:
+          if start is None:
+            start = cast(float, "'-Infinity'")
+          if end is None:
+            end = cast(float, "'Infinity'")
+          sql_bounds.append(f"('{label}', {start}, {end})")
+
+        bin_index_col = 'col0'
+        bin_min_col = 'col1'
+        bin_max_col = 'col2'
+        is_nan_filter = f'NOT isnan({inner_val}) AND' if leaf_is_float else ''
+
+        # We cast the field to `double` so binning works for both `float` and `int` fields.
+        group_select = f"""(
+          SELECT {bin_index_col} FROM (
+            VALUES {', '.join(sql_bounds)}
+          ) WHERE {is_nan_filter}
+             {inner_val}::DOUBLE >= {bin_min_col} AND {inner_val}::DOUBLE < {bin_max_col}
+        )"""
     else:
       if stats.approx_count_distinct >= dataset.TOO_MANY_DISTINCT:
-        return SelectGroupsResult(too_many_distinct=True, counts=[], bins=named_bins)
-
-    count_column = GroupsSortBy.COUNT.value
-    value_column = GroupsSortBy.VALUE.value
-
-    limit_query = f'LIMIT {limit}' if limit else ''
-    duckdb_path = self._leaf_path_to_duckdb_path(path, manifest.data_schema)
-    inner_select = _select_sql(
-      duckdb_path,
-      flatten=True,
-      unnest=True,
-      path=path,
-      schema=manifest.data_schema,
-      span_from=self._resolve_span(path, manifest),
-    )
-
-    filters, _ = self._normalize_filters(filters, col_aliases={}, udf_aliases={}, manifest=manifest)
-    if not include_deleted and manifest.data_schema.has_field((DELETED_LABEL_NAME,)):
-      filters.append(Filter(path=(DELETED_LABEL_NAME,), op='not_exists'))
-    filter_queries = self._create_where(manifest, filters)
-
-    where_query = ''
-    if filter_queries:
-      where_query = f"WHERE {' AND '.join(filter_queries)}"
-
-    query = f"""
-      SELECT {outer_select} AS {value_column}, COUNT() AS {count_column}
-      FROM (SELECT {inner_select} AS {inner_val} FROM t {where_query})
-      GROUP BY {value_column}
-      ORDER BY {sort_by.value} {sort_order.value}, {value_column}
-      {limit_query}
-    """
-    df = self._query_df(query)
-    counts = list(df.itertuples(index=False, name=None))
-    if is_temporal(leaf.dtype):
-      # Replace any NaT with None and pd.Timestamp to native datetime objects.
-      counts = [(None if pd.isnull(val) else val.to_pydatetime(), count) for val, count in counts]
+        return SelectGroupsResult(too_many_distinct=True, counts=[], bins=named_bins)
+
+    duckdb_path = self._leaf_path_to_duckdb_path(path, manifest.data_schema)
+    inner_select = _select_sql(
+      duckdb_path,
+      flatten=True,
+      unnest=True,
+      path=path,
+      schema=manifest.data_schema,
+      span_from=self._resolve_span(path, manifest),
+    )
+    return DuckDBGroupsQuery(
+      path=path,
+      inner_select=inner_select,
+      group_select=group_select,
+      bins=named_bins,
+      is_temporal=is_temporal(leaf.dtype),
+    )
 
-    return SelectGroupsResult(too_many_distinct=False, counts=counts, bins=named_bins)
+  def _groups_where_query(
+    self,
+    filters: Optional[Sequence[FilterLike]],
+    include_deleted: bool,
+    manifest: DatasetManifest,
+  ) -> str:
+    """Returns the WHERE clause of the rows that are grouped by `select_groups`."""
+    normalized_filters, _ = self._normalize_filters(
+      filters, col_aliases={}, udf_aliases={}, manifest=manifest
+    )
+    if not include_deleted and manifest.data_schema.has_field((DELETED_LABEL_NAME,)):
+      normalized_filters.append(Filter(path=(DELETED_LABEL_NAME,), op='not_exists'))
+    filter_queries = self._create_where(manifest, normalized_filters)
+    return f"WHERE {' AND '.join(filter_queries)}" if filter_queries else ''
 
   def _topk_udf_to_sort_by(
     self,
@@ -1666,8 +2389,11 @@ class DatasetDuckDB(Dataset):
     combine_columns: bool = False,
     include_deleted: bool = False,
     user: Optional[UserInfo] = None,
+    cursor: Optional[str] = None,
+    batch_size: Optional[int] = None,
   ) -> SelectRowsResult:
     manifest = self.manifest()
+    version = self._manifest_version
     cols = self._normalize_columns(columns, manifest.data_schema, combine_columns)
     offset = offset or 0
     schema = manifest.data_schema
@@ -1726,28 +2452,7 @@ class DatasetDuckDB(Dataset):
     # Filtering and searching.
     where_query = ''
     filters, udf_filters = self._normalize_filters(filters, col_aliases, udf_aliases, manifest)
-    # Add search where queries.
-    for search in searches:
-      search_path = normalize_path(search.path)
-      duckdb_path = self._leaf_path_to_duckdb_path(search_path, manifest.data_schema)
-      select_str = _select_sql(
-        duckdb_path, flatten=False, unnest=False, path=search_path, schema=manifest.data_schema
-      )
-      if search.type == 'keyword':
-        filters.append(Filter(path=search_path, op='ilike', value=search.query))
-      elif search.type == 'semantic' or search.type == 'concept':
-        # Semantic search and concepts don't yet filter.
-        continue
-      elif search.type == 'metadata':
-        # Make a regular filter query.
-        filter = Filter(path=search_path, op=search.op, value=search.value)
-        filters.append(filter)
-      else:
-        raise ValueError(f'Unknown search operator {search.type}.')
-
-    if not include_deleted and manifest.data_schema.has_field((DELETED_LABEL_NAME,)):
-      filters.append(Filter(path=(DELETED_LABEL_NAME,), op='not_exists'))
-
+    filters.extend(self._search_filters(searches, include_deleted, manifest))
     filter_queries = self._create_where(manifest, filters)
     if filter_queries:
       where_query = f"WHERE {' AND '.join(filter_queries)}"
@@ -1762,7 +2467,7 @@ class DatasetDuckDB(Dataset):
         # If there are filters, we need to send rowids to the top k query.
         df = con.execute(f'SELECT {ROWID} FROM t {where_query}').df()
         total_num_rows = len(df)
-        rowids = [rowid for rowid in df[ROWID]]
+        rowids = df[ROWID].tolist()
 
       if rowids is not None and len(rowids) == 0:
         where_query = 'WHERE false'
@@ -1873,11 +2578,58 @@ class DatasetDuckDB(Dataset):
       else:
         sort_sql_before_udf.append(sort_sql)
 
+    # Pages of rows sorted only by columns of the dataset are fetched with keyset pagination: the
+    # rowid breaks ties so the order is total, and a page starts right after the last row of the
+    # previous page, instead of skipping `offset` rows.
+    use_keyset = (
+      bool(sort_sql_before_udf) and not sort_sql_after_udf and not topk_udf_col and not udf_filters
+    )
     order_query = ''
     if sort_sql_before_udf:
       order_query = (
         f'ORDER BY {", ".join(sort_sql_before_udf)} ' f'{cast(SortOrder, sort_order).value}'
       )
+      if use_keyset:
+        order_query += f', {ROWID} ASC'
+
+    if batch_size:
+      if udf_filters or sort_sql_after_udf:
+        con.close()
+        raise ValueError('`batch_size` is not supported when filtering or sorting by a signal UDF.')
+      if use_keyset and limit:
+        con.close()
+        raise ValueError(
+          '`batch_size` is not supported with `limit` when sorting, since the cursor of the next '
+          'page is only known once the stream is consumed. Use `limit` without `batch_size` to '
+          'page through the rows.'
+        )
+
+    cursor_query = ''
+    cursor_params: list[Any] = []
+    if cursor:
+      if not use_keyset:
+        raise ValueError(
+          '`cursor` is only supported when sorting by columns of the dataset, without a semantic '
+          'search or a signal filter.'
+        )
+      # Only the last sort key takes the sort order.
+      directions = [SortOrder.ASC] * (len(sort_sql_before_udf) - 1) + [cast(SortOrder, sort_order)]
+      cursor_condition, cursor_params = _keyset_condition(
+        sort_sql_before_udf, directions, _decode_cursor(cursor, len(sort_sql_before_udf))
+      )
+      cursor_query = f'AND {cursor_condition}' if where_query else f'WHERE {cursor_condition}'
+      offset = 0
+
+    # The cursor is computed from the sort keys of the last row of the page. The keys are selected
+    # as a single struct so NULLs and NaNs stay distinct when the rows go through pandas.
+    cursor_columns: list[str] = []
+    if use_keyset and limit:
+      cursor_columns = [CURSOR_COLUMN]
+      cursor_fields = [f"'k{i}': {sql}" for i, sql in enumerate(sort_sql_before_udf)]
+      cursor_fields.append(f"'rowid': {ROWID}")
+      select_queries.append(
+        f'{{{", ".join(cursor_fields)}}} AS {escape_string_literal(CURSOR_COLUMN)}'
+      )
 
     limit_query = ''
     if limit:
@@ -1889,88 +2641,179 @@ class DatasetDuckDB(Dataset):
         limit_query = f'LIMIT {limit} OFFSET {offset}'
 
     if not topk_udf_col and where_query:
-      total_num_rows = cast(tuple, con.execute(f'SELECT COUNT(*) FROM t {where_query}').fetchone())[
-        0
-      ]
+      total_num_rows = self._count_rows(version, where_query)
 
     # Fetch the data from DuckDB.
-    df = con.execute(
+    query = con.execute(
       f"""
       SELECT {', '.join(select_queries)} FROM t
-      {where_query}
+      {where_query} {cursor_query}
       {order_query}
       {limit_query}
-    """
-    ).df()
-    df = _replace_nan_with_none(df)
+    """,
+      cursor_params,
+    )
 
-    # Run UDFs on the transformed columns.
-    for udf_col in udf_columns:
-      signal = cast(Signal, udf_col.signal_udf)
-      signal_alias = udf_col.alias or _unique_alias(udf_col)
-      temp_signal_cols = columns_to_merge[signal_alias]
-      if len(temp_signal_cols) != 1:
-        raise ValueError(
-          f'Unable to compute signal {signal.name}. Signal UDFs only operate on leafs, but got '
-          f'{len(temp_signal_cols)} underlying columns that contain data related to {udf_col.path}.'
-        )
-      signal_column = list(temp_signal_cols.keys())[0]
-      input = df[signal_column]
+    if temp_rowid_selected:
+      # The rowid was only selected to compute vector signals.
+      del columns_to_merge[ROWID]
+    output_columns_to_merge = columns_to_merge
+    if combine_columns:
+      all_columns: dict[str, Column] = {}
+      for col_dict in columns_to_merge.values():
+        all_columns.update(col_dict)
+      output_columns_to_merge = {'*': all_columns}
+
+    def arrow_rows(table: pa.Table) -> Union[pa.Table, list[Item]]:
+      """Build the final rows from the columns fetched from DuckDB, when there are no UDFs."""
+      drop_columns = set(cursor_columns)
+      if temp_rowid_selected:
+        drop_columns.add(ROWID)
+      column_indices = [i for i, name in enumerate(table.column_names) if name not in drop_columns]
+      table = _normalize_arrow_table(table.select(column_indices))
+      return _arrow_to_rows(table, output_columns_to_merge, combine_columns)
+
+    def compute_udfs(df: pd.DataFrame) -> pd.DataFrame:
+      """Run the UDFs on the transformed columns."""
+      for name in cursor_columns:
+        del df[name]
+      for udf_col in udf_columns:
+        signal = cast(Signal, udf_col.signal_udf)
+        signal_alias = udf_col.alias or _unique_alias(udf_col)
+        temp_signal_cols = columns_to_merge[signal_alias]
+        if len(temp_signal_cols) != 1:
+          raise ValueError(
+            f'Unable to compute signal {signal.name}. Signal UDFs only operate on leafs, but got '
+            f'{len(temp_signal_cols)} underlying columns that contain data related to '
+            f'{udf_col.path}.'
+          )
+        signal_column = list(temp_signal_cols.keys())[0]
+        input = df[signal_column]
 
-      path_id = f'{self.namespace}/{self.dataset_name}:{udf_col.path}'
-      with DebugTimer(f'Computing signal "{signal.name}" on {path_id}'):
-        signal.setup()
+        path_id = f'{self.namespace}/{self.dataset_name}:{udf_col.path}'
+        with DebugTimer(f'Computing signal "{signal.name}" on {path_id}'):
+          signal.setup()
 
-        step_description = f'Computing {signal.key()} on {path_id}'
+          step_description = f'Computing {signal.key()} on {path_id}'
 
-        if isinstance(signal, VectorSignal):
-          embedding_signal = signal
-          vector_store = self._get_vector_db_index(embedding_signal.embedding, udf_col.path)
-          flat_keys = list(flatten_keys(df[ROWID], input))
-          signal_out = sparse_to_dense_compute(
-            iter(flat_keys), lambda keys: embedding_signal.vector_compute(keys, vector_store)
-          )
-          # Add progress.
-          if task_step_id is not None:
-            signal_out = report_progress(
-              signal_out,
-              task_step_id=task_step_id,
-              estimated_len=len(flat_keys),
-              step_description=step_description,
+          if isinstance(signal, VectorSignal):
+            embedding_signal = signal
+            vector_store = self._get_vector_db_index(embedding_signal.embedding, udf_col.path)
+            flat_keys = list(flatten_keys(df[ROWID], input))
+            signal_out = sparse_to_dense_compute(
+              iter(flat_keys), lambda keys: embedding_signal.vector_compute(keys, vector_store)
             )
-          df[signal_column] = list(deep_unflatten(signal_out, input))
-        else:
-          num_rich_data = count_primitives(input)
-          flat_input = cast(Iterator[Optional[RichData]], deep_flatten(input))
-          signal_out = sparse_to_dense_compute(
-            flat_input, lambda x: signal.compute(cast(Iterable[RichData], x))
-          )
-          # Add progress.
-          if task_step_id is not None:
-            signal_out = report_progress(
-              signal_out,
-              task_step_id=task_step_id,
-              estimated_len=num_rich_data,
-              step_description=step_description,
-            )
-          signal_out_list = list(signal_out)
-          if signal_column in temp_column_to_offset_column:
-            offset_column_name, field = temp_column_to_offset_column[signal_column]
-            nested_spans: Iterable[Item] = df[offset_column_name]
-            flat_spans = deep_flatten(nested_spans)
-            for text_span, item in zip(flat_spans, signal_out_list):
-              _offset_any_span(cast(int, text_span[SPAN_KEY][TEXT_SPAN_START_FEATURE]), item, field)
-
-          if len(signal_out_list) != num_rich_data:
-            raise ValueError(
-              f'The signal generated {len(signal_out_list)} values but the input data had '
-              f"{num_rich_data} values. This means the signal either didn't generate a "
-              '"None" for a sparse output, or generated too many items.'
+            # Add progress.
+            if task_step_id is not None:
+              signal_out = report_progress(
+                signal_out,
+                task_step_id=task_step_id,
+                estimated_len=len(flat_keys),
+                step_description=step_description,
+              )
+            df[signal_column] = list(deep_unflatten(signal_out, input))
+          else:
+            num_rich_data = count_primitives(input)
+            flat_input = cast(Iterator[Optional[RichData]], deep_flatten(input))
+            signal_out = sparse_to_dense_compute(
+              flat_input, lambda x: signal.compute(cast(Iterable[RichData], x))
             )
+            # Add progress.
+            if task_step_id is not None:
+              signal_out = report_progress(
+                signal_out,
+                task_step_id=task_step_id,
+                estimated_len=num_rich_data,
+                step_description=step_description,
+              )
+            signal_out_list = list(signal_out)
+            if signal_column in temp_column_to_offset_column:
+              offset_column_name, field = temp_column_to_offset_column[signal_column]
+              nested_spans: Iterable[Item] = df[offset_column_name]
+              flat_spans = deep_flatten(nested_spans)
+              for text_span, item in zip(flat_spans, signal_out_list):
+                text_span_start = cast(int, text_span[SPAN_KEY][TEXT_SPAN_START_FEATURE])
+                _offset_any_span(text_span_start, item, field)
+
+            if len(signal_out_list) != num_rich_data:
+              raise ValueError(
+                f'The signal generated {len(signal_out_list)} values but the input data had '
+                f"{num_rich_data} values. This means the signal either didn't generate a "
+                '"None" for a sparse output, or generated too many items.'
+              )
+
+            df[signal_column] = list(deep_unflatten(signal_out_list, input))
+
+          signal.teardown()
+      return df
+
+    def merge_columns(df: pd.DataFrame) -> pd.DataFrame:
+      """Merge the temporary columns into the final columns."""
+      if temp_rowid_selected:
+        del df[ROWID]
+
+      for offset_column, _ in temp_column_to_offset_column.values():
+        del df[offset_column]
+
+      for final_col_name, temp_columns in output_columns_to_merge.items():
+        for temp_col_name, column in temp_columns.items():
+          if combine_columns:
+            dest_path = _col_destination_path(column)
+            spec = _split_path_into_subpaths_of_lists(dest_path)
+            df[temp_col_name] = list(wrap_in_dicts(df[temp_col_name], spec))
+
+          # If the temp col name is the same as the final name, we can skip merging. This happens
+          # when we select a source leaf column.
+          if temp_col_name == final_col_name:
+            continue
+
+          if final_col_name not in df:
+            df[final_col_name] = df[temp_col_name]
+          else:
+            df[final_col_name] = merge_series(df[final_col_name], df[temp_col_name])
+          del df[temp_col_name]
 
-          df[signal_column] = list(deep_unflatten(signal_out_list, input))
+      if combine_columns:
+        # Since we aliased every column to `*`, the object will have only '*' as the key. We need to
+        # elevate the all the columns under '*'.
+        df = pd.DataFrame.from_records(df['*'])
+      return df
+
+    if batch_size:
+      rows_per_batch = batch_size
+
+      def stream_batches() -> Iterator[SelectRowsData]:
+        try:
+          if not udf_columns:
+            for batch in query.fetch_record_batch(rows_per_batch=rows_per_batch):
+              yield arrow_rows(pa.Table.from_batches([batch]))
+            return
+          # DuckDB fetches pandas chunks in multiples of its vector size, so the chunks are
+          # re-sliced into frames of `batch_size` rows before computing the UDFs.
+          vectors_per_chunk = math.ceil(rows_per_batch / DUCKDB_VECTOR_SIZE)
+          chunks = (query.fetch_df_chunk(vectors_per_chunk) for _ in itertools.count())
+          frames = itertools.takewhile(lambda df: not df.empty, chunks)
+          for df in _rechunk_frames(frames, rows_per_batch):
+            yield merge_columns(compute_udfs(_replace_nan_with_none(df)))
+        finally:
+          result.close()
+
+      result = SelectRowsResult(stream_batches(), total_num_rows, close=con.close)
+      return result
+
+    next_cursor: Optional[str] = None
+    if not udf_columns:
+      # Without UDFs, the rows are built straight from Arrow, without a round-trip through pandas.
+      table = query.arrow()
+      con.close()
+      if cursor_columns and table.num_rows == limit:
+        next_cursor = _encode_cursor(table.column(CURSOR_COLUMN)[-1].as_py())
+      return SelectRowsResult(arrow_rows(table), total_num_rows, next_cursor)
 
-        signal.teardown()
+    df = _replace_nan_with_none(query.df())
+    if cursor_columns and len(df) == limit:
+      next_cursor = _encode_cursor(df[CURSOR_COLUMN].iloc[-1])
+    df = compute_udfs(df)
 
     if not df.empty and (udf_filters or sort_sql_after_udf):
       # Re-upload the udf outputs to duckdb so we can filter/sort on them.
@@ -1994,45 +2837,16 @@ class DatasetDuckDB(Dataset):
 
       df = _replace_nan_with_none(rel.df())
 
-    if temp_rowid_selected:
-      del df[ROWID]
-      del columns_to_merge[ROWID]
-
-    if combine_columns:
-      all_columns: dict[str, Column] = {}
-      for col_dict in columns_to_merge.values():
-        all_columns.update(col_dict)
-      columns_to_merge = {'*': all_columns}
-
-    for offset_column, _ in temp_column_to_offset_column.values():
-      del df[offset_column]
-
-    for final_col_name, temp_columns in columns_to_merge.items():
-      for temp_col_name, column in temp_columns.items():
-        if combine_columns:
-          dest_path = _col_destination_path(column)
-          spec = _split_path_into_subpaths_of_lists(dest_path)
-          df[temp_col_name] = list(wrap_in_dicts(df[temp_col_name], spec))
-
-        # If the temp col name is the same as the final name, we can skip merging. This happens when
-        # we select a source leaf column.
-        if temp_col_name == final_col_name:
-          continue
-
-        if final_col_name not in df:
-          df[final_col_name] = df[temp_col_name]
-        else:
-          df[final_col_name] = merge_series(df[final_col_name], df[temp_col_name])
-        del df[temp_col_name]
-
     con.close()
+    return SelectRowsResult(merge_columns(df), total_num_rows, next_cursor)
 
-    if combine_columns:
-      # Since we aliased every column to `*`, the object will have only '*' as the key. We need to
-      # elevate the all the columns under '*'.
-      df = pd.DataFrame.from_records(df['*'])
-
-    return SelectRowsResult(df, total_num_rows)
+  # NOTE: The version of the dataset is part of the cache key, so writes invalidate the cache.
+  @functools.lru_cache(maxsize=COUNT_CACHE_SIZE)
+  def _count_rows(self, version: str, where_query: str) -> int:
+    """Count the rows of the joined table that match a WHERE clause."""
+    del version
+    with closing(self.con.cursor()) as con:
+      return cast(tuple, con.execute(f'SELECT COUNT(*) FROM t {where_query}').fetchone())[0]
 
   @override
   def select_rows_schema(
@@ -2099,56 +2913,91 @@ class DatasetDuckDB(Dataset):
   ) -> int:
     created = datetime.now()
 
-    # If filters and searches are defined with row_ids, add this as a filter.
-    if row_ids:
-      filters = list(filters) if filters else []
-      filters.append(Filter(path=(ROWID,), op='in', value=list(row_ids)))
-
-    insert_row_ids = (
-      row[ROWID]
-      for row in self.select_rows(
-        columns=[ROWID], searches=searches, filters=filters, include_deleted=include_deleted
-      )
-    )
-
     labels_filepath = get_labels_sqlite_filename(self.dataset_path, name)
+    select_rowids = self._select_rowids_sql(searches, filters, include_deleted)
 
     with self._label_file_lock[labels_filepath]:
       # We don't cache sqlite connections as they cannot be shared across threads.
-      sqlite_con = sqlite3.connect(labels_filepath)
-      sqlite_cur = sqlite_con.cursor()
-
-      # Create the table if it doesn't exist.
-      sqlite_cur.execute(
-        f"""
-        CREATE TABLE IF NOT EXISTS "{name}" (
-          {ROWID} VARCHAR NOT NULL PRIMARY KEY,
-          label VARCHAR NOT NULL,
-          created DATETIME)
-      """
-      )
-
-      num_labels = 0
-      for row_id in insert_row_ids:
-        # We use ON CONFLICT to resolve the same row UUID being labeled again. In this case, we
-        # overwrite the existing label with the new label.
-        sqlite_cur.execute(
+      with closing(sqlite3.connect(labels_filepath)) as sqlite_con:
+        # Create the table if it doesn't exist.
+        sqlite_con.execute(
           f"""
-            INSERT INTO "{name}" VALUES (?, ?, ?)
-            ON CONFLICT({ROWID}) DO UPDATE SET label=excluded.label;
-          """,
-          (row_id, value, created.isoformat()),
+          CREATE TABLE IF NOT EXISTS "{name}" (
+            {ROWID} VARCHAR NOT NULL PRIMARY KEY,
+            label VARCHAR NOT NULL,
+            created DATETIME)
+        """
         )
-        num_labels += 1
-      sqlite_con.commit()
-      sqlite_con.close()
-
-    # Any deleted rows will cause statistics to be out of date.
-    if num_labels > 0 and name == DELETED_LABEL_NAME:
-      self.stats.cache_clear()
+        sqlite_con.commit()
+
+      with self._attach_labels(labels_filepath) as (con, labels_db, rowids_table):
+        num_labels = self._select_rowids_into(con, rowids_table, select_rowids, row_ids)
+        # The sqlite attachment doesn't support ON CONFLICT, so rows that are labeled again are
+        # overwritten with the new label first, and only the rows without a label are inserted.
+        con.execute('BEGIN TRANSACTION')
+        con.execute(
+          f"""
+          UPDATE {labels_db}."{name}" SET label = ?
+          WHERE {ROWID} IN (SELECT {ROWID} FROM {rowids_table})
+        """,
+          [value],
+        )
+        con.execute(
+          f"""
+          INSERT INTO {labels_db}."{name}"
+          SELECT {ROWID}, ?, ? FROM {rowids_table}
+          WHERE {ROWID} NOT IN (SELECT {ROWID} FROM {labels_db}."{name}")
+        """,
+          [value, created.isoformat()],
+        )
+        con.execute('COMMIT')
+    self._bump_version()
 
     return num_labels
 
+  @contextmanager
+  def _attach_labels(
+    self, labels_filepath: str
+  ) -> Iterator[tuple[duckdb.DuckDBPyConnection, str, str]]:
+    """Attach a sqlite label file to a new DuckDB cursor, to write labels with set-based queries.
+
+    Yields the cursor, the name of the attached database, and the name of a temporary table to
+    hold the rowids being written.
+    """
+    suffix = secrets.token_hex(8)
+    labels_db = f'__labels_{suffix}__'
+    rowids_table = f'__label_rowids_{suffix}__'
+    with closing(self.con.cursor()) as con:
+      con.execute(f"ATTACH '{labels_filepath}' AS {labels_db} (TYPE SQLITE)")
+      try:
+        yield con, labels_db, rowids_table
+      finally:
+        con.execute(f'DROP TABLE IF EXISTS {rowids_table}')
+        con.execute(f'DETACH {labels_db}')
+
+  def _select_rowids_into(
+    self,
+    con: duckdb.DuckDBPyConnection,
+    rowids_table: str,
+    select_rowids: str,
+    row_ids: Optional[Sequence[str]] = None,
+  ) -> int:
+    """Materialize the selected rowids into a temporary table and return how many there are.
+
+    The rowids are materialized before writing, since the joined table reads the label files that
+    are being written. When `row_ids` are given, the selection is restricted to them with a
+    semi-join against an Arrow table, instead of inlining every rowid in an `IN` filter.
+    """
+    if row_ids:
+      row_ids_view = f'{rowids_table}_input'
+      con.register(row_ids_view, pa.table({ROWID: pa.array(row_ids, type=pa.string())}))
+      select_rowids = f"""
+        SELECT {ROWID} FROM ({select_rowids})
+        WHERE {ROWID} IN (SELECT {ROWID} FROM {row_ids_view})
+      """
+    con.execute(f'CREATE TEMP TABLE {rowids_table} AS {select_rowids}')
+    return cast(tuple, con.execute(f'SELECT COUNT(*) FROM {rowids_table}').fetchone())[0]
+
   @override
   def get_label_names(self) -> list[str]:
     self.manifest()
@@ -2169,36 +3018,24 @@ class DatasetDuckDB(Dataset):
     if not os.path.exists(labels_filepath):
       raise ValueError(f'Label with name "{name}" does not exist.')
 
-    # If filters and searches are defined with row_ids, add this as a filter.
-    if row_ids:
-      filters = list(filters) if filters else []
-      filters.append(Filter(path=(ROWID,), op='in', value=list(row_ids)))
-
-    remove_row_ids = [
-      row[ROWID]
-      for row in self.select_rows(
-        columns=[ROWID], searches=searches, filters=filters, include_deleted=include_deleted
-      )
-    ]
+    select_rowids = self._select_rowids_sql(searches, filters, include_deleted)
 
     with self._label_file_lock[labels_filepath]:
-      with closing(sqlite3.connect(labels_filepath)) as conn:
-        conn.executemany(
+      with self._attach_labels(labels_filepath) as (con, labels_db, rowids_table):
+        num_removed = self._select_rowids_into(con, rowids_table, select_rowids, row_ids)
+        con.execute(
           f"""
-            DELETE FROM "{name}"
-            WHERE {ROWID} = ?
-          """,
-          [(x,) for x in remove_row_ids],
+          DELETE FROM {labels_db}."{name}"
+          WHERE {ROWID} IN (SELECT {ROWID} FROM {rowids_table})
+        """
         )
-        conn.commit()
+      with closing(sqlite3.connect(labels_filepath)) as conn:
         count = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
-        if count == 0:
-          delete_file(labels_filepath)
+      if count == 0:
+        delete_file(labels_filepath)
+    self._bump_version()
 
-    if remove_row_ids and name == DELETED_LABEL_NAME:
-      self.stats.cache_clear()
-
-    return len(remove_row_ids)
+    return num_removed
 
   @override
   def media(self, item_id: str, leaf_path: Path) -> MediaResult:
@@ -2309,6 +3146,49 @@ class DatasetDuckDB(Dataset):
 
     return duckdb_paths
 
+  def _search_filters(
+    self, searches: Sequence[Search], include_deleted: bool, manifest: DatasetManifest
+  ) -> list[Filter]:
+    """Returns the filters that keyword and metadata searches, and deleted rows, translate to."""
+    filters: list[Filter] = []
+    # Add search where queries.
+    for search in searches:
+      search_path = normalize_path(search.path)
+      duckdb_path = self._leaf_path_to_duckdb_path(search_path, manifest.data_schema)
+      select_str = _select_sql(
+        duckdb_path, flatten=False, unnest=False, path=search_path, schema=manifest.data_schema
+      )
+      if search.type == 'keyword':
+        filters.append(Filter(path=search_path, op='ilike', value=search.query))
+      elif search.type == 'semantic' or search.type == 'concept':
+        # Semantic search and concepts don't yet filter.
+        continue
+      elif search.type == 'metadata':
+        # Make a regular filter query.
+        filter = Filter(path=search_path, op=search.op, value=search.value)
+        filters.append(filter)
+      else:
+        raise ValueError(f'Unknown search operator {search.type}.')
+
+    if not include_deleted and manifest.data_schema.has_field((DELETED_LABEL_NAME,)):
+      filters.append(Filter(path=(DELETED_LABEL_NAME,), op='not_exists'))
+
+    return filters
+
+  def _select_rowids_sql(
+    self,
+    searches: Optional[Sequence[Search]],
+    filters: Optional[Sequence[FilterLike]],
+    include_deleted: bool,
+  ) -> str:
+    """Returns a query that selects the rowids of the rows matching the searches and filters."""
+    manifest = self.manifest()
+    source_filters, _ = self._normalize_filters(filters, {}, {}, manifest)
+    source_filters.extend(self._search_filters(searches or [], include_deleted, manifest))
+    filter_queries = self._create_where(manifest, source_filters)
+    where_query = f"WHERE {' AND '.join(filter_queries)}" if filter_queries else ''
+    return f'SELECT {ROWID} FROM t {where_query}'
+
   def _normalize_filters(
     self,
     filter_likes: Optional[Sequence[FilterLike]],
@@ -2614,7 +3494,9 @@ class DatasetDuckDB(Dataset):
 
     limit_clause = ''
     if query_options.limit:
-      limit_clause = f'LIMIT {query_options.limit}'
+      # Order the rows before limiting them, so every query with the same options, like another
+      # shard or a resumed computation, selects the same rows.
+      limit_clause = f'ORDER BY {ROWID} LIMIT {query_options.limit}'
       if query_options.offset:
         limit_clause += f' OFFSET {query_options.offset}'
 
@@ -2636,8 +3518,11 @@ class DatasetDuckDB(Dataset):
     include_deleted: bool = False,
     num_jobs: int = 1,
     execution_type: TaskExecutionType = 'threads',
+    max_concurrency: int = 16,
   ) -> Iterable[Item]:
     is_tmp_output = output_column is None
+    if max_concurrency < 1:
+      raise ValueError(f'`max_concurrency` must be at least 1, got {max_concurrency}.')
 
     manifest = self.manifest()
 
@@ -2674,26 +3559,26 @@ class DatasetDuckDB(Dataset):
     else:
       output_path = (output_column,)
 
-    parquet_filepath: Optional[str] = None
     if not is_tmp_output:
       if manifest.data_schema.has_field(output_path):
         if overwrite:
           field = manifest.data_schema.get_field(output_path)
           if field.map is None:
             raise ValueError(f'{output_path} is not a map column so it cannot be overwritten.')
-          # Delete the parquet file and map manifest.
+          # Delete the parquet files and map manifest.
           assert output_column is not None
-          parquet_filepath = os.path.join(
-            self.dataset_path, get_parquet_filename(output_column, shard_index=0, num_shards=1)
-          )
-          if os.path.exists(parquet_filepath):
-            delete_file(parquet_filepath)
-
           map_manifest_filepath = os.path.join(
             self.dataset_path, f'{output_column}.{MAP_MANIFEST_SUFFIX}'
           )
           if os.path.exists(map_manifest_filepath):
+            with open_file(map_manifest_filepath) as f:
+              old_map_manifest = MapManifest.model_validate_json(f.read())
+            for parquet_filename in old_map_manifest.files:
+              parquet_filepath = os.path.join(self.dataset_path, parquet_filename)
+              if os.path.exists(parquet_filepath):
+                delete_file(parquet_filepath)
             delete_file(map_manifest_filepath)
+          self._bump_version()
 
         else:
           raise ValueError(
@@ -2706,7 +3591,7 @@ class DatasetDuckDB(Dataset):
 
     num_jobs = get_task_manager().get_num_workers() if num_jobs == -1 else num_jobs
 
-    jsonl_cache_filepaths: list[str] = []
+    shard_cache_dirs: list[str] = []
 
     output_col_desc_suffix = f' to "{output_column}"' if output_column else ''
     progress_description = (
@@ -2720,7 +3605,7 @@ class DatasetDuckDB(Dataset):
     )
     subtasks: list[tuple[TaskFn, list[Any]]] = []
     for i in range(num_jobs):
-      jsonl_cache_filepath = _jsonl_cache_filepath(
+      shard_cache_dir = _shard_cache_dir(
         namespace=self.namespace,
         dataset_name=self.dataset_name,
         key=output_path,
@@ -2737,7 +3622,7 @@ class DatasetDuckDB(Dataset):
             map_fn,
             batch_size,
             output_path,
-            jsonl_cache_filepath,
+            shard_cache_dir,
             i,
             num_jobs,
             input_path,
@@ -2747,11 +3632,12 @@ class DatasetDuckDB(Dataset):
             resolve_span,
             (task_id, 0),
             progress_description,
+            max_concurrency,
           ],
         )
       )
 
-      jsonl_cache_filepaths.append(jsonl_cache_filepath)
+      shard_cache_dirs.append(shard_cache_dir)
 
     # Execute all the subtasks in parallel.
     get_task_manager().execute_sharded(
@@ -2759,26 +3645,43 @@ class DatasetDuckDB(Dataset):
       type=execution_type,
       subtasks=subtasks,
     )
-    show_progress(
-      task_step_id=(task_id, 0), total_len=manifest.num_items, description=progress_description
-    )
 
-    # Wait for the tasks to finish before reading the outputs.
-    get_task_manager().wait([task_id])
+    output_writer: Optional[_ParquetOutputWriter] = None
+    try:
+      with ThreadPoolExecutor(max_workers=1) as executor:
+        if not is_tmp_output:
+          # Write the outputs of each shard to the output files as soon as the shard is completed,
+          # while the later shards are still computing.
+          output_writer = _ParquetOutputWriter(
+            _get_parquet_filepath_prefix(self.dataset_path, output_path)
+          )
+          writing = executor.submit(output_writer.write_shard_caches, shard_cache_dirs, task_id)
+
+        show_progress(
+          task_step_id=(task_id, 0), total_len=manifest.num_items, description=progress_description
+        )
+
+        # Wait for the tasks to finish before reading the outputs.
+        get_task_manager().wait([task_id])
+        if output_writer:
+          writing.result()
+    except BaseException:
+      if output_writer:
+        output_writer.abort()
+      raise
 
-    json_query, map_schema, parquet_filepath = self._reshard_cache(
+    cache_query, map_schema, parquet_filepaths = self._reshard_cache(
       output_path=output_path,
-      jsonl_cache_filepaths=jsonl_cache_filepaths,
+      shard_cache_dirs=shard_cache_dirs,
       is_tmp_output=is_tmp_output,
+      output_writer=output_writer,
     )
 
-    result = DuckDBMapOutput(con=self.con, query=json_query, output_column=output_column)
+    result = DuckDBMapOutput(con=self.con, query=cache_query, output_column=output_column)
 
     if is_tmp_output:
       return result
 
-    assert parquet_filepath is not None
-
     map_field_root = map_schema.get_field(output_path)
 
     map_source: str = ''
@@ -2793,19 +3696,19 @@ class DatasetDuckDB(Dataset):
       date_created=datetime.now(),
     )
 
-    parquet_dir = os.path.dirname(parquet_filepath)
+    parquet_dir = os.path.dirname(parquet_filepaths[0])
     map_manifest_filepath = os.path.join(parquet_dir, f'{output_column}.{MAP_MANIFEST_SUFFIX}')
-    parquet_filename = os.path.basename(parquet_filepath)
     map_manifest = MapManifest(
-      files=[parquet_filename],
+      files=[os.path.basename(filepath) for filepath in parquet_filepaths],
       data_schema=map_schema,
       parquet_id=get_map_parquet_id(output_path),
       py_version=metadata.version('lilac'),
     )
     with open_file(map_manifest_filepath, 'w') as f:
       f.write(map_manifest.model_dump_json(exclude_none=True, indent=2))
+    self._bump_version()
 
-    log(f'Wrote map output to {parquet_filepath}')
+    log(f'Wrote map output to {parquet_dir}')
 
     # Promote any new string columns as media fields if the length is above a threshold.
     for path, field in map_schema.leafs.items():
@@ -2821,7 +3724,7 @@ class DatasetDuckDB(Dataset):
     map_fn: MapFn,
     batch_size: Optional[int],
     output_path: PathTuple,
-    jsonl_cache_filepath: str,
+    shard_cache_dir: str,
     job_id: int,
     job_count: int,
     unnest_input_path: Optional[PathTuple] = None,
@@ -2831,6 +3734,7 @@ class DatasetDuckDB(Dataset):
     resolve_span: bool = False,
     task_step_id: Optional[TaskStepId] = None,
     task_step_description: Optional[str] = None,
+    max_concurrency: int = 1,
   ) -> None:
     map_sig = inspect.signature(map_fn)
     if len(map_sig.parameters) > 2 or len(map_sig.parameters) == 0:
@@ -2840,6 +3744,7 @@ class DatasetDuckDB(Dataset):
       )
 
     has_job_id_arg = len(map_sig.parameters) == 2
+    is_async = inspect.iscoroutinefunction(map_fn)
 
     def _map_iterable(items: Iterable[RichData]) -> Iterable[Optional[Item]]:
       batch: Iterable[Any]
@@ -2856,15 +3761,22 @@ class DatasetDuckDB(Dataset):
       else:
         map_args = (batch,)
 
+      outputs: Iterable[Any]
+      if is_async:
+        # Async functions are awaited concurrently, and their outputs are written in order.
+        outputs = async_map_ordered(map_fn, zip(*map_args), max_concurrency)
+      else:
+        outputs = map(map_fn, *map_args)
+
       if batch_size is None:
-        yield from map(map_fn, *map_args)
+        yield from outputs
       else:
-        yield from itertools.chain.from_iterable(map(map_fn, *map_args))
+        yield from itertools.chain.from_iterable(outputs)
 
     self._compute_disk_cached(
       _map_iterable,
       output_path=output_path,
-      jsonl_cache_filepath=jsonl_cache_filepath,
+      shard_cache_dir=shard_cache_dir,
       unnest_input_path=unnest_input_path,
       overwrite=overwrite,
       query_options=query_options,
@@ -3098,21 +4010,38 @@ def read_source_manifest(dataset_path: str) -> SourceManifest:
   return source_manifest
 
 
+def _stats_key(path: PathTuple, include_deleted: bool) -> str:
+  """The key of the stats of a leaf in the `StatsStore`."""
+  return json.dumps([list(path), include_deleted])
+
+
+def _has_eager_stats(dtype: DataType) -> bool:
+  """Whether the stats of a leaf are computed with the stats of all the other leafs."""
+  return dtype in (STRING, STRING_SPAN, BOOLEAN) or is_ordinal(dtype)
+
+
+def _file_stamps(files: list[str]) -> list[tuple[int, int]]:
+  """Return the (mtime, size) of each file, to tell if any of the files changed."""
+  stamps: list[tuple[int, int]] = []
+  for file in files:
+    stat = os.stat(file)
+    stamps.append((stat.st_mtime_ns, stat.st_size))
+  return stamps
+
+
 def _signal_dir(enriched_path: PathTuple) -> str:
   """Get the filename prefix for a signal parquet file."""
   path_without_wildcards = (p for p in enriched_path if p != PATH_WILDCARD)
   return os.path.join(*path_without_wildcards)
 
 
-def _get_parquet_filepath(
+def _get_parquet_filepath_prefix(
   dataset_path: str,
   output_path: PathTuple,
   parquet_filename_prefix: Optional[str] = None,
 ) -> str:
-  # The final parquet file is not sharded.
-  parquet_filename = get_parquet_filename(
-    parquet_filename_prefix or output_path[-1], shard_index=0, num_shards=1
-  )
+  """Returns the path of the parquet files of a map or signal output, without the shard suffix."""
+  parquet_filename = parquet_filename_prefix or output_path[-1]
   path_prefix: Optional[PathTuple]
   if parquet_filename_prefix:
     path_prefix = output_path
@@ -3131,7 +4060,7 @@ def _get_parquet_filepath(
   return os.path.join(dataset_path, parquet_rel_filepath)
 
 
-def _jsonl_cache_filepath(
+def _shard_cache_dir(
   namespace: str,
   dataset_name: str,
   key: Union[list[str], PathTuple],
@@ -3140,7 +4069,7 @@ def _jsonl_cache_filepath(
   shard_id: Optional[int] = None,
   shard_count: Optional[int] = None,
 ) -> str:
-  """Get the filepath for a map function's cache file."""
+  """Get the directory of the parquet fragments that cache the outputs of a map or signal shard."""
   tmp_dir: Optional[tempfile.TemporaryDirectory] = None
   if not is_temporary:
     cache_dir = os.path.join(get_lilac_cache_dir(project_dir), namespace, dataset_name)
@@ -3160,10 +4089,214 @@ def _jsonl_cache_filepath(
   return os.path.join(
     cache_dir,
     subdir,
-    f'{filename_prefix}{job_range_suffix}.jsonl',
+    f'{filename_prefix}{job_range_suffix}.cache',
   )
 
 
+def _cache_fragment_filepaths(shard_cache_dir: str) -> list[str]:
+  """Returns the parquet fragments of a shard cache, in the order they were written."""
+  if not os.path.isdir(shard_cache_dir):
+    return []
+  return [
+    os.path.join(shard_cache_dir, filename)
+    for filename in sorted(os.listdir(shard_cache_dir))
+    if filename.endswith('.parquet')
+  ]
+
+
+def _write_cache_fragments(
+  items: Iterable[Item], shard_cache_dir: str, schema: Optional[pa.Schema]
+) -> None:
+  """Writes the items to new parquet fragments of a shard cache.
+
+  A fragment is flushed every `SHARD_CACHE_FLUSH_ROWS` items or `SHARD_CACHE_FLUSH_SECONDS`, and
+  when the items raise, so the cache keeps every item that was computed.
+  """
+  os.makedirs(shard_cache_dir, exist_ok=True)
+  next_index = len(_cache_fragment_filepaths(shard_cache_dir))
+  buffer: list[Item] = []
+  last_flush = time.monotonic()
+
+  def _flush() -> None:
+    nonlocal next_index, last_flush
+    if schema:
+      table = pa.Table.from_pylist(buffer, schema=schema)
+    elif buffer:
+      inferred_table: Optional[pa.Table] = None
+      try:
+        inferred_table = pa.Table.from_pylist(buffer)
+        inferred_type = pa.struct(list(inferred_table.schema))
+      except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # A value has different types in different items, so the type of each item is inferred on
+        # its own and widened, like `_unify_cache_fragments` does across fragments.
+        inferred_type = functools.reduce(
+          _merge_arrow_types, (pa.infer_type([item]) for item in buffer)
+        )
+      # Parquet can't store empty structs, so they get a dummy child like in `infer_schema`.
+      parquet_type = _with_empty_struct_children(inferred_type)
+      if inferred_table is not None and parquet_type.equals(inferred_type):
+        table = inferred_table
+      else:
+        table = pa.Table.from_pylist(
+          [_encode_json_values(item, parquet_type) for item in buffer],
+          schema=pa.schema(list(parquet_type)),
+        )
+    else:
+      # A shard without outputs still writes a fragment so it has a schema to read.
+      table = pa.table({ROWID: pa.array([], type=pa.string())})
+    buffer.clear()
+    _write_cache_fragment(table, os.path.join(shard_cache_dir, f'{next_index:05d}.parquet'))
+    next_index += 1
+    last_flush = time.monotonic()
+
+  try:
+    for item in items:
+      buffer.append(item)
+      if (
+        len(buffer) >= SHARD_CACHE_FLUSH_ROWS
+        or time.monotonic() - last_flush >= SHARD_CACHE_FLUSH_SECONDS
+      ):
+        _flush()
+  except BaseException:
+    # Keep the items computed before the error. If they can't be written, the error of the items is
+    # raised, not the error of the flush.
+    if buffer:
+      try:
+        _flush()
+      except Exception as flush_error:
+        log(f'Failed to cache the outputs computed before an error: {flush_error}')
+    raise
+  if buffer or next_index == 0:
+    _flush()
+
+
+def _write_cache_fragment(table: pa.Table, filepath: str) -> None:
+  """Writes a fragment atomically, so a reader never sees a partially written fragment."""
+  tmp_filepath = f'{filepath}.{secrets.token_hex(8)}.tmp'
+  pq.write_table(table, tmp_filepath)
+  os.replace(tmp_filepath, filepath)
+
+
+def _unify_cache_fragments(filepaths: list[str]) -> None:
+  """Rewrites the fragments whose schema differs from the others with a schema common to all.
+
+  Fragments without a given schema are written with the schema inferred from their own items, so a
+  column can be null in one fragment, or a struct can have fields that are missing in another.
+  """
+  schemas = [pq.read_schema(filepath) for filepath in filepaths]
+  if not schemas:
+    return
+  unified = schemas[0]
+  for schema in schemas[1:]:
+    unified = pa.schema(list(_merge_arrow_types(pa.struct(list(unified)), pa.struct(list(schema)))))
+  for filepath, schema in zip(filepaths, schemas):
+    if not schema.equals(unified):
+      _write_cache_fragment(_widen_table(pq.read_table(filepath), unified), filepath)
+
+
+def _rewrite_parquet_file(filepath: str, schema: pa.Schema) -> None:
+  """Rewrites a parquet file with a wider schema, one row group at a time."""
+  tmp_filepath = f'{filepath}.{secrets.token_hex(8)}.tmp'
+  parquet_file = pq.ParquetFile(filepath)
+  with pq.ParquetWriter(tmp_filepath, schema) as writer:
+    for i in range(parquet_file.num_row_groups):
+      row_group = parquet_file.read_row_group(i)
+      writer.write_table(_widen_table(row_group, schema), row_group_size=len(row_group))
+  os.replace(tmp_filepath, filepath)
+
+
+def _delete_parquet_files(filepath_prefix: str) -> None:
+  """Deletes the parquet files written by `_ParquetOutputWriter` for the prefix."""
+  output_dir, filename_prefix = os.path.split(filepath_prefix)
+  if not os.path.isdir(output_dir):
+    return
+  filename_re = re.compile(rf'{re.escape(filename_prefix)}-\d{{5}}-of-\d{{5}}\.parquet')
+  for filename in os.listdir(output_dir):
+    if filename_re.fullmatch(filename):
+      delete_file(os.path.join(output_dir, filename))
+
+
+def _with_empty_struct_children(dtype: pa.DataType) -> pa.DataType:
+  """Returns the type with a null `__empty__` child in every struct without children."""
+  if pa.types.is_struct(dtype):
+    if dtype.num_fields == 0:
+      return pa.struct([('__empty__', pa.null())])
+    return pa.struct([(field.name, _with_empty_struct_children(field.type)) for field in dtype])
+  if pa.types.is_list(dtype):
+    return pa.list_(_with_empty_struct_children(dtype.value_type))
+  return dtype
+
+
+def _widen_table(table: Union[pa.Table, pa.RecordBatch], schema: pa.Schema) -> pa.Table:
+  """Converts a table to a schema widened by `_merge_arrow_types`."""
+  source_type = pa.struct(list(table.schema))
+  dtype = pa.struct(list(schema))
+  return pa.Table.from_pylist(
+    [_encode_json_values(row, dtype, source_type) for row in table.to_pylist()], schema=schema
+  )
+
+
+def _encode_json_values(
+  value: Any, dtype: pa.DataType, source_type: Optional[pa.DataType] = None
+) -> Any:
+  """JSON-encodes the parts of a value that have the `_JSON_ENCODED_TYPE`.
+
+  The source type is the type the value was read with. Parts that already had the JSON-encoded type
+  are kept as they are. Without a source type, the value is a Python object that was never encoded.
+  """
+  if value is None:
+    return None
+  if dtype.equals(_JSON_ENCODED_TYPE):
+    if source_type is not None and source_type.equals(_JSON_ENCODED_TYPE):
+      return value
+    return json.dumps(value, separators=(',', ':'), default=str)
+  if pa.types.is_struct(dtype) and isinstance(value, dict):
+    source_fields = (
+      {field.name: field.type for field in source_type}
+      if source_type is not None and pa.types.is_struct(source_type)
+      else {}
+    )
+    return {
+      field.name: _encode_json_values(
+        value.get(field.name), field.type, source_fields.get(field.name)
+      )
+      for field in dtype
+    }
+  if pa.types.is_list(dtype) and isinstance(value, list):
+    source_value_type = (
+      source_type.value_type if source_type is not None and pa.types.is_list(source_type) else None
+    )
+    return [_encode_json_values(v, dtype.value_type, source_value_type) for v in value]
+  return value
+
+
+def _merge_arrow_types(a: pa.DataType, b: pa.DataType) -> pa.DataType:
+  """Returns a type that can hold the values of both types.
+
+  Values that can't share a type, e.g. a string and an integer, are JSON-encoded as DuckDB's JSON
+  type does, and get the `_JSON_ENCODED_TYPE`.
+  """
+  if a.equals(b) or pa.types.is_null(b):
+    return a
+  if pa.types.is_null(a):
+    return b
+  if a.equals(_JSON_ENCODED_TYPE) or b.equals(_JSON_ENCODED_TYPE):
+    return _JSON_ENCODED_TYPE
+  if pa.types.is_struct(a) and pa.types.is_struct(b):
+    fields = {field.name: field.type for field in a}
+    for field in b:
+      fields[field.name] = (
+        _merge_arrow_types(fields[field.name], field.type) if field.name in fields else field.type
+      )
+    return pa.struct(list(fields.items()))
+  if pa.types.is_list(a) and pa.types.is_list(b):
+    return pa.list_(_merge_arrow_types(a.value_type, b.value_type))
+  numeric_types = (pa.types.is_integer, pa.types.is_floating)
+  if any(is_type(a) for is_type in numeric_types) and any(is_type(b) for is_type in numeric_types):
+    return pa.float64() if pa.types.is_floating(a) or pa.types.is_floating(b) else pa.int64()
+  return _JSON_ENCODED_TYPE
+
+
 def split_column_name(column: str, split_name: str) -> str:
   """Get the name of a split column."""
   return f'{column}.{split_name}'
@@ -3305,6 +4438,179 @@ def _make_schema_from_path(path: PathTuple, field: Field) -> Schema:
   return Schema(fields=field.fields)
 
 
+def _cursor_value(value: Any) -> Any:
+  """Convert a sort key returned by DuckDB to a JSON value that DuckDB can compare with."""
+  if isinstance(value, np.generic):
+    value = value.item()
+  if isinstance(value, (datetime, date)):
+    return value.isoformat()
+  # NaN is kept as is: DuckDB sorts it above every other number, and compares it equal to itself.
+  return value
+
+
+def _encode_cursor(keys: dict[str, Any]) -> str:
+  """Encode the sort keys and the rowid of a row as an opaque cursor."""
+  data = json.dumps([_cursor_value(value) for value in keys.values()])
+  return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str, num_sort_keys: int) -> list[Any]:
+  """Decode a cursor into the sort keys and the rowid of the last row of the previous page."""
+  try:
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+  except (ValueError, UnicodeError) as e:
+    raise ValueError(f'Invalid cursor: "{cursor}".') from e
+  if not isinstance(values, list) or len(values) != num_sort_keys + 1:
+    raise ValueError(f'Invalid cursor: "{cursor}". The cursor is for a different sort.')
+  return values
+
+
+def _keyset_condition(
+  sort_sqls: list[str], directions: list[SortOrder], values: list[Any]
+) -> tuple[str, list[Any]]:
+  """Make a condition that selects the rows after a cursor in `ORDER BY sort_sqls, rowid`.
+
+  DuckDB sorts NULLs last in both directions, so a NULL key is only followed by NULL keys.
+
+  Returns:
+    A tuple of the SQL condition and its parameters.
+  """
+  *sort_values, rowid = values
+  condition = f'{ROWID} > ?'
+  params: list[Any] = [rowid]
+  for sql, direction, value in reversed(list(zip(sort_sqls, directions, sort_values))):
+    if value is None:
+      condition = f'({sql} IS NULL AND {condition})'
+    else:
+      op = '>' if direction == SortOrder.ASC else '<'
+      condition = f'({sql} {op} ? OR {sql} IS NULL OR ({sql} = ? AND {condition}))'
+      params = [value, value, *params]
+  return condition, params
+
+
+def _arrow_to_rows(
+  table: pa.Table, columns_to_merge: dict[str, dict[str, Column]], combine_columns: bool
+) -> Union[pa.Table, list[Item]]:
+  """Merge the temporary columns of a select rows query into the final rows.
+
+  When no columns need to be merged, the Arrow table is returned as is.
+  """
+  if not combine_columns and all(
+    list(temp_columns) == [final_col_name]
+    for final_col_name, temp_columns in columns_to_merge.items()
+  ):
+    return table
+
+  final_columns: dict[str, list[Item]] = {}
+  for final_col_name, temp_columns in columns_to_merge.items():
+    for temp_col_name, column in temp_columns.items():
+      values = table.column(temp_col_name).to_pylist()
+      if combine_columns:
+        dest_path = _col_destination_path(column)
+        spec = _split_path_into_subpaths_of_lists(dest_path)
+        values = list(wrap_in_dicts(values, spec))
+      if final_col_name not in final_columns:
+        final_columns[final_col_name] = values
+      else:
+        final_columns[final_col_name] = _merge_cells(final_columns[final_col_name], values)
+
+  if combine_columns:
+    # Every column was aliased to `*`, so the rows are the merged values under '*'.
+    return final_columns['*']
+  names = list(final_columns.keys())
+  return [dict(zip(names, values)) for values in zip(*final_columns.values())]
+
+
+def _rechunk_frames(frames: Iterable[pd.DataFrame], batch_size: int) -> Iterator[pd.DataFrame]:
+  """Re-slice a stream of data frames into frames of exactly `batch_size` rows, except the last."""
+  buffer: list[pd.DataFrame] = []
+  num_buffered = 0
+  for frame in frames:
+    buffer.append(frame)
+    num_buffered += len(frame)
+    if num_buffered < batch_size:
+      continue
+    df = pd.concat(buffer, ignore_index=True)
+    num_full = len(df) - len(df) % batch_size
+    for start in range(0, num_full, batch_size):
+      yield df.iloc[start : start + batch_size].reset_index(drop=True)
+    buffer = [df.iloc[num_full:].reset_index(drop=True)]
+    num_buffered = len(df) - num_full
+  if num_buffered:
+    yield pd.concat(buffer, ignore_index=True)
+
+
+def _normalize_arrow_table(table: pa.Table) -> pa.Table:
+  """Make the rows of an Arrow table match the rows that DuckDB returns through pandas.
+
+  Top-level NaN floats are replaced with nulls, maps are converted to a struct of a `key` and a
+  `value` list, and duplicate column names are renamed.
+  """
+  table = table.rename_columns(_deduplicate_column_names(table.column_names))
+  for i, field in enumerate(table.schema):
+    column = table.column(i)
+    if pa.types.is_floating(field.type):
+      column = pc.if_else(pc.is_nan(column), pa.scalar(None, field.type), column)
+    elif _arrow_type_has_map(field.type):
+      column = pa.chunked_array([_map_to_struct(chunk) for chunk in column.chunks])
+    else:
+      continue
+    table = table.set_column(i, field.name, column)
+  return table
+
+
+def _deduplicate_column_names(names: list[str]) -> list[str]:
+  """Rename duplicate column names with a `_<count>` suffix, like DuckDB does for pandas."""
+  counts: dict[str, int] = {}
+  new_names: list[str] = []
+  for name in names:
+    if name not in counts:
+      counts[name] = 1
+      new_names.append(name)
+      continue
+    counts[name] += 1
+    new_name = f'{name}_{counts[name]}'
+    suffix = 1
+    while new_name in counts:
+      new_name = f'{name}_{counts[name]}_{suffix}'
+      suffix += 1
+    counts[new_name] = 1
+    new_names.append(new_name)
+  return new_names
+
+
+def _arrow_type_has_map(type: pa.DataType) -> bool:
+  if pa.types.is_map(type):
+    return True
+  if pa.types.is_struct(type):
+    return any(_arrow_type_has_map(type.field(i).type) for i in range(type.num_fields))
+  if pa.types.is_list(type):
+    return _arrow_type_has_map(type.value_type)
+  return False
+
+
+def _map_to_struct(array: pa.Array) -> pa.Array:
+  """Recursively convert the maps in an Arrow array to a struct of a `key` and a `value` list."""
+  if not _arrow_type_has_map(array.type):
+    return array
+  if array.offset:
+    # Offsets of sliced arrays can't be combined with a null mask.
+    array = pa.concat_arrays([array])
+  type = array.type
+  mask = array.is_null()
+  if pa.types.is_map(type):
+    keys = pa.ListArray.from_arrays(array.offsets, _map_to_struct(array.keys))
+    values = pa.ListArray.from_arrays(array.offsets, _map_to_struct(array.items))
+    return pa.StructArray.from_arrays([keys, values], names=['key', 'value'], mask=mask)
+  if pa.types.is_struct(type):
+    return pa.StructArray.from_arrays(
+      [_map_to_struct(array.field(i)) for i in range(type.num_fields)],
+      names=[type.field(i).name for i in range(type.num_fields)],
+      mask=mask,
+    )
+  return pa.ListArray.from_arrays(array.offsets, _map_to_struct(array.values), mask=mask)
+
+
 def _replace_nan_with_none(df: pd.DataFrame) -> pd.DataFrame:
   """DuckDB returns np.nan for missing field in string column, replace with None for correctness."""
   # TODO(https://github.com/duckdb/duckdb/issues/4066): Remove this once duckdb fixes upstream.
@@ -3367,6 +4673,55 @@ def _auto_bins(stats: StatsResult, num_bins: int) -> list[Bin]:
   return bins
 
 
+def _scale_count(sample_count: int, sample_rate: float) -> tuple[int, int]:
+  """Estimate a count from the count in a Bernoulli sample, with the half-width of its 95% CI."""
+  count = round(sample_count / sample_rate)
+  error = APPROXIMATE_Z_SCORE * math.sqrt(sample_count * (1 - sample_rate)) / sample_rate
+  return count, math.ceil(error)
+
+
+def _scale_groups(result: SelectGroupsResult, sample_rate: float) -> SelectGroupsResult:
+  """Estimate the counts of groups from their counts in a sample of the rows."""
+  counts: list[tuple[Any, int]] = []
+  count_errors: list[int] = []
+  for value, sample_count in result.counts:
+    count, count_error = _scale_count(sample_count, sample_rate)
+    counts.append((value, count))
+    count_errors.append(count_error)
+  return SelectGroupsResult(
+    too_many_distinct=result.too_many_distinct,
+    counts=counts,
+    bins=result.bins,
+    is_approximate=True,
+    count_errors=count_errors,
+  )
+
+
+def _auto_bin_sql(val: str, stats: StatsResult, num_bins: int, is_float: bool) -> str:
+  """Returns the label of the auto bin of a value, computed arithmetically.
+
+  The bins are those of `_auto_bins`. The bin index is estimated with a division, and then corrected
+  by one when rounding put the value on the other side of a bin boundary.
+  """
+  min_val = cast(float, stats.min_val)
+  bin_width = (cast(float, stats.max_val) - min_val) / num_bins
+  if bin_width == 0:
+    # All the values are equal to the start of the last bin.
+    index = str(num_bins - 1)
+  else:
+    value = f'{val}::DOUBLE'
+    estimate = f'floor(({value} - {min_val}) / {bin_width})'
+    index = f"""(
+      {estimate}
+      - ({value} < {min_val} + {estimate} * {bin_width})::INTEGER
+      + ({value} >= {min_val} + ({estimate} + 1) * {bin_width})::INTEGER
+    )"""
+  label = f'CAST(least({num_bins - 1}, greatest(0, {index}))::INTEGER AS VARCHAR)'
+  # NOTE: `least` and `greatest` ignore NULLs, so missing values are kept out of the bins here.
+  is_missing = f'{val} IS NULL OR isnan({val})' if is_float else f'{val} IS NULL'
+  return f'(CASE WHEN {is_missing} THEN NULL ELSE {label} END)'
+
+
 def get_labels_sqlite_filename(dataset_output_dir: str, label_name: str) -> str:
   """Get the filepath to the labels file."""
   return os.path.join(dataset_output_dir, f'{label_name}{LABELS_SQLITE_SUFFIX}')
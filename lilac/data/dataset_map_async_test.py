@@ -0,0 +1,174 @@
+"""Tests for dataset.map() with async map functions, against a local stand-in HTTP server."""
+
+import asyncio
+import threading
+from collections import Counter
+from typing import Iterator
+
+import pytest
+from pytest_mock import MockerFixture
+
+from ..schema import Item
+from . import dataset_utils as dataset_utils_module
+from .dataset_test_utils import TestDataMaker
+
+
+class StandInServer:
+  """A local HTTP server standing in for an LLM or web service.
+
+  A request for `/<text>` responds with the text upper-cased, after a delay. While `failures` has a
+  positive count for the path, the request responds with a 503 and decrements it.
+  """
+
+  def __init__(self, delay: float = 0.02) -> None:
+    self.delay = delay
+    self.failures: Counter[str] = Counter()
+    self.requests: Counter[str] = Counter()
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.port = 0
+    self._loop = asyncio.new_event_loop()
+    self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+    self._server: asyncio.Server
+
+  def start(self) -> None:
+    self._thread.start()
+    self._server = asyncio.run_coroutine_threadsafe(
+      asyncio.start_server(self._handle, '127.0.0.1', 0), self._loop
+    ).result()
+    self.port = self._server.sockets[0].getsockname()[1]
+
+  def stop(self) -> None:
+    self._loop.call_soon_threadsafe(self._server.close)
+    self._loop.call_soon_threadsafe(self._loop.stop)
+    self._thread.join()
+
+  async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    _, path, _ = (await reader.readline()).decode().split(' ')
+    # Skip the headers.
+    while (await reader.readline()) not in (b'\r\n', b''):
+      pass
+
+    self.in_flight += 1
+    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    await asyncio.sleep(self.delay)
+    self.in_flight -= 1
+
+    self.requests[path] += 1
+    if self.failures[path] > 0:
+      self.failures[path] -= 1
+      status, body = '503 Service Unavailable', ''
+    else:
+      status, body = '200 OK', path[1:].upper()
+    headers = f'Content-Length: {len(body)}\r\nConnection: close'
+    writer.write(f'HTTP/1.1 {status}\r\n{headers}\r\n\r\n{body}'.encode())
+    await writer.drain()
+    writer.close()
+
+
+async def _get(port: int, path: str) -> str:
+  """Requests the path from the stand-in server, and returns the body of the response."""
+  reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode())
+  response = (await reader.read()).decode()
+  writer.close()
+  await writer.wait_closed()
+  status_line, _, rest = response.partition('\r\n')
+  if ' 200 ' not in status_line:
+    raise ConnectionError(status_line)
+  _, _, body = rest.partition('\r\n\r\n')
+  return body
+
+
+@pytest.fixture
+def server() -> Iterator[StandInServer]:
+  server = StandInServer()
+  server.start()
+  yield server
+  server.stop()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(mocker: MockerFixture) -> None:
+  mocker.patch.object(dataset_utils_module, 'ASYNC_MAP_RETRY_BACKOFF_SECONDS', 0.0)
+
+
+@pytest.mark.parametrize('num_jobs', [1, 2])
+def test_async_map(num_jobs: int, server: StandInServer, make_test_data: TestDataMaker) -> None:
+  texts = [f'text{i}' for i in range(20)]
+  dataset = make_test_data([{'text': text} for text in texts])
+
+  async def _upper(item: Item) -> Item:
+    return await _get(server.port, f'/{item["text"]}')
+
+  dataset.map(_upper, output_column='upper', num_jobs=num_jobs, max_concurrency=4)
+
+  rows = list(dataset.select_rows(['text', 'upper']))
+  assert rows == [{'text': text, 'upper': text.upper()} for text in texts]
+  # The calls of each job overlap, up to the max concurrency.
+  assert 1 < server.max_in_flight <= 4 * num_jobs
+
+
+def test_async_map_job_id(server: StandInServer, make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'text': text} for text in 'abcd'])
+
+  async def _upper(item: Item, job_id: int) -> Item:
+    return {'upper': await _get(server.port, f'/{item["text"]}'), 'job_id': job_id}
+
+  dataset.map(_upper, output_column='upper', num_jobs=2)
+
+  rows = list(dataset.select_rows(['upper']))
+  assert rows == [
+    {'upper': {'upper': 'A', 'job_id': 0}},
+    {'upper': {'upper': 'B', 'job_id': 0}},
+    {'upper': {'upper': 'C', 'job_id': 1}},
+    {'upper': {'upper': 'D', 'job_id': 1}},
+  ]
+
+
+def test_async_map_batch(server: StandInServer, make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'text': text} for text in 'abcde'])
+
+  async def _upper(items: list[Item]) -> list[Item]:
+    return await asyncio.gather(*[_get(server.port, f'/{item["text"]}') for item in items])
+
+  dataset.map(_upper, output_column='upper', batch_size=2, max_concurrency=2)
+
+  rows = list(dataset.select_rows(['upper']))
+  assert rows == [{'upper': text.upper()} for text in 'abcde']
+
+
+def test_async_map_retries(server: StandInServer, make_test_data: TestDataMaker) -> None:
+  server.failures.update({'/a': 2, '/b': 2, '/c': 2})
+  dataset = make_test_data([{'text': text} for text in 'abc'])
+
+  async def _upper(item: Item) -> Item:
+    return await _get(server.port, f'/{item["text"]}')
+
+  dataset.map(_upper, output_column='upper')
+
+  rows = list(dataset.select_rows(['upper']))
+  assert rows == [{'upper': 'A'}, {'upper': 'B'}, {'upper': 'C'}]
+  assert server.requests == {'/a': 3, '/b': 3, '/c': 3}
+
+
+def test_async_map_raises_after_retries(
+  server: StandInServer, make_test_data: TestDataMaker
+) -> None:
+  server.failures['/b'] = dataset_utils_module.ASYNC_MAP_MAX_RETRIES + 1
+  dataset = make_test_data([{'text': text} for text in 'abc'])
+
+  async def _upper(item: Item) -> Item:
+    return await _get(server.port, f'/{item["text"]}')
+
+  with pytest.raises(Exception):
+    dataset.map(_upper, output_column='upper')
+  assert not dataset.manifest().data_schema.has_field(('upper',))
+
+  # The output written before the failing call is cached, so it is not requested again.
+  server.requests.clear()
+  dataset.map(_upper, output_column='upper')
+
+  rows = list(dataset.select_rows(['upper']))
+  assert rows == [{'upper': 'A'}, {'upper': 'B'}, {'upper': 'C'}]
+  assert '/a' not in server.requests
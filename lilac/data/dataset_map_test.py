@@ -1,11 +1,14 @@
 """Tests for dataset.map()."""
 
 import inspect
+import os
 import re
 from typing import ClassVar, Iterable, Optional
 
+import pyarrow.parquet as pq
 import pytest
 from distributed import Client, LocalCluster
+from pytest_mock import MockerFixture
 from typing_extensions import override
 
 from .. import tasks
@@ -26,7 +29,9 @@ from ..test_utils import (
   TEST_TIME,
   allow_any_datetime,
 )
-from .dataset import DatasetManifest, Filter, SelectGroupsResult, StatsResult
+from ..utils import get_dataset_output_dir
+from . import dataset_duckdb as dataset_duckdb_module
+from .dataset import Dataset, DatasetManifest, Filter, SelectGroupsResult, StatsResult
 from .dataset_test_utils import (
   TEST_DATASET_NAME,
   TEST_NAMESPACE,
@@ -556,6 +561,254 @@ def test_map_filter(
   assert len(rows) == 9
 
 
+@pytest.mark.parametrize('execution_type', TEST_EXECUTION_TYPES)
+def test_map_shards_by_position(
+  execution_type: tasks.TaskExecutionType, make_test_data: TestDataMaker
+) -> None:
+  dataset = make_test_data([{'text': letter} for letter in 'abcdefghij'])
+
+  def _map_fn(item: Item, job_id: int) -> Item:
+    return job_id
+
+  dataset.map(_map_fn, output_column='job_id', num_jobs=4, execution_type=execution_type)
+
+  # Each shard computes a contiguous range of the source rows.
+  rows = list(dataset.select_rows(['text', 'job_id']))
+  assert [(row['text'], row['job_id']) for row in rows] == [
+    ('a', 0),
+    ('b', 0),
+    ('c', 0),
+    ('d', 1),
+    ('e', 1),
+    ('f', 1),
+    ('g', 2),
+    ('h', 2),
+    ('i', 2),
+    ('j', 3),
+  ]
+
+
+def test_map_output_types_change_between_cache_flushes(
+  make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  # Flush every output to its own cache fragment.
+  mocker.patch.object(dataset_duckdb_module, 'SHARD_CACHE_FLUSH_ROWS', 1)
+  dataset = make_test_data([{'text': letter} for letter in 'abcd'])
+  outputs: dict[str, Item] = {
+    'a': None,
+    'b': {'x': 1},
+    'c': {'x': 2.5, 'y': 'c'},
+    'd': {'y': 'd', 'z': [1, 2]},
+  }
+
+  def _map_fn(item: Item) -> Item:
+    return outputs[item['text']]
+
+  dataset.map(_map_fn, output_column='out')
+
+  rows = list(dataset.select_rows(['text', 'out']))
+  assert rows == [
+    {'text': 'a', 'out': None},
+    {'text': 'b', 'out': {'x': 1.0, 'y': None, 'z': None}},
+    {'text': 'c', 'out': {'x': 2.5, 'y': 'c', 'z': None}},
+    {'text': 'd', 'out': {'x': None, 'y': 'd', 'z': [1, 2]}},
+  ]
+
+
+def test_map_output_types_mixed_in_one_cache_flush(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'x': x} for x in range(4)])
+
+  def _map_fn(x: int) -> Item:
+    return x if x % 2 else str(x)
+
+  def _struct_map_fn(item: Item) -> Item:
+    return {'a': 1} if item['x'] % 2 else {'a': 'x'}
+
+  dataset.map(_map_fn, input_path='x', output_column='mixed')
+  dataset.map(_struct_map_fn, output_column='mixed_struct')
+
+  # Values of mixed types are JSON-encoded.
+  rows = list(dataset.select_rows(['mixed', 'mixed_struct']))
+  assert rows == [
+    {'mixed': '"0"', 'mixed_struct': {'a': '"x"'}},
+    {'mixed': '1', 'mixed_struct': {'a': '1'}},
+    {'mixed': '"2"', 'mixed_struct': {'a': '"x"'}},
+    {'mixed': '3', 'mixed_struct': {'a': '1'}},
+  ]
+
+
+def test_map_output_types_mixed_between_cache_flushes(
+  make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  mocker.patch.object(dataset_duckdb_module, 'SHARD_CACHE_FLUSH_ROWS', 2)
+  dataset = make_test_data([{'x': x} for x in range(4)])
+
+  def _map_fn(x: int) -> Item:
+    return x if x < 2 else str(x)
+
+  dataset.map(_map_fn, input_path='x', output_column='mixed')
+
+  rows = list(dataset.select_rows(['mixed']))
+  assert rows == [{'mixed': '0'}, {'mixed': '1'}, {'mixed': '"2"'}, {'mixed': '"3"'}]
+
+
+def test_map_error_is_raised_when_outputs_cant_be_cached(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'text': letter} for letter in 'ab'])
+
+  def _map_fn(item: Item) -> Item:
+    if item['text'] == 'b':
+      raise ValueError('Failed on b.')
+    # An output that can't be stored in parquet.
+    return object()
+
+  with pytest.raises(ValueError, match='Failed on b.'):
+    dataset.map(_map_fn, output_column='out')
+
+
+def _map_parquet_files(dataset: Dataset, output_column: str) -> list[str]:
+  dataset_path = get_dataset_output_dir(dataset.project_dir, TEST_NAMESPACE, TEST_DATASET_NAME)
+  return sorted(
+    filename
+    for filename in os.listdir(dataset_path)
+    if filename.startswith(f'{output_column}-') and filename.endswith('.parquet')
+  )
+
+
+@pytest.mark.parametrize('execution_type', TEST_EXECUTION_TYPES)
+def test_map_output_files_are_size_bounded(
+  execution_type: tasks.TaskExecutionType, make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  # Close each output file after its first row group of 2 rows.
+  mocker.patch.object(dataset_duckdb_module, 'RESHARD_FILE_MAX_BYTES', 1)
+  mocker.patch.object(dataset_duckdb_module, 'RESHARD_ROW_GROUP_ROWS', 2)
+  dataset = make_test_data([{'text': letter} for letter in 'abcde'])
+
+  def _map_fn(item: Item) -> Item:
+    return item['text'].upper()
+
+  dataset.map(_map_fn, output_column='upper', num_jobs=2, execution_type=execution_type)
+
+  dataset_path = get_dataset_output_dir(dataset.project_dir, TEST_NAMESPACE, TEST_DATASET_NAME)
+  filenames = _map_parquet_files(dataset, 'upper')
+  assert filenames == [
+    'upper-00000-of-00003.parquet',
+    'upper-00001-of-00003.parquet',
+    'upper-00002-of-00003.parquet',
+  ]
+  # The files have whole row groups, in the order of the rows.
+  assert [
+    [row['upper'] for row in pq.read_table(os.path.join(dataset_path, filename)).to_pylist()]
+    for filename in filenames
+  ] == [['A', 'B'], ['C', 'D'], ['E']]
+
+  rows = list(dataset.select_rows(['text', 'upper']))
+  assert rows == [{'text': letter, 'upper': letter.upper()} for letter in 'abcde']
+
+  # Overwriting with fewer files deletes the previous files.
+  mocker.patch.object(dataset_duckdb_module, 'RESHARD_ROW_GROUP_ROWS', 5)
+  dataset.map(_map_fn, output_column='upper', overwrite=True, execution_type=execution_type)
+
+  assert _map_parquet_files(dataset, 'upper') == ['upper-00000-of-00001.parquet']
+  rows = list(dataset.select_rows(['text', 'upper']))
+  assert rows == [{'text': letter, 'upper': letter.upper()} for letter in 'abcde']
+
+
+def test_map_output_types_change_between_output_files(
+  make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  # Write every output to its own cache fragment and output file.
+  mocker.patch.object(dataset_duckdb_module, 'SHARD_CACHE_FLUSH_ROWS', 1)
+  mocker.patch.object(dataset_duckdb_module, 'RESHARD_FILE_MAX_BYTES', 1)
+  mocker.patch.object(dataset_duckdb_module, 'RESHARD_ROW_GROUP_ROWS', 1)
+  dataset = make_test_data([{'text': letter} for letter in 'abc'])
+  outputs: dict[str, Item] = {'a': {'x': 1}, 'b': {'x': 2.5}, 'c': {'y': 'c'}}
+
+  def _map_fn(item: Item) -> Item:
+    return outputs[item['text']]
+
+  dataset.map(_map_fn, output_column='out')
+
+  # The files written before the types changed are rewritten with the final types.
+  assert len(_map_parquet_files(dataset, 'out')) == 3
+  rows = list(dataset.select_rows(['text', 'out']))
+  assert rows == [
+    {'text': 'a', 'out': {'x': 1.0, 'y': None}},
+    {'text': 'b', 'out': {'x': 2.5, 'y': None}},
+    {'text': 'c', 'out': {'x': None, 'y': 'c'}},
+  ]
+
+
+def test_map_failed_shard_writes_no_output_files(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'text': letter} for letter in 'abcd'])
+
+  def _map_fn(item: Item) -> Item:
+    if item['text'] == 'd':
+      raise ValueError('Failed on d.')
+    return item['text'].upper()
+
+  with pytest.raises(ValueError, match='Failed on d.'):
+    dataset.map(_map_fn, output_column='upper', num_jobs=2)
+
+  # The output of the first shard was written while the second computed, and then removed.
+  dataset_path = get_dataset_output_dir(dataset.project_dir, TEST_NAMESPACE, TEST_DATASET_NAME)
+  assert not [filename for filename in os.listdir(dataset_path) if filename.startswith('upper')]
+
+
+@pytest.mark.parametrize('num_jobs', [1, 3])
+def test_map_process_pool(num_jobs: int, make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'text': letter} for letter in 'abcdef'])
+  prefix = 'upper'
+
+  def _map_fn(item: Item, job_id: int) -> Item:
+    # The closure is sent to each worker process along with the shard of the job.
+    return {prefix: item['text'].upper(), 'job_id': job_id, 'pid': os.getpid()}
+
+  dataset.map(_map_fn, output_column='out', num_jobs=num_jobs, execution_type='process_pool')
+
+  rows = list(dataset.select_rows(['text', 'out']))
+  assert [(row['text'], row['out']['upper'], row['out']['job_id']) for row in rows] == [
+    (letter, letter.upper(), i * num_jobs // 6) for i, letter in enumerate('abcdef')
+  ]
+  # Each job runs in its own process.
+  pids = {row['out']['job_id']: row['out']['pid'] for row in rows}
+  assert os.getpid() not in pids.values()
+  assert len(set(pids.values())) == num_jobs
+
+
+def test_map_process_pool_reports_progress(
+  make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  dataset = make_test_data([{'text': letter} for letter in 'abcdef'])
+  execute_sharded = mocker.spy(tasks.get_task_manager(), 'execute_sharded')
+
+  dataset.map(lambda item: item['text'].upper(), num_jobs=2, execution_type='process_pool')
+
+  # The workers send their progress to this process, where the progress of both shards is kept.
+  [step] = tasks.get_worker_steps(execute_sharded.call_args.args[0])
+  assert step.progress == 1.0
+  assert sorted(step.shard_progresses) == [(0, (3, 3)), (1, (3, 3))]
+
+
+def test_map_process_pool_error_resumes(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'text': letter} for letter in 'abcd'])
+
+  def _map_fn(item: Item) -> Item:
+    if item['text'] == 'c' and not os.path.exists(marker_path):
+      raise ValueError('Failed on c.')
+    return item['text'].upper()
+
+  marker_path = os.path.join(dataset.project_dir, 'marker')
+  with pytest.raises(ValueError, match='Failed on c.'):
+    dataset.map(_map_fn, output_column='text_upper', execution_type='process_pool')
+  assert not dataset.manifest().data_schema.has_field(('text_upper',))
+
+  open(marker_path, 'w').close()
+  dataset.map(_map_fn, output_column='text_upper', execution_type='process_pool')
+
+  rows = list(dataset.select_rows(['text_upper']))
+  assert rows == [{'text_upper': letter} for letter in 'ABCD']
+
+
 @pytest.mark.parametrize('num_jobs', [-1, 1, 2])
 @pytest.mark.parametrize('execution_type', TEST_EXECUTION_TYPES)
 @pytest.mark.parametrize('batch_size', [-1, 2, 3])
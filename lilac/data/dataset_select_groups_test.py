@@ -1,14 +1,18 @@
 """Tests for dataset.select_groups()."""
 
 import re
+import threading
 from datetime import datetime
+from typing import cast
 
 import pytest
 from pytest_mock import MockerFixture
 
 from ..schema import Field, Item, MapType, field, schema
 from . import dataset as dataset_module
-from .dataset import GroupsSortBy, SelectGroupsResult, SortOrder
+from . import dataset_duckdb as dataset_duckdb_module
+from .dataset import CountResult, FilterLike, GroupsSortBy, SelectGroupsResult, SortOrder
+from .dataset_duckdb import DatasetDuckDB
 from .dataset_test_utils import TestDataMaker
 
 
@@ -290,3 +294,131 @@ def test_map_dtype(make_test_data: TestDataMaker) -> None:
   )
   with pytest.raises(ValueError, match='Cannot compute groups on a map field'):
     dataset.select_groups('column')
+
+
+def test_auto_bins_match_bin_lookup(make_test_data: TestDataMaker) -> None:
+  # Values on and around the bin boundaries of 15 uniform bins between 0 and 1.5.
+  items: list[Item] = [{'feature': i / 10} for i in range(16)]
+  items += [{'feature': i / 10 + 1e-9} for i in range(15)] + [{}]
+  dataset = make_test_data(items)
+
+  auto_result = dataset.select_groups('feature', sort_by=GroupsSortBy.VALUE)
+  assert auto_result.bins
+  # Explicit bins are looked up by their bounds.
+  lookup_result = dataset.select_groups(
+    'feature', sort_by=GroupsSortBy.VALUE, bins=auto_result.bins
+  )
+  assert auto_result == lookup_result
+
+
+def test_select_groups_many(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  items: list[Item] = [
+    {'name': 'Name1', 'age': 34, 'active': False, 'tags': ['a', 'b']},
+    {'name': 'Name2', 'age': 45, 'active': True, 'tags': ['a']},
+    {'age': 17, 'active': True, 'tags': []},
+    {'name': 'Name3', 'active': True},
+    {'name': 'Name4', 'age': 55, 'tags': ['c', 'a']},
+  ]
+  dataset = make_test_data(items)
+  leaf_paths = ['name', 'age', 'active', 'tags.*']
+
+  results = dataset.select_groups_many(leaf_paths)
+  assert results == [dataset.select_groups(leaf_path) for leaf_path in leaf_paths]
+
+  filters: list[FilterLike] = [('active', 'equals', True)]
+  results = dataset.select_groups_many(leaf_paths, filters=filters, limit=2)
+  assert results == [
+    dataset.select_groups(leaf_path, filters=filters, limit=2) for leaf_path in leaf_paths
+  ]
+
+  results = dataset.select_groups_many(
+    leaf_paths, sort_by=GroupsSortBy.VALUE, sort_order=SortOrder.ASC
+  )
+  assert results == [
+    dataset.select_groups(leaf_path, sort_by=GroupsSortBy.VALUE, sort_order=SortOrder.ASC)
+    for leaf_path in leaf_paths
+  ]
+
+  # The results are cached per filter set.
+  expected = dataset.select_groups_many(leaf_paths, filters=filters, limit=2)
+  query_spy = mocker.spy(dataset, '_query')
+  assert dataset.select_groups_many(leaf_paths, filters=filters, limit=2) == expected
+  query_spy.assert_not_called()
+
+
+def test_approximate(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  items: list[Item] = [{'active': i % 4 == 0, 'age': i % 50} for i in range(400)]
+  dataset = cast(DatasetDuckDB, make_test_data(items))
+
+  # Small datasets are always queried exactly.
+  assert dataset.select_groups('active', approximate=True) == dataset.select_groups('active')
+  assert dataset.count(approximate=True) == CountResult(count=400)
+
+  mocker.patch(f'{dataset_duckdb_module.__name__}.APPROXIMATE_MIN_ROWS', 0)
+  mocker.patch(f'{dataset_duckdb_module.__name__}.APPROXIMATE_SAMPLE_PERCENT', 50)
+  # Block the background refinement, to see the approximate results.
+  release_refinements = threading.Event()
+  dataset._refinement_executor.submit(release_refinements.wait)
+
+  result = dataset.select_groups('active', approximate=True)
+  assert result.is_approximate
+  assert result.count_errors
+  for (value, count), error in zip(result.counts, result.count_errors):
+    exact_count = 100 if value else 300
+    assert abs(count - exact_count) <= error
+  [many_result] = dataset.select_groups_many(['active'], approximate=True)
+  assert many_result == result
+
+  count_result = dataset.count(filters=[('active', 'equals', True)], approximate=True)
+  assert count_result.is_approximate
+  assert abs(count_result.count - 100) <= cast(int, count_result.count_error)
+
+  # The sample is persisted, so another instance of the dataset makes the same estimates.
+  other_dataset = DatasetDuckDB(
+    dataset.namespace, dataset.dataset_name, project_dir=dataset.project_dir
+  )
+  other_dataset._refinement_executor.submit(release_refinements.wait)
+  assert other_dataset.select_groups('active', approximate=True) == result
+
+  # Once refined in the background, the exact results are returned.
+  release_refinements.set()
+  for future in list(dataset._refinements.values()):
+    future.result()
+  assert dataset.select_groups('active', approximate=True) == dataset.select_groups('active')
+  assert dataset.select_groups_many(['active'], approximate=True) == [
+    dataset.select_groups('active')
+  ]
+  assert dataset.count(filters=[('active', 'equals', True)], approximate=True) == CountResult(
+    count=100
+  )
+
+
+def test_approximate_refinements_per_include_deleted(
+  make_test_data: TestDataMaker, mocker: MockerFixture
+) -> None:
+  dataset = cast(DatasetDuckDB, make_test_data([{'active': i % 4 == 0} for i in range(40)]))
+  mocker.patch(f'{dataset_duckdb_module.__name__}.APPROXIMATE_MIN_ROWS', 0)
+  release_refinements = threading.Event()
+  dataset._refinement_executor.submit(release_refinements.wait)
+
+  dataset.select_groups('active', approximate=True)
+  dataset.select_groups('active', approximate=True, include_deleted=True)
+
+  # Each is refined on its own, so one never answers with the exact result of the other.
+  assert len(dataset._refinements) == 2
+  release_refinements.set()
+
+
+def test_approximate_failed_refinement_is_retried(make_test_data: TestDataMaker) -> None:
+  dataset = cast(DatasetDuckDB, make_test_data([{'active': True}]))
+
+  def _fail() -> int:
+    raise ValueError('Failed to refine.')
+
+  assert dataset._refined('key', _fail) is None
+  with pytest.raises(ValueError):
+    dataset._refinements['key'].result()
+
+  assert dataset._refined('key', lambda: 42) is None
+  dataset._refinements['key'].result()
+  assert dataset._refined('key', lambda: 0) == 42
@@ -1,6 +1,7 @@
 """Tests for dataset.select_rows(sort_by=...)."""
 
-from typing import ClassVar, Iterable, Optional, Sequence, cast
+from datetime import datetime
+from typing import Any, ClassVar, Iterable, Optional, Sequence, cast
 
 import numpy as np
 import pytest
@@ -17,6 +18,7 @@ from ..schema import (
   VectorKey,
   field,
   lilac_embedding,
+  schema,
   span,
 )
 from ..signal import (
@@ -26,7 +28,7 @@ from ..signal import (
   clear_signal_registry,
   register_signal,
 )
-from .dataset import Column, SortOrder
+from .dataset import Column, Dataset, SortOrder
 from .dataset_test_utils import TestDataMaker, enriched_item
 
 
@@ -576,3 +578,113 @@ def test_sort_by_topk_udf_with_filter(make_test_data: TestDataMaker) -> None:
       ),
     },
   ]
+
+
+def _select_all_pages(dataset: Dataset, limit: int, **kwargs: Any) -> list[list[Item]]:
+  pages: list[list[Item]] = []
+  cursor: Optional[str] = None
+  while True:
+    result = dataset.select_rows(limit=limit, cursor=cursor, **kwargs)
+    pages.append(list(result))
+    cursor = result.next_cursor
+    if cursor is None:
+      return pages
+
+
+@pytest.mark.parametrize('sort_order', [SortOrder.ASC, SortOrder.DESC])
+def test_sort_with_cursor(make_test_data: TestDataMaker, sort_order: SortOrder) -> None:
+  dataset = make_test_data(
+    [
+      {'score': 3.5, 'title': 'a'},
+      {'score': None, 'title': 'b'},
+      {'score': 1.0, 'title': 'a'},
+      {'score': 3.5, 'title': 'c'},
+      {'score': 3.5, 'title': 'a'},
+      {'score': None, 'title': None},
+      {'score': 2.0, 'title': 'b'},
+    ],
+    schema({'score': 'float32', 'title': 'string'}),
+  )
+  for sort_by in [['score'], ['title'], ['score', 'title'], ['title', 'score']]:
+    all_rows = list(
+      dataset.select_rows(columns=[ROWID], sort_by=sort_by, sort_order=sort_order, limit=100)
+    )
+    assert len(all_rows) == 7
+    for limit in [1, 2, 3, 7]:
+      pages = _select_all_pages(
+        dataset, limit, columns=[ROWID], sort_by=sort_by, sort_order=sort_order
+      )
+      assert all(len(page) == limit for page in pages[:-1])
+      assert [row for page in pages for row in page] == all_rows
+
+
+@pytest.mark.parametrize('sort_order', [SortOrder.ASC, SortOrder.DESC])
+def test_sort_with_cursor_nan(make_test_data: TestDataMaker, sort_order: SortOrder) -> None:
+  dataset = make_test_data(
+    [
+      {'score': 1.0},
+      {'score': float('nan')},
+      {'score': 2.0},
+      {'score': float('nan')},
+      {'score': None},
+      {'score': 3.0},
+    ],
+    schema({'score': 'float32'}),
+  )
+  all_rows = list(
+    dataset.select_rows(columns=[ROWID], sort_by=['score'], sort_order=sort_order, limit=100)
+  )
+  pages = _select_all_pages(dataset, 1, columns=[ROWID], sort_by=['score'], sort_order=sort_order)
+  assert [row for page in pages for row in page] == all_rows
+
+
+def test_sort_with_cursor_and_filter(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data(
+    [
+      {'active': True, 'date': datetime(2023, 1, 2)},
+      {'active': False, 'date': datetime(2023, 1, 1)},
+      {'active': True, 'date': datetime(2023, 1, 1)},
+      {'active': True, 'date': None},
+      {'active': True, 'date': datetime(2023, 1, 3)},
+    ],
+    schema({'active': 'boolean', 'date': 'timestamp'}),
+  )
+  result = dataset.select_rows(
+    columns=[ROWID], filters=[('active', 'equals', True)], sort_by=['date'], limit=2
+  )
+  assert list(result) == [{ROWID: '5'}, {ROWID: '1'}]
+  assert result.total_num_rows == 4
+
+  result = dataset.select_rows(
+    columns=[ROWID],
+    filters=[('active', 'equals', True)],
+    sort_by=['date'],
+    limit=2,
+    cursor=result.next_cursor,
+  )
+  assert list(result) == [{ROWID: '3'}, {ROWID: '4'}]
+  # The total number of rows doesn't depend on the page.
+  assert result.total_num_rows == 4
+
+  result = dataset.select_rows(
+    columns=[ROWID],
+    filters=[('active', 'equals', True)],
+    sort_by=['date'],
+    limit=2,
+    cursor=result.next_cursor,
+  )
+  assert list(result) == []
+  assert result.next_cursor is None
+
+
+def test_cursor_requires_sort(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'score': 1}, {'score': 2}, {'score': 3}])
+  result = dataset.select_rows(columns=[ROWID], limit=2)
+  assert result.next_cursor is None
+
+  result = dataset.select_rows(columns=[ROWID], sort_by=['score'], limit=2)
+  assert result.next_cursor is not None
+  with pytest.raises(ValueError, match='`cursor` is only supported'):
+    dataset.select_rows(columns=[ROWID], limit=2, cursor=result.next_cursor)
+  with pytest.raises(ValueError, match='Invalid cursor'):
+    dataset.select_rows(columns=[ROWID], sort_by=['score'], limit=2, cursor='not a cursor')
@@ -9,6 +9,7 @@ from pytest_mock import MockerFixture
 from ..schema import Field, Item, MapType, field, schema
 from . import dataset as dataset_module
 from .dataset import StatsResult
+from .dataset_duckdb import DatasetDuckDB
 from .dataset_test_utils import TestDataMaker
 
 SIMPLE_ITEMS: list[Item] = [
@@ -64,6 +65,32 @@ def test_stats_with_deletions(make_test_data: TestDataMaker) -> None:
   )
 
 
+def test_stats_are_persisted(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  dataset = cast(DatasetDuckDB, make_test_data(SIMPLE_ITEMS))
+  dataset.stats(leaf_path='str')
+  compute_stats_spy = mocker.spy(DatasetDuckDB, '_compute_stats')
+
+  # Another instance of the dataset, e.g. after a restart, reads the persisted stats.
+  other_dataset = DatasetDuckDB(
+    dataset.namespace, dataset.dataset_name, project_dir=dataset.project_dir
+  )
+  assert other_dataset.stats(leaf_path='int') == StatsResult(
+    path=('int',), total_count=3, approx_count_distinct=2, min_val=1, max_val=2
+  )
+  compute_stats_spy.assert_not_called()
+
+  # Adding a column only computes the stats of the new leaf.
+  other_dataset.map(lambda item: len(item['str'] or ''), output_column='str_len')
+  assert other_dataset.stats(leaf_path='str_len') == StatsResult(
+    path=('str_len',), total_count=4, approx_count_distinct=2, min_val=0, max_val=1
+  )
+  assert other_dataset.stats(leaf_path='str') == StatsResult(
+    path=('str',), total_count=3, approx_count_distinct=2, avg_text_length=1
+  )
+  compute_stats_spy.assert_called_once()
+  assert list(compute_stats_spy.call_args.args[1].keys()) == [('str_len',)]
+
+
 def test_nested_stats(make_test_data: TestDataMaker) -> None:
   nested_items: list[Item] = [
     {'name': 'Name1', 'addresses': [{'zips': [5, 8]}]},
@@ -274,6 +274,51 @@ def test_select_rows_next(make_test_data: TestDataMaker) -> None:
   assert _get_rows() == SIMPLE_ITEMS
 
 
+def test_select_rows_arrow(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+
+  result = dataset.select_rows(['str', 'int'], limit=2)
+  table = result.arrow()
+  assert table.column_names == ['str', 'int']
+  assert table.to_pylist() == [{'str': 'a', 'int': 1}, {'str': 'b', 'int': 2}]
+
+  batches = list(result.iter_batches(batch_size=1))
+  assert [batch.to_pylist() for batch in batches] == [
+    [{'str': 'a', 'int': 1}],
+    [{'str': 'b', 'int': 2}],
+  ]
+
+  assert result.df().to_dict('records') == [{'str': 'a', 'int': 1}, {'str': 'b', 'int': 2}]
+
+
+def test_select_rows_batch_size(make_test_data: TestDataMaker) -> None:
+  items: list[Item] = [{'text': f'hello{i}'} for i in range(5)]
+  dataset = make_test_data(items)
+
+  result = dataset.select_rows(['text'], batch_size=2)
+  assert result.total_num_rows == 5
+  batches = list(result.iter_batches())
+  assert [batch.num_rows for batch in batches] == [2, 2, 1]
+  assert [row for batch in batches for row in batch.to_pylist()] == items
+  # A streamed result can only be iterated once.
+  assert list(result) == []
+
+  # Signal UDFs are computed batch by batch.
+  udf_col = Column('text', signal_udf=LengthSignal())
+  result = dataset.select_rows(['text', udf_col], batch_size=2)
+  assert list(result) == [{'text': f'hello{i}', 'text.length_signal': 6} for i in range(5)]
+  result = dataset.select_rows(['text', udf_col], batch_size=2)
+  assert [batch.num_rows for batch in result.iter_batches()] == [2, 2, 1]
+
+  # A stream that is abandoned is closed explicitly.
+  with dataset.select_rows(['text'], batch_size=2) as result:
+    assert next(result) == {'text': 'hello0'}
+
+  # The cursor of the next page is not known until a stream is consumed.
+  with pytest.raises(ValueError, match='`batch_size` is not supported with `limit`'):
+    dataset.select_rows(['text'], sort_by=['text'], limit=2, batch_size=2)
+
+
 def test_merge_values(make_test_data: TestDataMaker) -> None:
   dataset = make_test_data([{'text': 'hello'}, {'text': 'everybody'}])
   test_signal = TestSignal()
@@ -1,5 +1,6 @@
 """Utilities for working with datasets."""
 
+import asyncio
 import gc
 import itertools
 import json
@@ -7,14 +8,16 @@ import math
 import os
 import pprint
 import secrets
+from collections import deque
 from collections.abc import Iterable
-from typing import Callable, Generator, Iterator, Optional, TypeVar, Union, cast
+from typing import Any, Awaitable, Callable, Generator, Iterator, Optional, TypeVar, Union, cast
 
 import numpy as np
 import pyarrow as pa
 
 from ..batch_utils import deep_flatten
 from ..embeddings.vector_store import VectorDBIndex
+from ..embeddings.vector_store_hnsw import HNSWSettings
 from ..env import env
 from ..parquet_writer import ParquetWriter
 from ..schema import (
@@ -36,13 +39,17 @@ from ..schema import (
   schema_to_arrow_schema,
 )
 from ..signal import Signal
-from ..utils import chunks, is_primitive, log, open_file
+from ..utils import is_primitive, log, open_file
 
 # The embedding write chunk sizes keeps the memory pressure lower as we iteratively write to the
 # vector store. Embeddings are float32, taking up 4 bytes, so this results in ~130K * dims of RAM
 # pressure.
 EMBEDDINGS_WRITE_CHUNK_SIZE = 32_768
 
+# Calls of an async map function that raise are retried, waiting twice as long after every attempt.
+ASYNC_MAP_MAX_RETRIES = 3
+ASYNC_MAP_RETRY_BACKOFF_SECONDS = 1.0
+
 
 def _replace_embeddings_with_none(input: Union[Item, Item]) -> Union[Item, Item]:
   if isinstance(input, np.ndarray):
@@ -164,17 +171,42 @@ def _flat_embeddings(
     pass
 
 
+def load_embeddings_checkpoint(
+  vector_store: str, output_dir: str, hnsw_settings: Optional[HNSWSettings] = None
+) -> Optional[VectorDBIndex]:
+  """Load the partial vector index left by an interrupted `write_embeddings_to_disk` call.
+
+  Returns None when there is nothing to resume from.
+  """
+  if not VectorDBIndex.has_segments(output_dir):
+    return None
+  vector_index = VectorDBIndex(vector_store, hnsw_settings)
+  vector_index.load(output_dir)
+  return vector_index
+
+
 def write_embeddings_to_disk(
-  vector_store: str, rowids: Iterable[str], signal_items: Iterable[Item], output_dir: str
+  vector_store: str,
+  rowids: Iterable[str],
+  signal_items: Iterable[Item],
+  output_dir: str,
+  checkpoint: Optional[VectorDBIndex] = None,
+  hnsw_settings: Optional[HNSWSettings] = None,
 ) -> None:
-  """Write a set of embeddings to disk."""
+  """Write a set of embeddings to disk.
+
+  The embeddings are appended to the index on disk in chunks. If the write is interrupted, the
+  chunks written so far can be loaded with `load_embeddings_checkpoint` and passed back as
+  `checkpoint` to continue writing the same index.
+  """
   path_embedding_items = (
     _flat_embeddings(signal_item, path=(signal_item[ROWID],)) for signal_item in signal_items
   )
 
-  def _get_span_vectors() -> Generator:
+  def _get_row_span_vectors() -> Generator:
     nonlocal path_embedding_items
     for path_item in path_embedding_items:
+      row_span_vectors: list[tuple[PathKey, list[tuple[int, int]], list[np.ndarray]]] = []
       for path_key, embedding_items in path_item:
         if not path_key or not embedding_items:
           # Sparse embeddings may not have an embedding for every key.
@@ -190,12 +222,23 @@ def write_embeddings_to_disk(
           embedding_vectors.append(vector.reshape(-1))
           spans.append((text_span[TEXT_SPAN_START_FEATURE], text_span[TEXT_SPAN_END_FEATURE]))
 
-        yield (path_key, spans, embedding_vectors)
-
-  span_vectors = _get_span_vectors()
-
-  vector_index = VectorDBIndex(vector_store)
-  for span_vectors_chunk in chunks(span_vectors, EMBEDDINGS_WRITE_CHUNK_SIZE):
+        row_span_vectors.append((path_key, spans, embedding_vectors))
+      yield row_span_vectors
+
+  def _get_span_vectors_chunks() -> Generator:
+    # Chunks always hold whole rows, so a checkpoint never has a partially embedded row.
+    span_vectors_chunk: list[tuple[PathKey, list[tuple[int, int]], list[np.ndarray]]] = []
+    for row_span_vectors in _get_row_span_vectors():
+      span_vectors_chunk.extend(row_span_vectors)
+      if len(span_vectors_chunk) >= EMBEDDINGS_WRITE_CHUNK_SIZE:
+        yield span_vectors_chunk
+        span_vectors_chunk = []
+    if span_vectors_chunk:
+      yield span_vectors_chunk
+
+  vector_index = checkpoint or VectorDBIndex(vector_store, hnsw_settings)
+  wrote_chunks = checkpoint is not None
+  for span_vectors_chunk in _get_span_vectors_chunks():
     chunk_spans: list[tuple[PathKey, list[tuple[int, int]]]] = []
     chunk_embedding_vectors: list[np.ndarray] = []
     for path_key, spans, vectors in span_vectors_chunk:
@@ -205,11 +248,18 @@ def write_embeddings_to_disk(
     embedding_matrix = np.array(chunk_embedding_vectors, dtype=np.float32)
 
     vector_index.add(chunk_spans, embedding_matrix)
-    vector_index.save(output_dir)
+    # Only append the new chunk to disk. Rewriting the whole index after every chunk makes writing
+    # the index quadratic in its size.
+    vector_index.save_segment(output_dir)
+    wrote_chunks = True
 
     del embedding_matrix, chunk_embedding_vectors, chunk_spans
     gc.collect()
 
+  if wrote_chunks:
+    # Compact the segments into a single index, which is faster to load.
+    vector_index.save(output_dir)
+
   del vector_index
   gc.collect()
 
@@ -322,6 +372,49 @@ def sparse_to_dense_compute(
     yield None if input is None else next(dense_output)
 
 
+def async_map_ordered(
+  func: Callable[..., Awaitable[Tout]], args: Iterable[tuple[Any, ...]], max_concurrency: int
+) -> Iterator[Tout]:
+  """Calls the async `func` on each tuple of args, yielding outputs in the order of the args.
+
+  The calls run on an event loop owned by the iterator, with at most `max_concurrency` of them in
+  flight. A call that raises is retried `ASYNC_MAP_MAX_RETRIES` times with exponential backoff
+  before the error is raised.
+  """
+  if max_concurrency < 1:
+    raise ValueError(f'`max_concurrency` must be at least 1, got {max_concurrency}.')
+
+  async def _call_with_retries(call_args: tuple[Any, ...]) -> Tout:
+    attempt = 0
+    while True:
+      try:
+        return await func(*call_args)
+      except Exception as e:
+        if attempt >= ASYNC_MAP_MAX_RETRIES:
+          raise e
+        backoff = ASYNC_MAP_RETRY_BACKOFF_SECONDS * 2**attempt
+        log(f'Retrying {func.__name__} in {backoff:.1f}s after: {e!r}')
+        await asyncio.sleep(backoff)
+        attempt += 1
+
+  loop = asyncio.new_event_loop()
+  in_flight: deque[asyncio.Task[Tout]] = deque()
+  try:
+    for call_args in args:
+      in_flight.append(loop.create_task(_call_with_retries(call_args)))
+      if len(in_flight) >= max_concurrency:
+        # The other calls in flight make progress while the loop waits for the oldest one.
+        yield loop.run_until_complete(in_flight.popleft())
+    while in_flight:
+      yield loop.run_until_complete(in_flight.popleft())
+  finally:
+    if in_flight:
+      for task in in_flight:
+        task.cancel()
+      loop.run_until_complete(asyncio.wait(in_flight))
+    loop.close()
+
+
 def shard_id_to_range(
   shard_id: Optional[int], shard_count: Optional[int], num_items: int
 ) -> tuple[int, int]:
@@ -1,10 +1,16 @@
 """Tests for dataset utils."""
 
+import asyncio
 from typing import Iterable, Iterator
 
 from ..schema import PathTuple
 from ..utils import chunks
-from .dataset_utils import count_primitives, sparse_to_dense_compute, wrap_in_dicts
+from .dataset_utils import (
+  async_map_ordered,
+  count_primitives,
+  sparse_to_dense_compute,
+  wrap_in_dicts,
+)
 
 
 def test_count_nested() -> None:
@@ -89,3 +95,21 @@ def test_sparse_to_dense_compute_empty() -> None:
 
   out = sparse_to_dense_compute(sparse_input, func)
   assert list(out) == []
+
+
+def test_async_map_ordered() -> None:
+  in_flight = 0
+  max_in_flight = 0
+
+  async def func(x: int) -> int:
+    nonlocal in_flight, max_in_flight
+    in_flight += 1
+    max_in_flight = max(max_in_flight, in_flight)
+    # Later inputs finish first.
+    await asyncio.sleep(0.01 * (10 - x))
+    in_flight -= 1
+    return x * 2
+
+  out = async_map_ordered(func, ((x,) for x in range(10)), max_concurrency=3)
+  assert list(out) == [x * 2 for x in range(10)]
+  assert max_in_flight == 3
@@ -1,10 +1,14 @@
 """Registers all vector stores."""
 from .vector_store import register_vector_store
 from .vector_store_hnsw import HNSWVectorStore
+from .vector_store_ivf import IVFVectorStore
 from .vector_store_numpy import NumpyVectorStore
+from .vector_store_quantized import QuantizedVectorStore
 
 
 def register_default_vector_stores() -> None:
   """Register all the default vector stores."""
   register_vector_store(HNSWVectorStore)
+  register_vector_store(IVFVectorStore)
   register_vector_store(NumpyVectorStore)
+  register_vector_store(QuantizedVectorStore)
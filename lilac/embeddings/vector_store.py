@@ -1,14 +1,22 @@
 """Interface for storing vectors."""
 
 import abc
+import math
 import os
 import pickle
-from typing import Iterable, Optional, Sequence, Type, cast
+import shutil
+from typing import TYPE_CHECKING, Iterable, Literal, Optional, Sequence, Type, cast
 
 import numpy as np
+import pandas as pd
+from pydantic import BaseModel
 
+from ..env import env
 from ..schema import SpanVector, VectorKey
-from ..utils import open_file
+from ..utils import delete_file, file_exists, log, open_file
+
+if TYPE_CHECKING:
+  from .vector_store_hnsw import HNSWSettings
 
 
 class VectorStore(abc.ABC):
@@ -57,7 +65,11 @@ class VectorStore(abc.ABC):
     pass
 
   def topk(
-    self, query: np.ndarray, k: int, keys: Optional[Iterable[VectorKey]] = None
+    self,
+    query: np.ndarray,
+    k: int,
+    keys: Optional[Iterable[VectorKey]] = None,
+    ef: Optional[int] = None,
   ) -> list[tuple[VectorKey, float]]:
     """Return the top k most similar vectors.
 
@@ -65,16 +77,131 @@ class VectorStore(abc.ABC):
       query: The query vector.
       k: The number of results to return.
       keys: Optional keys to restrict the search to.
+      ef: The size of the candidate list of approximate stores, like HNSW. Exact stores ignore it.
 
     Returns:
       A list of (key, score) tuples.
     """
     raise NotImplementedError
 
+  def get_positions(self, positions: np.ndarray) -> np.ndarray:
+    """Return the embeddings at the given positions.
+
+    The position of a vector is the order in which it was added to the store. Stores that don't
+    implement this are read with `get()` instead.
+
+    Args:
+      positions: The positions to return the embeddings for.
+
+    Returns:
+      The embeddings at the given positions.
+    """
+    raise NotImplementedError
+
+  def topk_positions(
+    self,
+    query: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Return the top k most similar vectors, addressed by position instead of by key.
+
+    The position of a vector is the order in which it was added to the store. This lets callers
+    restrict the search with an integer array, without building keys. Stores that don't implement
+    this are searched with `topk()` instead.
+
+    Args:
+      query: The query vector.
+      k: The number of results to return.
+      positions: Optional positions to restrict the search to.
+      ef: The size of the candidate list of approximate stores, like HNSW. Exact stores ignore it.
+
+    Returns:
+      A tuple of (positions, scores) arrays, sorted by descending score.
+    """
+    raise NotImplementedError
+
+  def topk_batch(
+    self,
+    queries: np.ndarray,
+    k: int,
+    keys: Optional[Iterable[VectorKey]] = None,
+    ef: Optional[int] = None,
+  ) -> list[list[tuple[VectorKey, float]]]:
+    """Return the top k most similar vectors for each of several queries.
+
+    The default implementation calls `topk()` once per query. Stores that can score many queries
+    at once should override this.
+
+    Args:
+      queries: The query vectors, as a (num queries, dim) matrix.
+      k: The number of results to return per query.
+      keys: Optional keys to restrict the search to.
+      ef: The size of the candidate list of approximate stores, like HNSW. Exact stores ignore it.
+
+    Returns:
+      A list with a list of (key, score) tuples for each query.
+    """
+    keys = list(keys) if keys is not None else None
+    return [self.topk(query, k, keys, ef) for query in queries]
+
+  def topk_positions_batch(
+    self,
+    queries: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Return the top k most similar vectors for each of several queries, addressed by position.
+
+    The default implementation calls `topk_positions()` once per query. Stores that can score many
+    queries at once should override this.
+
+    Args:
+      queries: The query vectors, as a (num queries, dim) matrix.
+      k: The number of results to return per query.
+      positions: Optional positions to restrict the search to.
+      ef: The size of the candidate list of approximate stores, like HNSW. Exact stores ignore it.
+
+    Returns:
+      A list with a tuple of (positions, scores) arrays for each query, sorted by descending score.
+    """
+    return [self.topk_positions(query, k, positions, ef) for query in queries]
+
 
 PathKey = VectorKey
 
+# Older indices stored the spans as a pickled list of (path key, spans) tuples. We still read it for
+# backwards compatibility, and migrate it to the span arrays on load.
 _SPANS_PICKLE_NAME = 'spans.pkl'
+_SPANS_PREFIX = 'spans'
+# The files of a span table, see `_SpanTable`.
+_SPAN_TABLE_SUFFIXES = ('.rowids.npy', '.path_keys.npy', '.offsets.npy', '.npy')
+_SEGMENTS_DIRNAME = 'segments'
+_SEGMENTS_MANIFEST_FILENAME = 'manifest.json'
+_SEGMENT_EMBEDDINGS_SUFFIX = '.matrix.npy'
+
+# A columnar table of the spans of a list of path keys, as a tuple of arrays:
+#   rowids: The unique rowids of the path keys, utf-8 encoded.
+#   path keys: An int32 (num path keys, key length) matrix. The first column is the index of the
+#     rowid in `rowids`, the rest are the other parts of the path key.
+#   offsets: An int64 array of length num path keys + 1. The spans of the i-th path key are
+#     `spans[offsets[i]:offsets[i + 1]]`.
+#   spans: An int32 (num spans, 2) matrix of (start, end) spans.
+# Spans are in the order their vectors were added to the vector store, so the row of a span is the
+# position of its vector in the store.
+_SpanTable = tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+class VectorDBSegmentsManifest(BaseModel):
+  """Describes the segments of a vector index that have not yet been compacted."""
+
+  # The number of vectors in the compacted index the segments were appended to. None when the
+  # segments were not appended to a compacted index.
+  base_size: Optional[int] = None
+  # The names of the segments, in the order they were written.
+  segments: list[str] = []
 
 
 class VectorDBIndex:
@@ -82,32 +209,150 @@ class VectorDBIndex:
 
   This wraps a regular vector store by adding a mapping from path keys, such as (rowid1, 0),
   to span keys, such as (rowid1, 0, 0), which denotes the first span in the (rowid1, 0) document.
+
+  The spans are kept in flat numpy arrays with interned rowids (see `_SpanTable`), rather than as
+  Python objects, so large indices stay compact in memory and load without unpickling. Keys are
+  resolved to array rows with a sorted rowid array and a pandas index over the integer path keys.
+
+  On disk, an index is a compacted index written by `save()`, followed by any number of append-only
+  segments written by `save_segment()`. Each segment holds only the spans and embeddings added since
+  the previous save, so writing a large index in chunks does linear I/O.
   """
 
-  def __init__(self, vector_store: str) -> None:
-    self._vector_store: VectorStore = get_vector_store_cls(vector_store)()
-    # Map a path key to spans for that path.
-    self._id_to_spans: dict[PathKey, list[tuple[int, int]]] = {}
-    self._rowid_to_path_keys: dict[str, list[PathKey]] = {}
+  def __init__(self, vector_store: str, hnsw_settings: Optional['HNSWSettings'] = None) -> None:
+    """Initialize the index.
+
+    Args:
+      vector_store: The name of the vector store.
+      hnsw_settings: The settings of the HNSW index, when the vector store is 'hnsw'.
+    """
+    self._vector_store: VectorStore
+    if hnsw_settings is not None:
+      from .vector_store_hnsw import HNSWVectorStore
+
+      if vector_store != HNSWVectorStore.name:
+        raise ValueError(f'HNSW settings are not supported by vector store "{vector_store}".')
+      self._vector_store = HNSWVectorStore(hnsw_settings)
+    else:
+      self._vector_store = get_vector_store_cls(vector_store)()
+    # The span tables added to the index, in order. They are merged lazily by `_get_span_table()`.
+    self._span_tables: list[_SpanTable] = []
+
+    # The segments written by `save_segment()` since the last compaction.
+    self._segments_manifest = VectorDBSegmentsManifest()
+    # Spans and embeddings added since the last save, which are not yet on disk.
+    self._unsaved_span_tables: list[_SpanTable] = []
+    self._unsaved_embeddings: list[np.ndarray] = []
+
+    # Lookups over the merged span table, built lazily.
+    # The rowids sorted, and their order, to find rowids with `np.searchsorted`.
+    self._sorted_rowids: Optional[np.ndarray] = None
+    self._sorted_rowid_order: Optional[np.ndarray] = None
+    # Maps an integer path key, with the rowid replaced by its index, to the row of the path key.
+    self._path_key_index: Optional[pd.Index] = None
+    # For each span, the index of its rowid and of its path key.
+    self._span_rowid_indices: Optional[np.ndarray] = None
+    self._span_path_indices: Optional[np.ndarray] = None
 
   def load(self, base_path: str) -> None:
     """Load the vector index from disk."""
-    assert not self._id_to_spans, 'Cannot load into a non-empty index.'
-    with open_file(os.path.join(base_path, _SPANS_PICKLE_NAME), 'rb') as f:
-      all_spans: list[tuple[PathKey, list[tuple[int, int]]]] = pickle.load(f)
-      self._id_to_spans.update(all_spans)
-      for path_key, _ in all_spans:
-        rowid = cast(str, path_key[0])
-        self._rowid_to_path_keys.setdefault(rowid, []).append(path_key)
-    self._vector_store.load(os.path.join(base_path, self._vector_store.name))
+    assert not self._span_tables, 'Cannot load into a non-empty index.'
+    segments_dir = os.path.join(base_path, _SEGMENTS_DIRNAME)
+    segments_manifest: Optional[VectorDBSegmentsManifest] = None
+    if self.has_segments(base_path):
+      with open_file(os.path.join(segments_dir, _SEGMENTS_MANIFEST_FILENAME)) as f:
+        segments_manifest = VectorDBSegmentsManifest.model_validate_json(f.read())
+
+    if segments_manifest is None or segments_manifest.base_size is not None:
+      self._add_span_table(_load_base_span_table(base_path))
+      self._vector_store.load(os.path.join(base_path, self._vector_store.name))
+
+    if segments_manifest is None:
+      return
+
+    if (
+      segments_manifest.base_size is not None
+      and segments_manifest.base_size != self._vector_store.size()
+    ):
+      # The compacted index was rewritten after these segments were appended, which means a
+      # compaction was interrupted before it deleted the segments. The compacted index already
+      # contains everything in the segments.
+      return
+
+    for segment in segments_manifest.segments:
+      segment_span_table = _load_span_table(
+        os.path.join(segments_dir, f'{segment}.{_SPANS_PREFIX}')
+      )
+      with open_file(os.path.join(segments_dir, segment + _SEGMENT_EMBEDDINGS_SUFFIX), 'rb') as f:
+        segment_embeddings = np.load(f, allow_pickle=False)
+      self._vector_store.add(_get_vector_keys(segment_span_table), segment_embeddings)
+      self._add_span_table(segment_span_table)
+    self._segments_manifest = segments_manifest
+    self._unsaved_span_tables = []
+    self._unsaved_embeddings = []
 
   def save(self, base_path: str) -> None:
-    """Save the vector index to disk."""
-    assert self._id_to_spans, 'Cannot save an empty index.'
-    with open_file(os.path.join(base_path, _SPANS_PICKLE_NAME), 'wb') as f:
-      pickle.dump(list(self._id_to_spans.items()), f)
+    """Save the vector index to disk.
+
+    This writes the entire index and compacts any segments previously written to `base_path`.
+    """
+    span_table = self._get_span_table()
+    assert span_table is not None, 'Cannot save an empty index.'
+    _save_span_table(os.path.join(base_path, _SPANS_PREFIX), span_table)
     self._vector_store.save(os.path.join(base_path, self._vector_store.name))
 
+    # The span table supersedes the spans pickle of older indices.
+    spans_pickle_path = os.path.join(base_path, _SPANS_PICKLE_NAME)
+    if file_exists(spans_pickle_path):
+      delete_file(spans_pickle_path)
+    # The compacted index now contains all the segments.
+    shutil.rmtree(os.path.join(base_path, _SEGMENTS_DIRNAME), ignore_errors=True)
+    self._segments_manifest = VectorDBSegmentsManifest(base_size=self._vector_store.size())
+    self._unsaved_span_tables = []
+    self._unsaved_embeddings = []
+
+  def save_segment(self, base_path: str) -> None:
+    """Append the spans and embeddings added since the last save to disk, as a new segment.
+
+    Unlike `save()`, this only writes the new data. Segments are merged into the index when it's
+    loaded, and compacted by the next call to `save()`.
+    """
+    if not self._unsaved_span_tables:
+      return
+    segments_dir = os.path.join(base_path, _SEGMENTS_DIRNAME)
+    segment = f'{len(self._segments_manifest.segments):05d}'
+    _save_span_table(
+      os.path.join(segments_dir, f'{segment}.{_SPANS_PREFIX}'),
+      _concat_span_tables(self._unsaved_span_tables),
+    )
+    with open_file(os.path.join(segments_dir, segment + _SEGMENT_EMBEDDINGS_SUFFIX), 'wb') as f:
+      np.save(f, np.concatenate(self._unsaved_embeddings), allow_pickle=False)
+
+    self._segments_manifest.segments.append(segment)
+    # Write the manifest last, and atomically, so a crash never leaves a partial segment in it.
+    manifest_path = os.path.join(segments_dir, _SEGMENTS_MANIFEST_FILENAME)
+    with open_file(manifest_path + '.tmp', 'w') as f:
+      f.write(self._segments_manifest.model_dump_json())
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    self._unsaved_span_tables = []
+    self._unsaved_embeddings = []
+
+  @staticmethod
+  def has_segments(base_path: str) -> bool:
+    """Return whether `base_path` has segments that were not compacted by `save()`.
+
+    This is the case when writing the index in chunks was interrupted.
+    """
+    return file_exists(os.path.join(base_path, _SEGMENTS_DIRNAME, _SEGMENTS_MANIFEST_FILENAME))
+
+  def rowids(self) -> list[str]:
+    """Return the rowids of the rows that have spans in the index."""
+    span_table = self._get_span_table()
+    if span_table is None:
+      return []
+    return np.char.decode(span_table[0], 'utf-8').tolist()
+
   def add(
     self, all_spans: Sequence[tuple[PathKey, list[tuple[int, int]]]], embeddings: np.ndarray
   ) -> None:
@@ -122,12 +367,73 @@ class VectorDBIndex:
       embeddings
     ), f'Number of spans ({len(vector_keys)}) and embeddings ({len(embeddings)}) must match.'
 
-    self._id_to_spans.update(all_spans)
-    for path_key, _ in all_spans:
-      rowid = cast(str, path_key[0])
-      self._rowid_to_path_keys.setdefault(rowid, []).append(path_key)
-
+    span_table = _spans_to_span_table(all_spans)
     self._vector_store.add(vector_keys, embeddings)
+    self._add_span_table(span_table)
+
+    self._unsaved_span_tables.append(span_table)
+    self._unsaved_embeddings.append(embeddings)
+
+  def _add_span_table(self, span_table: _SpanTable) -> None:
+    self._span_tables.append(span_table)
+    self._sorted_rowids = None
+    self._sorted_rowid_order = None
+    self._path_key_index = None
+    self._span_rowid_indices = None
+    self._span_path_indices = None
+
+  def _get_span_table(self) -> Optional[_SpanTable]:
+    """Merge the span tables into one, and return it. Returns None when the index is empty."""
+    if not self._span_tables:
+      return None
+    if len(self._span_tables) > 1:
+      self._span_tables = [_concat_span_tables(self._span_tables)]
+    return self._span_tables[0]
+
+  def _get_rowid_indices(self, rowids: np.ndarray) -> np.ndarray:
+    """Return the index of each utf-8 encoded rowid in the span table, or -1 if it is missing."""
+    span_table = self._get_span_table()
+    if span_table is None or len(rowids) == 0:
+      return np.full(len(rowids), -1, dtype=np.int64)
+    if self._sorted_rowids is None or self._sorted_rowid_order is None:
+      sorted_rowid_order: np.ndarray = np.argsort(span_table[0])
+      sorted_rowids: np.ndarray = span_table[0][sorted_rowid_order]
+      self._sorted_rowids, self._sorted_rowid_order = sorted_rowids, sorted_rowid_order
+    locs = np.searchsorted(self._sorted_rowids, rowids)
+    locs = np.minimum(locs, len(self._sorted_rowids) - 1)
+    return np.where(self._sorted_rowids[locs] == rowids, self._sorted_rowid_order[locs], -1)
+
+  def _get_path_indices(self, path_keys: Sequence[PathKey]) -> np.ndarray:
+    """Return the row of each path key in the span table, or -1 if it is missing."""
+    span_table = self._get_span_table()
+    if span_table is None or not path_keys:
+      return np.full(len(path_keys), -1, dtype=np.int64)
+    table_path_keys = span_table[1]
+    query_rowids, query_key_parts = keys_to_arrays(path_keys)
+    if query_key_parts.shape[1] != table_path_keys.shape[1] - 1:
+      return np.full(len(path_keys), -1, dtype=np.int64)
+    query_rowid_indices = self._get_rowid_indices(query_rowids)
+
+    if table_path_keys.shape[1] == 1:
+      if self._path_key_index is None:
+        self._path_key_index = pd.Index(table_path_keys[:, 0])
+      query_index = pd.Index(query_rowid_indices)
+    else:
+      if self._path_key_index is None:
+        self._path_key_index = pd.MultiIndex.from_arrays(list(table_path_keys.T))
+      query_index = pd.MultiIndex.from_arrays([query_rowid_indices, *query_key_parts.T])
+    return self._path_key_index.get_indexer(query_index)
+
+  def _get_span_indices(self) -> tuple[np.ndarray, np.ndarray]:
+    """Return the index of the rowid, and of the path key, of every span."""
+    if self._span_rowid_indices is None or self._span_path_indices is None:
+      span_table = self._get_span_table()
+      assert span_table is not None
+      _, path_keys, offsets, _ = span_table
+      span_path_indices = _get_span_path_indices(offsets)
+      span_rowid_indices: np.ndarray = path_keys[:, 0][span_path_indices]
+      self._span_rowid_indices, self._span_path_indices = span_rowid_indices, span_path_indices
+    return self._span_rowid_indices, self._span_path_indices
 
   def get_vector_store(self) -> VectorStore:
     """Return the underlying vector store."""
@@ -142,23 +448,74 @@ class VectorDBIndex:
     Returns:
       The span vectors for the given keys.
     """
-    all_spans: list[list[tuple[int, int]]] = []
-    all_vector_keys: list[list[VectorKey]] = []
-    for path_key in keys:
-      spans = self._id_to_spans.get(path_key, [])
-      all_spans.append(spans)
-      all_vector_keys.append([(*path_key, i) for i in range(len(spans))])
-
+    keys = list(keys)
+    span_table = self._get_span_table()
+    path_indices = self._get_path_indices(keys)
+    if span_table is None or not np.any(path_indices >= 0):
+      for _ in keys:
+        yield []
+      return
+
+    _, _, offsets, spans = span_table
+    found = path_indices >= 0
+    starts = np.where(found, offsets[path_indices], 0)
+    num_spans = np.where(found, offsets[path_indices + 1], 0) - starts
+    # The positions of the spans of all the keys, without a Python loop over the keys.
+    key_offsets = np.cumsum(num_spans) - num_spans
+    positions = np.repeat(starts - key_offsets, num_spans) + np.arange(num_spans.sum())
+
+    all_vectors = self._get_positions(positions)
+    all_spans = spans[positions].tolist()
     offset = 0
-    flat_vector_keys = [key for vector_keys in all_vector_keys for key in (vector_keys or [])]
-    all_vectors = self._vector_store.get(flat_vector_keys)
-    for spans in all_spans:
-      vectors = all_vectors[offset : offset + len(spans)]
-      yield [{'span': span, 'vector': vector} for span, vector in zip(spans, vectors)]
-      offset += len(spans)
+    for key_num_spans in num_spans.tolist():
+      key_spans = all_spans[offset : offset + key_num_spans]
+      vectors = all_vectors[offset : offset + key_num_spans]
+      yield [
+        {'span': (start, end), 'vector': vector} for (start, end), vector in zip(key_spans, vectors)
+      ]
+      offset += key_num_spans
+
+  def _get_positions(self, positions: np.ndarray) -> np.ndarray:
+    try:
+      return self._vector_store.get_positions(positions)
+    except NotImplementedError:
+      pass
+    span_table = self._get_span_table()
+    assert span_table is not None
+    # The vector store can only be read by key.
+    return self._vector_store.get(_get_vector_keys(span_table, positions))
+
+  def _topk_positions(
+    self, query: np.ndarray, k: int, positions: Optional[np.ndarray], ef: Optional[int]
+  ) -> tuple[np.ndarray, np.ndarray]:
+    try:
+      return self._vector_store.topk_positions(query, k, positions, ef)
+    except NotImplementedError:
+      pass
+
+    # The vector store can only be searched by key, so translate positions to keys and back.
+    span_table = self._get_span_table()
+    assert span_table is not None
+    key_scores = self._vector_store.topk(query, k, _get_vector_keys(span_table, positions), ef)
+    path_indices = self._get_path_indices([tuple(key[:-1]) for key, _ in key_scores])
+    span_indices = np.array([key[-1] for key, _ in key_scores], dtype=np.int64)
+    topk_positions = span_table[2][path_indices] + span_indices
+    return topk_positions, np.array([score for _, score in key_scores])
+
+  def _topk_positions_batch(
+    self, queries: np.ndarray, k: int, positions: Optional[np.ndarray], ef: Optional[int]
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    try:
+      return self._vector_store.topk_positions_batch(queries, k, positions, ef)
+    except NotImplementedError:
+      return [self._topk_positions(query, k, positions, ef) for query in queries]
 
   def topk(
-    self, query: np.ndarray, k: int, rowids: Optional[Iterable[str]] = None
+    self,
+    query: np.ndarray,
+    k: int,
+    rowids: Optional[Iterable[str]] = None,
+    ef: Optional[int] = None,
   ) -> list[tuple[PathKey, float]]:
     """Return the top k most similar vectors.
 
@@ -166,49 +523,206 @@ class VectorDBIndex:
       query: The query vector.
       k: The number of results to return.
       rowids: Optional row ids to restrict the search to.
+      ef: The size of the candidate list of approximate stores, like HNSW. Exact stores ignore it.
+
+    Returns:
+      A list of (path key, score) tuples for the top k rows, sorted by descending score. A path key
+      is scored by its most similar span.
+    """
+    return self.topk_batch(query.reshape(1, -1), k, rowids, ef)[0]
+
+  def topk_batch(
+    self,
+    queries: np.ndarray,
+    k: int,
+    rowids: Optional[Iterable[str]] = None,
+    ef: Optional[int] = None,
+  ) -> list[list[tuple[PathKey, float]]]:
+    """Return the top k most similar vectors for each of several queries.
+
+    The queries are scored together by the vector store, e.g. with a single matrix-matrix product,
+    which is much faster than calling `topk()` once per query.
+
+    Args:
+      queries: The query vectors, as a (num queries, dim) matrix.
+      k: The number of results to return per query.
+      rowids: Optional row ids to restrict the search to.
+      ef: The size of the candidate list of approximate stores, like HNSW. Exact stores ignore it.
 
     Returns:
-      A list of (rowid, score) tuples.
+      A list with the result of `topk()` for each query.
     """
-    total_num_span_keys = self._vector_store.size()
-    k = min(k, total_num_span_keys)
-    span_keys: Optional[list[VectorKey]] = None
+    span_table = self._get_span_table()
+    if k <= 0 or span_table is None or len(span_table[3]) == 0:
+      return [[] for _ in queries]
+    span_rowid_indices, span_path_indices = self._get_span_indices()
+
+    positions: Optional[np.ndarray] = None
+    num_spans_per_row = np.bincount(span_rowid_indices, minlength=len(span_table[0]))
     if rowids is not None:
-      span_keys = []
-      for rowid in rowids:
-        path_keys = self._rowid_to_path_keys.get(rowid)
-        if path_keys is None:
-          continue
-
-        span_keys.extend(
-          [
-            (*path_key, i)
-            for path_key in path_keys
-            for i in range(len(self._id_to_spans[path_key]))
-          ]
-        )
-      k = min(k, len(span_keys))
-    span_k = k
-    path_key_scores: dict[PathKey, float] = {}
-    seen_rowids: dict[str, bool] = {}
-    while (
-      len(seen_rowids) < k
-      and span_k <= total_num_span_keys
-      and (not span_keys or span_k <= len(span_keys))
-    ):
-      span_k += k
-      vector_key_scores = self._vector_store.topk(query, span_k, span_keys)
-      for (*path_key_list, _), score in vector_key_scores:
-        path_key = tuple(path_key_list)
-        if path_key not in path_key_scores:
-          path_key_scores[path_key] = score
-        rowid = cast(str, path_key[0])
-        if rowid not in seen_rowids:
-          seen_rowids[rowid] = True
-
-    top_rowids = set(list(seen_rowids.keys())[:k])
-    top_path_keys = [(key, s) for (key, s) in path_key_scores.items() if key[0] in top_rowids]
-    return list(top_path_keys)
+      rowid_indices = self._get_rowid_indices(_encode_rowids(list(rowids)))
+      row_mask = np.zeros(len(span_table[0]), dtype=np.bool_)
+      row_mask[rowid_indices[rowid_indices >= 0]] = True
+      row_positions: np.ndarray = np.flatnonzero(row_mask[span_rowid_indices])
+      if len(row_positions) == 0:
+        return [[] for _ in queries]
+      positions = row_positions
+      num_spans_per_row = num_spans_per_row[row_mask]
+
+    # Start from the number of spans the top k rows have on average, and double it for the queries
+    # whose top spans cover fewer than k rows. A single row with many spans then doesn't inflate the
+    # search of every query. Once the top spans cover k rows, the first occurrence of each of those
+    # rows is its best span.
+    num_candidates = len(positions) if positions is not None else len(span_rowid_indices)
+    span_k = min(max(k, math.ceil(k * float(num_spans_per_row.mean()))), num_candidates)
+    query_topks: list[Optional[tuple[np.ndarray, np.ndarray]]] = [None] * len(queries)
+    pending = np.arange(len(queries))
+    while len(pending) > 0:
+      batch_topks = self._topk_positions_batch(queries[pending], span_k, positions, ef)
+      still_pending: list[int] = []
+      for query_index, (topk_positions, topk_scores) in zip(pending.tolist(), batch_topks):
+        num_rows = len(np.unique(span_rowid_indices[topk_positions]))
+        if num_rows < k and span_k < num_candidates and len(topk_positions) == span_k:
+          still_pending.append(query_index)
+        else:
+          query_topks[query_index] = (topk_positions, topk_scores)
+      pending = np.array(still_pending, dtype=np.int64)
+      span_k = min(span_k * 2, num_candidates)
+
+    results: list[list[tuple[PathKey, float]]] = []
+    for query_topk in query_topks:
+      assert query_topk is not None
+      topk_positions, topk_scores = query_topk
+      # The results are sorted by score, so the first occurrence of a row is its best span.
+      topk_rowid_indices = span_rowid_indices[topk_positions]
+      _, first_rowid_occurrences = np.unique(topk_rowid_indices, return_index=True)
+      top_rowid_indices = topk_rowid_indices[np.sort(first_rowid_occurrences)[:k]]
+      in_top_rows = np.isin(topk_rowid_indices, top_rowid_indices)
+      topk_positions, topk_scores = topk_positions[in_top_rows], topk_scores[in_top_rows]
+
+      topk_path_indices = span_path_indices[topk_positions]
+      _, first_path_occurrences = np.unique(topk_path_indices, return_index=True)
+      first_path_occurrences = np.sort(first_path_occurrences)
+      topk_path_keys = _get_path_keys(span_table, topk_path_indices[first_path_occurrences])
+      results.append(list(zip(topk_path_keys, topk_scores[first_path_occurrences].tolist())))
+    return results
+
+
+def keys_to_arrays(keys: Sequence[VectorKey]) -> tuple[np.ndarray, np.ndarray]:
+  """Split a list of keys into an array of utf-8 encoded rowids and an int32 key-part matrix."""
+  key_lengths = set(len(key) for key in keys)
+  if len(key_lengths) > 1:
+    raise ValueError(f'All keys must have the same length. Got key lengths: {key_lengths}')
+  num_key_parts = key_lengths.pop() - 1 if key_lengths else 0
+  rowids = _encode_rowids([cast(str, key[0]) for key in keys])
+  key_parts = np.array([key[1:] for key in keys], dtype=np.int32).reshape(len(keys), num_key_parts)
+  return rowids, key_parts
+
+
+def _encode_rowids(rowids: Sequence[str]) -> np.ndarray:
+  return np.char.encode(np.array(rowids, dtype=np.str_), 'utf-8')
+
+
+def _spans_to_span_table(all_spans: Sequence[tuple[PathKey, list[tuple[int, int]]]]) -> _SpanTable:
+  path_rowids, key_parts = keys_to_arrays([path_key for path_key, _ in all_spans])
+  rowid_indices, rowids = pd.factorize(path_rowids)
+  num_spans = np.fromiter((len(spans) for _, spans in all_spans), dtype=np.int64)
+  spans = np.array([span for _, spans in all_spans for span in spans], dtype=np.int32)
+  return (
+    np.asarray(rowids, dtype=np.bytes_),
+    np.column_stack([rowid_indices.astype(np.int32), key_parts]),
+    np.concatenate(([0], np.cumsum(num_spans))),
+    spans.reshape(len(spans), 2),
+  )
+
+
+def _concat_span_tables(span_tables: Sequence[_SpanTable]) -> _SpanTable:
+  """Concatenate span tables, re-interning their rowids."""
+  if len(span_tables) == 1:
+    return span_tables[0]
+  key_lengths = set(path_keys.shape[1] for _, path_keys, _, _ in span_tables)
+  if len(key_lengths) > 1:
+    raise ValueError(f'All keys must have the same length. Got key lengths: {key_lengths}')
+  rowid_indices, rowids = pd.factorize(np.concatenate([rowids for rowids, _, _, _ in span_tables]))
+
+  all_path_keys: list[np.ndarray] = []
+  all_offsets: list[np.ndarray] = [np.array([0], dtype=np.int64)]
+  rowid_offset = 0
+  span_offset = 0
+  for table_rowids, path_keys, offsets, spans in span_tables:
+    path_keys = np.array(path_keys, dtype=np.int32)
+    path_keys[:, 0] = rowid_indices[rowid_offset + path_keys[:, 0]]
+    all_path_keys.append(path_keys)
+    all_offsets.append(offsets[1:] + span_offset)
+    rowid_offset += len(table_rowids)
+    span_offset += len(spans)
+  return (
+    np.asarray(rowids, dtype=np.bytes_),
+    np.concatenate(all_path_keys),
+    np.concatenate(all_offsets),
+    np.concatenate([spans for _, _, _, spans in span_tables]),
+  )
+
+
+def _get_span_path_indices(offsets: np.ndarray) -> np.ndarray:
+  """Return the index of the path key of every span."""
+  return np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+
+
+def _get_path_keys(span_table: _SpanTable, path_indices: np.ndarray) -> list[PathKey]:
+  rowids, path_keys, _, _ = span_table
+  path_keys = path_keys[path_indices]
+  path_rowids = np.char.decode(rowids[path_keys[:, 0]], 'utf-8').tolist()
+  return [(rowid, *parts) for rowid, parts in zip(path_rowids, path_keys[:, 1:].tolist())]
+
+
+def _get_vector_keys(
+  span_table: _SpanTable, positions: Optional[np.ndarray] = None
+) -> list[VectorKey]:
+  """Return the vector keys of the spans at the given positions, or of all spans."""
+  offsets = span_table[2]
+  if positions is None:
+    positions = np.arange(offsets[-1])
+  path_indices = _get_span_path_indices(offsets)[positions]
+  span_indices = positions - offsets[path_indices]
+  path_keys = _get_path_keys(span_table, path_indices)
+  return [(*path_key, i) for path_key, i in zip(path_keys, span_indices.tolist())]
+
+
+def _save_span_table(prefix: str, span_table: _SpanTable) -> None:
+  os.makedirs(os.path.dirname(prefix), exist_ok=True)
+  for suffix, array in zip(_SPAN_TABLE_SUFFIXES, span_table):
+    # Write to a temporary file and rename, which keeps memory-mapped readers of the previous file
+    # valid.
+    with open(prefix + suffix + '.tmp', 'wb') as f:
+      np.save(f, array, allow_pickle=False)
+    os.replace(prefix + suffix + '.tmp', prefix + suffix)
+
+
+def _load_span_table(prefix: str) -> _SpanTable:
+  mmap_mode: Optional[Literal['r']] = 'r' if bool(int(env('VECTOR_STORE_MMAP') or 0)) else None
+  rowids, path_keys, offsets, spans = (
+    np.load(prefix + suffix, mmap_mode=mmap_mode, allow_pickle=False)
+    for suffix in _SPAN_TABLE_SUFFIXES
+  )
+  return rowids, path_keys, offsets, spans
+
+
+def _load_base_span_table(base_path: str) -> _SpanTable:
+  """Load the span table of a compacted index, migrating it from the pickle of older indices."""
+  prefix = os.path.join(base_path, _SPANS_PREFIX)
+  if os.path.exists(prefix + _SPAN_TABLE_SUFFIXES[0]):
+    return _load_span_table(prefix)
+
+  with open_file(os.path.join(base_path, _SPANS_PICKLE_NAME), 'rb') as f:
+    all_spans: list[tuple[PathKey, list[tuple[int, int]]]] = pickle.load(f)
+  span_table = _spans_to_span_table(all_spans)
+  try:
+    _save_span_table(prefix, span_table)
+  except OSError as e:
+    # The index may be read-only. We can still use it, but will migrate again next time.
+    log(f'Unable to migrate the spans of the vector index at "{base_path}": {e}')
+  return span_table
 
 
 VECTOR_STORE_REGISTRY: dict[str, Type[VectorStore]] = {}
@@ -1,12 +1,16 @@
 """HNSW vector store."""
 
+import math
 import multiprocessing
+import os
 import threading
-from typing import Iterable, Optional, Set, cast
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional, cast
 
 import hnswlib
 import numpy as np
 import pandas as pd
+from pydantic import BaseModel
 from typing_extensions import override
 
 from ..schema import VectorKey
@@ -15,44 +19,88 @@ from .vector_store import VectorStore
 
 _HNSW_SUFFIX = '.hnswlib.bin'
 _LOOKUP_SUFFIX = '.lookup.pkl'
+_SETTINGS_SUFFIX = '.hnswlib.json'
 
-# Parameters for HNSW index: https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
+# Default parameters for HNSW index: https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
 QUERY_EF = 50
 CONSTRUCTION_EF = 100
 M = 16
 SPACE = 'ip'
 
+# Restricted searches over at most this many vectors are scored exactly, instead of searching the
+# graph.
+EXACT_SEARCH_LIMIT = 2_000
+# Restricted searches first search the graph unrestricted for this many times the number of
+# results we expect to be left after filtering, and filter the results with a bitmap.
+FILTER_OVERSAMPLING = 2
+# The largest unrestricted search done for a restricted search. Beyond this, the restricted vectors
+# are scored exactly.
+MAX_FILTER_CANDIDATES = 1_000
+# The number of vectors scored at once by an exact search.
+EXACT_SEARCH_BLOCK_SIZE = 10_000
+
+
+class HNSWSettings(BaseModel):
+  """The parameters of an HNSW index.
+
+  See https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md for how they trade off recall,
+  latency and memory. The settings are saved with the index, so a loaded index keeps the settings
+  it was built with, except for an explicitly passed `query_ef`, which only affects searches.
+  """
+
+  # The number of bi-directional links per element. Fixed when the index is created.
+  m: int = M
+  # The size of the candidate list while building the index. Fixed when the index is created.
+  construction_ef: int = CONSTRUCTION_EF
+  # The default size of the candidate list while searching. Can be overridden per query.
+  query_ef: int = QUERY_EF
+
 
 class HNSWVectorStore(VectorStore):
   """HNSW-backed vector store."""
 
   name = 'hnsw'
 
-  def __init__(self) -> None:
+  def __init__(self, settings: Optional[HNSWSettings] = None) -> None:
+    self.settings = settings or HNSWSettings()
+    # The query ef the store was created with, which overrides the one saved with a loaded index.
+    self._query_ef: Optional[int] = None
+    if settings and 'query_ef' in settings.model_fields_set:
+      self._query_ef = settings.query_ef
     # Maps a `VectorKey` to a row index in `_embeddings`.
     self._key_to_label: Optional[pd.Series] = None
     self._index: Optional[hnswlib.Index] = None
-    self._lock = threading.Lock()
+    # Queries share the lock and run concurrently. Only writes to the index take it exclusively.
+    self._lock = _ReadWriteLock()
 
   @override
   def save(self, base_path: str) -> None:
     assert (
       self._key_to_label is not None and self._index is not None
     ), 'The vector store has no embeddings. Call load() or add() first.'
-    with self._lock:
+    with self._lock.read():
       self._index.save_index(base_path + _HNSW_SUFFIX)
       self._key_to_label.to_pickle(base_path + _LOOKUP_SUFFIX)
+      with open(base_path + _SETTINGS_SUFFIX, 'w') as f:
+        f.write(self.settings.model_dump_json())
 
   @override
   def load(self, base_path: str) -> None:
-    with self._lock:
+    with self._lock.write():
+      # Older indices don't have a settings file, and were built with the default settings.
+      self.settings = HNSWSettings()
+      if os.path.exists(base_path + _SETTINGS_SUFFIX):
+        with open(base_path + _SETTINGS_SUFFIX) as f:
+          self.settings = HNSWSettings.model_validate_json(f.read())
+      if self._query_ef is not None:
+        self.settings.query_ef = self._query_ef
       self._key_to_label = pd.read_pickle(base_path + _LOOKUP_SUFFIX)
       dim = int(self._key_to_label.name)
       index = hnswlib.Index(space=SPACE, dim=dim)
       index.set_num_threads(multiprocessing.cpu_count())
       index.load_index(base_path + _HNSW_SUFFIX)
       self._index = index
-      index.set_ef(min(QUERY_EF, self.size()))
+      index.set_ef(self._default_ef())
 
   @override
   def size(self) -> int:
@@ -63,7 +111,7 @@ class HNSWVectorStore(VectorStore):
 
   @override
   def add(self, keys: list[VectorKey], embeddings: np.ndarray) -> None:
-    with self._lock:
+    with self._lock.write():
       dim = embeddings.shape[1]
 
       current_size = self.size() if self._index is not None else 0
@@ -71,7 +119,11 @@ class HNSWVectorStore(VectorStore):
         with DebugTimer('hnswlib index creation'):
           index = hnswlib.Index(space=SPACE, dim=dim)
           index.set_num_threads(multiprocessing.cpu_count())
-          index.init_index(max_elements=len(keys), ef_construction=CONSTRUCTION_EF, M=M)
+          index.init_index(
+            max_elements=len(keys),
+            ef_construction=self.settings.construction_ef,
+            M=self.settings.m,
+          )
           self._index = index
       else:
         with DebugTimer('hnswlib index resize'):
@@ -96,46 +148,268 @@ class HNSWVectorStore(VectorStore):
 
         self._key_to_label.name = str(dim)
         self._index.add_items(embeddings, row_indices)
-        self._index.set_ef(min(QUERY_EF, self.size()))
+        self._index.set_ef(self._default_ef())
 
   @override
   def get(self, keys: Optional[Iterable[VectorKey]] = None) -> np.ndarray:
     assert (
       self._index is not None and self._key_to_label is not None
     ), 'No embeddings exist in this store.'
-    with self._lock:
+    with self._lock.read():
       if not keys:
         return np.array(self._index.get_items(self._key_to_label.values), dtype=np.float32)
       locs = self._key_to_label.loc[cast(list[str], keys)].values
       return np.array(self._index.get_items(locs), dtype=np.float32)
 
+  @override
+  def get_positions(self, positions: np.ndarray) -> np.ndarray:
+    assert self._index is not None, 'No embeddings exist in this store.'
+    with self._lock.read():
+      # Labels are assigned in the order vectors are added, so a label is the vector's position.
+      return np.array(self._index.get_items(positions), dtype=np.float32)
+
+  def _default_ef(self) -> int:
+    return min(self.settings.query_ef, self.size())
+
+  @contextmanager
+  def _query_lock(self, ef: Optional[int]) -> Iterator[None]:
+    """Hold the lock for a query. Queries with their own ef take it exclusively.
+
+    The ef of an hnswlib index is shared by all queries, so a query that changes it can't run
+    concurrently with other queries.
+    """
+    if ef is None:
+      with self._lock.read():
+        yield
+      return
+    with self._lock.write():
+      assert self._index is not None, 'No embeddings exist in this store.'
+      self._index.set_ef(ef)
+      try:
+        yield
+      finally:
+        self._index.set_ef(self._default_ef())
+
+  def _knn_query(
+    self, queries: np.ndarray, k: int
+  ) -> list[Optional[tuple[np.ndarray, np.ndarray]]]:
+    """Search the graph. The caller must hold the lock.
+
+    Returns:
+      The (labels, scores) of each query, or None for the queries where hnswlib can't find k
+      results.
+    """
+    assert self._index is not None, 'No embeddings exist in this store.'
+    try:
+      locs, dists = self._index.knn_query(queries, k=k)
+    except RuntimeError:
+      # If K is too large compared to M and construction-time ef, HNSW will throw an error. Search
+      # the queries one at a time, so only the queries that fail return no results.
+      if len(queries) == 1:
+        return [None]
+      return [self._knn_query(query[np.newaxis], k)[0] for query in queries]
+    return [
+      (query_locs.astype(np.int64), 1 - query_dists) for query_locs, query_dists in zip(locs, dists)
+    ]
+
+  def _search(
+    self, queries: np.ndarray, k: int, labels: Optional[np.ndarray]
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Search the index, optionally restricted to a set of labels. The caller must hold the lock.
+
+    A restricted search never uses hnswlib's filter callback, which calls back into Python for
+    every node hnswlib visits:
+      - Few labels: score their vectors exactly.
+      - Many labels: search the graph unrestricted for extra results, and filter them with a bitmap.
+        Queries with too few results left after filtering search again for twice as many.
+      - Otherwise, or once the unrestricted search would exceed `MAX_FILTER_CANDIDATES`: score the
+        vectors of the labels exactly, a block at a time.
+
+    Returns:
+      A list with a tuple of (labels, scores) arrays for each query, sorted by descending score.
+      Queries where hnswlib can't find k results return no results, which is ok for the caller
+      (VectorDBIndex).
+    """
+    assert self._index is not None, 'No embeddings exist in this store.'
+    queries = queries.astype(np.float32)
+    size = self.size()
+    k = min(k, size if labels is None else len(labels))
+    empty = (np.array([], dtype=np.int64), np.array([], dtype=np.float32))
+    if k <= 0:
+      return [empty for _ in queries]
+    if labels is None:
+      return [result or empty for result in self._knn_query(queries, k)]
+
+    label_ids: np.ndarray = labels.astype(np.int64)
+    if len(label_ids) <= EXACT_SEARCH_LIMIT:
+      return self._exact_search(queries, k, label_ids)
+
+    label_mask = np.zeros(size, dtype=np.bool_)
+    label_mask[label_ids] = True
+    results: list[Optional[tuple[np.ndarray, np.ndarray]]] = [None] * len(queries)
+    missing = list(range(len(queries)))
+    num_candidates = math.ceil(FILTER_OVERSAMPLING * k * size / len(label_ids))
+    while missing and num_candidates <= MAX_FILTER_CANDIDATES:
+      num_candidates = min(num_candidates, size)
+      for i, result in zip(missing, self._knn_query(queries[missing], num_candidates)):
+        if result is None:
+          continue
+        locs, scores = result
+        in_labels = label_mask[locs]
+        if np.count_nonzero(in_labels) >= k:
+          results[i] = (locs[in_labels][:k], scores[in_labels][:k])
+      missing = [i for i in missing if results[i] is None]
+      if num_candidates == size:
+        break
+      num_candidates *= 2
+
+    if missing:
+      for i, result in zip(missing, self._exact_search(queries[missing], k, label_ids)):
+        results[i] = result
+    return [result or empty for result in results]
+
+  def _exact_search(
+    self, queries: np.ndarray, k: int, label_ids: np.ndarray
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Score the vectors of the labels exactly, a block at a time. The caller must hold the lock."""
+    assert self._index is not None, 'No embeddings exist in this store.'
+    topk_labels = np.empty((len(queries), 0), dtype=np.int64)
+    topk_similarities = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(label_ids), EXACT_SEARCH_BLOCK_SIZE):
+      block_labels = label_ids[start : start + EXACT_SEARCH_BLOCK_SIZE]
+      vectors = np.array(self._index.get_items(block_labels), dtype=np.float32)
+      # Keep the top k of the previous blocks, and pick the top k again with this block.
+      all_labels = np.concatenate(
+        [topk_labels, np.broadcast_to(block_labels, (len(queries), len(block_labels)))], axis=1
+      )
+      similarities = np.concatenate([topk_similarities, queries @ vectors.T], axis=1)
+      block_k = min(k, similarities.shape[1])
+      indices = np.argpartition(similarities, -block_k, axis=1)[:, -block_k:]
+      topk_labels = np.take_along_axis(all_labels, indices, axis=1)
+      topk_similarities = np.take_along_axis(similarities, indices, axis=1)
+    order = np.argsort(topk_similarities, axis=1)[:, ::-1]
+    topk_labels = np.take_along_axis(topk_labels, order, axis=1)
+    topk_similarities = np.take_along_axis(topk_similarities, order, axis=1)
+    return list(zip(topk_labels, topk_similarities))
+
   @override
   def topk(
-    self, query: np.ndarray, k: int, keys: Optional[Iterable[VectorKey]] = None
+    self,
+    query: np.ndarray,
+    k: int,
+    keys: Optional[Iterable[VectorKey]] = None,
+    ef: Optional[int] = None,
   ) -> list[tuple[VectorKey, float]]:
+    """Return the top k most similar vectors.
+
+    Args:
+      query: The query vector.
+      k: The number of results to return.
+      keys: Optional keys to restrict the search to.
+      ef: The size of the candidate list for this query. Defaults to the `query_ef` setting. hnswlib
+        shares the ef between all queries, so a query with its own ef runs alone, and waits for
+        the other queries to finish.
+
+    Returns:
+      A list of (key, score) tuples.
+    """
     assert (
       self._index is not None and self._key_to_label is not None
     ), 'No embeddings exist in this store.'
-    with self._lock:
-      labels: Set[int] = set()
+    with self._query_lock(ef):
+      labels: Optional[np.ndarray] = None
       if keys is not None:
-        labels = set(self._key_to_label.loc[cast(list[str], keys)].tolist())
-        k = min(k, len(labels))
+        labels = self._key_to_label.loc[cast(list[str], keys)].to_numpy()
+      [(locs, scores)] = self._search(np.expand_dims(query, axis=0), k, labels)
+      topk_keys = self._key_to_label.index.values[locs]
+      return list(zip(topk_keys, scores))
 
-      k = min(k, self.size())
+  @override
+  def topk_positions(
+    self,
+    query: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """Return the top k most similar vectors, addressed by position instead of by key.
 
-      def filter_func(label: int) -> bool:
-        return label in labels
+    Args:
+      query: The query vector.
+      k: The number of results to return.
+      positions: Optional positions to restrict the search to.
+      ef: The size of the candidate list for this query. Defaults to the `query_ef` setting. hnswlib
+        shares the ef between all queries, so a query with its own ef runs alone, and waits for
+        the other queries to finish.
 
-      query = np.expand_dims(query.astype(np.float32), axis=0)
-      try:
-        locs, dists = self._index.knn_query(query, k=k, filter=filter_func if labels else None)
-      except RuntimeError:
-        # If K is too large compared to M and construction-time ef, HNSW will throw an error.
-        # In this case we return no results, which is ok for the caller of this method
-        # (VectorIndex).
-        return []
-      locs = locs[0]
-      dists = dists[0]
-      topk_keys = self._key_to_label.index.values[locs]
-      return [(key, 1 - dist) for key, dist in zip(topk_keys, dists)]
+    Returns:
+      A tuple of (positions, scores) arrays, sorted by descending score.
+    """
+    return self.topk_positions_batch(np.expand_dims(query, axis=0), k, positions, ef)[0]
+
+  @override
+  def topk_positions_batch(
+    self,
+    queries: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Return the top k most similar vectors for each of several queries, addressed by position.
+
+    Args:
+      queries: The query vectors, as a (num queries, dim) matrix.
+      k: The number of results to return per query.
+      positions: Optional positions to restrict the search to.
+      ef: The size of the candidate list for these queries. Defaults to the `query_ef` setting.
+        hnswlib shares the ef between all queries, so queries with their own ef run alone, and
+        wait for the other queries to finish.
+
+    Returns:
+      A list with a tuple of (positions, scores) arrays for each query, sorted by descending score.
+    """
+    with self._query_lock(ef):
+      # Labels are assigned in the order vectors are added, so a label is the vector's position.
+      return self._search(queries, k, positions)
+
+
+class _ReadWriteLock:
+  """A lock that is held either by any number of readers, or by a single writer.
+
+  Waiting writers block new readers, so a steady stream of queries can't starve a writer.
+  """
+
+  def __init__(self) -> None:
+    self._condition = threading.Condition()
+    self._num_readers = 0
+    self._num_waiting_writers = 0
+    self._writing = False
+
+  @contextmanager
+  def read(self) -> Iterator[None]:
+    with self._condition:
+      while self._writing or self._num_waiting_writers:
+        self._condition.wait()
+      self._num_readers += 1
+    try:
+      yield
+    finally:
+      with self._condition:
+        self._num_readers -= 1
+        if self._num_readers == 0:
+          self._condition.notify_all()
+
+  @contextmanager
+  def write(self) -> Iterator[None]:
+    with self._condition:
+      self._num_waiting_writers += 1
+      while self._writing or self._num_readers:
+        self._condition.wait()
+      self._num_waiting_writers -= 1
+      self._writing = True
+    try:
+      yield
+    finally:
+      with self._condition:
+        self._writing = False
+        self._condition.notify_all()
@@ -0,0 +1,229 @@
+"""IVFVectorStore class for searching vectors partitioned by k-means clusters."""
+
+import math
+import os
+from typing import Literal, Optional
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from typing_extensions import override
+
+from .vector_store_numpy import NumpyVectorStore
+
+_CENTROIDS_SUFFIX = '.ivf_centroids.npy'
+_LIST_OFFSETS_SUFFIX = '.ivf_offsets.npy'
+_LIST_POSITIONS_SUFFIX = '.ivf_positions.npy'
+_LIST_VECTORS_SUFFIX = '.ivf_vectors.npy'
+
+# Stores with fewer vectors than this are searched exhaustively.
+MIN_INDEX_SIZE = 10_000
+# The number of posting lists probed per query.
+NPROBE = 16
+# The number of vectors sampled per centroid to train the k-means centroids.
+TRAIN_SAMPLES_PER_CENTROID = 64
+# The number of vectors assigned to posting lists at once.
+ASSIGN_BLOCK_SIZE = 16_384
+
+
+class IVFVectorStore(NumpyVectorStore):
+  """Stores vectors in posting lists of k-means clusters (an inverted file index).
+
+  When the store is saved, vectors are partitioned into about sqrt(N) clusters with k-means. Each
+  cluster's posting list is a contiguous slice of a memory-mapped matrix on disk. A query only
+  scores the `nprobe` lists whose centroids are closest to it, so search is sublinear and the
+  index does not need to fit in RAM.
+
+  Vectors added after the lists were built are searched exhaustively until the next `save()`, which
+  assigns them to the existing centroids. The centroids are trained once, and never retrained.
+
+  The posting lists hold a second copy of every vector, ordered by list, next to the embeddings
+  file, so the index takes about twice the disk space of a numpy store. Since new vectors land in
+  the middle of the lists, each `save()` rewrites the copy of all the vectors, not only the new
+  ones.
+  """
+
+  name = 'ivf'
+
+  def __init__(self) -> None:
+    super().__init__()
+    # The number of posting lists to probe per query. Probing more lists improves recall.
+    self.nprobe = NPROBE
+    self._centroids: Optional[np.ndarray] = None
+    # The posting lists. The vectors of list i are `_list_vectors[offsets[i]:offsets[i + 1]]`, and
+    # their positions in the store are `_list_positions[offsets[i]:offsets[i + 1]]`.
+    self._list_offsets: Optional[np.ndarray] = None
+    self._list_positions: Optional[np.ndarray] = None
+    self._list_vectors: Optional[np.ndarray] = None
+
+  @override
+  def save(self, base_path: str) -> None:
+    super().save(base_path)
+    # Re-open the saved embeddings memory-mapped, so building the lists doesn't need them in RAM.
+    _, rowids, key_parts = self._consolidate()
+    self._segments = [(self._load_embeddings(base_path, mmap_mode='r'), rowids, key_parts)]
+    if self.size() < MIN_INDEX_SIZE:
+      self._reset_lists()
+      for suffix in _IVF_SUFFIXES:
+        if os.path.exists(base_path + suffix):
+          os.remove(base_path + suffix)
+      return
+    self._build_lists(base_path)
+
+  @override
+  def load(self, base_path: str) -> None:
+    super().load(base_path)
+    self._reset_lists()
+    if not os.path.exists(base_path + _CENTROIDS_SUFFIX):
+      return
+    self._centroids = np.load(base_path + _CENTROIDS_SUFFIX, allow_pickle=False)
+    self._list_offsets = np.load(base_path + _LIST_OFFSETS_SUFFIX, allow_pickle=False)
+    self._list_positions = np.load(base_path + _LIST_POSITIONS_SUFFIX, allow_pickle=False)
+    self._list_vectors = np.load(
+      base_path + _LIST_VECTORS_SUFFIX, mmap_mode='r', allow_pickle=False
+    )
+
+  @override
+  def _load_embeddings(self, base_path: str, mmap_mode: Optional[Literal['r']]) -> np.ndarray:
+    # The embeddings are only read for `get()` and to build the lists, so they always stay on disk.
+    return super()._load_embeddings(base_path, mmap_mode='r')
+
+  def _reset_lists(self) -> None:
+    self._centroids = None
+    self._list_offsets = None
+    self._list_positions = None
+    self._list_vectors = None
+
+  def _build_lists(self, base_path: str) -> None:
+    """Assign the vectors to posting lists, and write the lists to disk."""
+    embeddings, _, _ = self._consolidate()
+    list_ids = np.empty(len(embeddings), dtype=np.int32)
+    num_indexed = 0
+    if (
+      self._centroids is not None
+      and self._list_offsets is not None
+      and self._list_positions is not None
+    ):
+      # Keep the lists of the vectors that are already indexed, and only assign the new vectors.
+      num_indexed = len(self._list_positions)
+      list_ids[self._list_positions] = np.repeat(
+        np.arange(len(self._centroids), dtype=np.int32), np.diff(self._list_offsets)
+      )
+    else:
+      self._centroids = _train_centroids(embeddings)
+    centroids = self._centroids
+    for start in range(num_indexed, len(embeddings), ASSIGN_BLOCK_SIZE):
+      block = embeddings[start : start + ASSIGN_BLOCK_SIZE]
+      list_ids[start : start + len(block)] = np.argmax(_centroid_scores(centroids, block), axis=1)
+
+    list_positions = np.argsort(list_ids, kind='stable')
+    list_offsets = np.concatenate(([0], np.cumsum(np.bincount(list_ids, minlength=len(centroids)))))
+
+    tmp_vectors_path = base_path + _LIST_VECTORS_SUFFIX + '.tmp'
+    list_vectors = np.lib.format.open_memmap(  # type: ignore
+      tmp_vectors_path, mode='w+', dtype=np.float32, shape=embeddings.shape
+    )
+    for start in range(0, len(list_positions), ASSIGN_BLOCK_SIZE):
+      block_positions = list_positions[start : start + ASSIGN_BLOCK_SIZE]
+      list_vectors[start : start + len(block_positions)] = embeddings[block_positions]
+    list_vectors.flush()
+    del list_vectors
+
+    for suffix, array in (
+      (_CENTROIDS_SUFFIX, centroids),
+      (_LIST_OFFSETS_SUFFIX, list_offsets),
+      (_LIST_POSITIONS_SUFFIX, list_positions),
+    ):
+      with open(base_path + suffix + '.tmp', 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+      os.replace(base_path + suffix + '.tmp', base_path + suffix)
+    # Rename the vectors last, which keeps memory-mapped readers of the previous lists valid.
+    os.replace(tmp_vectors_path, base_path + _LIST_VECTORS_SUFFIX)
+
+    self._list_offsets = list_offsets
+    self._list_positions = list_positions
+    self._list_vectors = np.load(
+      base_path + _LIST_VECTORS_SUFFIX, mmap_mode='r', allow_pickle=False
+    )
+
+  @override
+  def _topk_positions_batch(
+    self, queries: np.ndarray, k: int, positions: Optional[np.ndarray]
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    return [self._topk_positions(query, k, positions) for query in queries]
+
+  @override
+  def _topk_positions(
+    self, query: np.ndarray, k: int, positions: Optional[np.ndarray]
+  ) -> tuple[np.ndarray, np.ndarray]:
+    if (
+      self._centroids is None
+      or self._list_offsets is None
+      or self._list_positions is None
+      or self._list_vectors is None
+    ):
+      return super()._topk_positions(query, k, positions)
+
+    nprobe = min(self.nprobe, len(self._centroids))
+    num_indexed = len(self._list_positions)
+    if positions is not None and len(positions) <= num_indexed * nprobe / len(self._centroids):
+      # The restricted set is smaller than the lists we would probe, so exhaustive search is faster.
+      return super()._topk_positions(query, k, positions)
+
+    query = query.astype(np.float32).reshape(-1)
+    centroid_scores = _centroid_scores(self._centroids, query[np.newaxis, :])[0]
+    probes = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+
+    candidate_positions: list[np.ndarray] = []
+    candidate_similarities: list[np.ndarray] = []
+    for probe in probes.tolist():
+      start, end = self._list_offsets[probe], self._list_offsets[probe + 1]
+      candidate_positions.append(self._list_positions[start:end])
+      candidate_similarities.append(self._list_vectors[start:end] @ query)
+    # Vectors added since the lists were built are not in any list yet.
+    embeddings, _, _ = self._consolidate()
+    if len(embeddings) > num_indexed:
+      candidate_positions.append(np.arange(num_indexed, len(embeddings)))
+      candidate_similarities.append(embeddings[num_indexed:] @ query)
+
+    all_positions = np.concatenate(candidate_positions)
+    similarities = np.concatenate(candidate_similarities)
+    if positions is not None:
+      in_positions = np.isin(all_positions, positions)
+      all_positions, similarities = all_positions[in_positions], similarities[in_positions]
+    num_results = min(k, len(positions) if positions is not None else len(embeddings))
+    if len(similarities) < num_results:
+      # The probed lists don't have enough vectors, so fall back to exhaustive search.
+      return super()._topk_positions(query, k, positions)
+    if num_results <= 0:
+      return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    indices = np.argpartition(similarities, -num_results)[-num_results:]
+    indices = indices[np.argsort(similarities[indices])][::-1]
+    return all_positions[indices], similarities[indices]
+
+
+_IVF_SUFFIXES = (
+  _CENTROIDS_SUFFIX,
+  _LIST_OFFSETS_SUFFIX,
+  _LIST_POSITIONS_SUFFIX,
+  _LIST_VECTORS_SUFFIX,
+)
+
+
+def _train_centroids(embeddings: np.ndarray) -> np.ndarray:
+  """Train k-means centroids on a sample of the embeddings."""
+  num_lists = max(1, int(math.sqrt(len(embeddings))))
+  num_samples = min(len(embeddings), num_lists * TRAIN_SAMPLES_PER_CENTROID)
+  rng = np.random.default_rng(42)
+  sample = np.sort(rng.choice(len(embeddings), size=num_samples, replace=False))
+  kmeans = MiniBatchKMeans(n_clusters=num_lists, n_init=1, random_state=42)
+  kmeans.fit(np.asarray(embeddings[sample], dtype=np.float32))
+  return kmeans.cluster_centers_.astype(np.float32)
+
+
+def _centroid_scores(centroids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+  """Score the centroids for each vector. The highest score is the closest centroid.
+
+  This ranks centroids by euclidean distance, since |x - c|^2 = |x|^2 - 2 * (x.c - |c|^2 / 2).
+  """
+  return vectors @ centroids.T - 0.5 * np.sum(centroids**2, axis=1)
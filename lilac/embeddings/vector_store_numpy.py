@@ -1,47 +1,82 @@
 """NumpyVectorStore class for storing vectors in numpy arrays."""
 
-from typing import Iterable, Optional, cast
+import os
+from typing import Iterable, Literal, Optional, Sequence, cast
 
 import numpy as np
 import pandas as pd
 from typing_extensions import override
 
+from ..env import env
 from ..schema import VectorKey
-from .vector_store import VectorStore
+from .vector_store import VectorStore, keys_to_arrays
 
 _EMBEDDINGS_SUFFIX = '.matrix.npy'
+_ROWIDS_SUFFIX = '.rowids.npy'
+_KEY_PARTS_SUFFIX = '.keys.npy'
+# Older indices stored the key lookup as a pickled pandas Series. We still read it for backwards
+# compatibility.
 _LOOKUP_SUFFIX = '.lookup.pkl'
 
+# The number of queries scored at once by `topk_batch()`. This bounds the memory of the
+# (queries, vectors) similarity matrix.
+QUERY_BLOCK_SIZE = 64
+
 
 class NumpyVectorStore(VectorStore):
-  """Stores vectors as in-memory np arrays."""
+  """Stores vectors as in-memory np arrays.
+
+  The keys are stored as two flat arrays: the utf-8 encoded rowids, and an int32 matrix with the
+  rest of each `VectorKey`. Both arrays, and the embedding matrix, are plain `.npy` files so they
+  can be memory-mapped. When the `VECTOR_STORE_MMAP` environment variable is set to 1, `load()`
+  maps the files read-only instead of copying them into RAM, so several processes share a single
+  page-cached copy of the index.
+  """
 
   name = 'numpy'
 
   def __init__(self) -> None:
-    self._embeddings: Optional[np.ndarray] = None
-    # Maps a `VectorKey` to a row index in `_embeddings`.
+    # The store is a list of (embeddings, rowids, key parts) segments. Each call to `add()` appends
+    # a segment so growing the store does linear work, instead of re-copying the whole matrix on
+    # every call. The segments are merged lazily, the first time we read from the store.
+    #   embeddings: The embedding matrix.
+    #   rowids: The rowid of each embedding, utf-8 encoded.
+    #   key parts: The rest of the `VectorKey` (after the rowid) of each embedding.
+    self._segments: list[tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+    # Maps a `VectorKey` to a row index in the embedding matrix. This is built lazily from the key
+    # arrays the first time we look up by key.
     self._key_to_index: Optional[pd.Series] = None
 
   @override
   def size(self) -> int:
-    assert (
-      self._embeddings is not None
-    ), 'The vector store has no embeddings. Call load() or add() first.'
-    return len(self._embeddings)
+    assert self._segments, 'The vector store has no embeddings. Call load() or add() first.'
+    return sum(len(embeddings) for embeddings, _, _ in self._segments)
 
   @override
   def save(self, base_path: str) -> None:
-    assert (
-      self._embeddings is not None and self._key_to_index is not None
-    ), 'The vector store has no embeddings. Call load() or add() first.'
-    np.save(base_path + _EMBEDDINGS_SUFFIX, self._embeddings, allow_pickle=False)
-    self._key_to_index.to_pickle(base_path + _LOOKUP_SUFFIX)
+    assert self._segments, 'The vector store has no embeddings. Call load() or add() first.'
+    embeddings, rowids, key_parts = zip(*self._segments)
+    # Segments are streamed to disk one at a time so saving doesn't need a merged copy in memory.
+    _save_segments(base_path + _EMBEDDINGS_SUFFIX, embeddings)
+    _save_segments(base_path + _ROWIDS_SUFFIX, rowids)
+    _save_segments(base_path + _KEY_PARTS_SUFFIX, key_parts)
 
   @override
   def load(self, base_path: str) -> None:
-    self._embeddings = np.load(base_path + _EMBEDDINGS_SUFFIX, allow_pickle=False)
-    self._key_to_index = pd.read_pickle(base_path + _LOOKUP_SUFFIX)
+    mmap_mode: Optional[Literal['r']] = 'r' if bool(int(env('VECTOR_STORE_MMAP') or 0)) else None
+    embeddings = self._load_embeddings(base_path, mmap_mode)
+    self._key_to_index = None
+    if os.path.exists(base_path + _ROWIDS_SUFFIX):
+      rowids = np.load(base_path + _ROWIDS_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
+      key_parts = np.load(base_path + _KEY_PARTS_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
+    else:
+      key_to_index: pd.Series = pd.read_pickle(base_path + _LOOKUP_SUFFIX).sort_values()
+      rowids, key_parts = keys_to_arrays(key_to_index.index.tolist())
+      self._key_to_index = key_to_index
+    self._segments = [(embeddings, rowids, key_parts)]
+
+  def _load_embeddings(self, base_path: str, mmap_mode: Optional[Literal['r']]) -> np.ndarray:
+    return np.load(base_path + _EMBEDDINGS_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
 
   @override
   def add(self, keys: list[VectorKey], embeddings: np.ndarray) -> None:
@@ -50,52 +85,155 @@ class NumpyVectorStore(VectorStore):
         f'Length of keys ({len(keys)}) does not match number of embeddings {embeddings.shape[0]}.'
       )
 
-    current_size = self.size() if self._embeddings is not None else 0
+    rowids, key_parts = keys_to_arrays(keys)
+    if self._segments:
+      current_embeddings, _, current_key_parts = self._segments[0]
+      if embeddings.shape[1] != current_embeddings.shape[1]:
+        raise ValueError(
+          f'Embedding dimension ({embeddings.shape[1]}) does not match the dimension of the '
+          f'store ({current_embeddings.shape[1]}).'
+        )
+      if key_parts.shape[1] != current_key_parts.shape[1]:
+        raise ValueError(
+          f'Keys must have the same length. Got keys of length {key_parts.shape[1] + 1}, but the '
+          f'store has keys of length {current_key_parts.shape[1] + 1}.'
+        )
 
     # Cast to float32 since dot product with float32 is 40-50x faster than float16 and 2.5x faster
     # than float64.
-    if self._embeddings is None:
-      self._embeddings = embeddings.astype(np.float32)
-    else:
-      self._embeddings = np.concatenate([self._embeddings, embeddings.astype(np.float32)], axis=0)
+    self._segments.append((embeddings.astype(np.float32), rowids, key_parts))
+    self._key_to_index = None
 
-    row_indices = np.arange(current_size, current_size + len(keys), dtype=np.int32)
-    new_key_to_label = pd.Series(row_indices, index=keys, dtype=np.int32)
-    if self._key_to_index is not None:
-      self._key_to_index = pd.concat([self._key_to_index, new_key_to_label])
-    else:
-      self._key_to_index = new_key_to_label
+  def _consolidate(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge all the segments into one and return its (embeddings, rowids, key parts)."""
+    assert self._segments, 'The vector store has no embeddings. Call load() or add() first.'
+    segments = self._segments
+    if len(segments) > 1:
+      embeddings, rowids, key_parts = zip(*segments)
+      segments = [(np.concatenate(embeddings), np.concatenate(rowids), np.concatenate(key_parts))]
+      self._segments = segments
+    return segments[0]
+
+  def _get_key_to_index(self) -> pd.Series:
+    _, rowids, key_parts = self._consolidate()
+    key_to_index = self._key_to_index
+    if key_to_index is None:
+      index = pd.MultiIndex.from_arrays(
+        [np.char.decode(rowids, 'utf-8'), *key_parts.T.astype(np.int64)]
+      )
+      key_to_index = pd.Series(np.arange(len(index), dtype=np.int32), index=index)
+      self._key_to_index = key_to_index
+    return key_to_index
+
+  def _get_keys(self, row_indices: np.ndarray) -> list[VectorKey]:
+    """Return the `VectorKey`s for the given row indices."""
+    _, rowids, key_parts = self._consolidate()
+    rowid_list = np.char.decode(rowids[row_indices], 'utf-8').tolist()
+    key_parts_list = key_parts[row_indices].tolist()
+    return [(rowid, *parts) for rowid, parts in zip(rowid_list, key_parts_list)]
 
   @override
   def get(self, keys: Optional[Iterable[VectorKey]] = None) -> np.ndarray:
-    assert (
-      self._embeddings is not None and self._key_to_index is not None
-    ), 'The vector store has no embeddings. Call load() or add() first.'
+    all_embeddings, _, _ = self._consolidate()
     if not keys:
-      return self._embeddings
-    locs = self._key_to_index.loc[cast(list[str], keys)]
-    return self._embeddings.take(locs, axis=0)
+      return all_embeddings
+    locs = self._get_key_to_index().loc[cast(list[str], keys)]
+    return all_embeddings.take(locs, axis=0)
+
+  @override
+  def get_positions(self, positions: np.ndarray) -> np.ndarray:
+    embeddings, _, _ = self._consolidate()
+    return embeddings.take(positions, axis=0)
 
   @override
   def topk(
-    self, query: np.ndarray, k: int, keys: Optional[Iterable[VectorKey]] = None
+    self,
+    query: np.ndarray,
+    k: int,
+    keys: Optional[Iterable[VectorKey]] = None,
+    ef: Optional[int] = None,
   ) -> list[tuple[VectorKey, float]]:
-    assert (
-      self._embeddings is not None and self._key_to_index is not None
-    ), 'The vector store has no embeddings. Call load() or add() first.'
+    positions: Optional[np.ndarray] = None
     if keys is not None:
-      row_indices = self._key_to_index.loc[cast(list[str], keys)]
-      embeddings = self._embeddings.take(row_indices, axis=0)
-      keys = list(keys)
-    else:
-      keys, embeddings = (
-        cast(list[VectorKey], self._key_to_index.index.tolist()),
-        self._embeddings,
-      )
+      positions = self._get_key_to_index().loc[cast(list[str], keys)].to_numpy()
+    topk_positions, topk_similarities = self._topk_positions(query, k, positions)
+    topk_keys = self._get_keys(topk_positions)
+    return list(zip(topk_keys, topk_similarities))
+
+  @override
+  def topk_positions(
+    self,
+    query: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    return self._topk_positions(query, k, positions)
+
+  @override
+  def topk_batch(
+    self,
+    queries: np.ndarray,
+    k: int,
+    keys: Optional[Iterable[VectorKey]] = None,
+    ef: Optional[int] = None,
+  ) -> list[list[tuple[VectorKey, float]]]:
+    positions: Optional[np.ndarray] = None
+    if keys is not None:
+      positions = self._get_key_to_index().loc[cast(list[str], keys)].to_numpy()
+    results: list[list[tuple[VectorKey, float]]] = []
+    for topk_positions, topk_similarities in self._topk_positions_batch(queries, k, positions):
+      topk_keys = self._get_keys(topk_positions)
+      results.append(list(zip(topk_keys, topk_similarities)))
+    return results
+
+  @override
+  def topk_positions_batch(
+    self,
+    queries: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    return self._topk_positions_batch(queries, k, positions)
+
+  def _topk_positions_batch(
+    self, queries: np.ndarray, k: int, positions: Optional[np.ndarray]
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    embeddings, _, _ = self._consolidate()
+    if positions is not None:
+      embeddings = embeddings.take(positions, axis=0)
+    k = min(k, len(embeddings))
+    if k <= 0:
+      return [(np.array([], dtype=np.int64), np.array([], dtype=embeddings.dtype)) for _ in queries]
+
+    queries = queries.astype(embeddings.dtype)
+    results: list[tuple[np.ndarray, np.ndarray]] = []
+    for start in range(0, len(queries), QUERY_BLOCK_SIZE):
+      # Score a block of queries with one matrix-matrix product.
+      similarities = queries[start : start + QUERY_BLOCK_SIZE] @ embeddings.T
+      indices = np.argpartition(similarities, -k, axis=1)[:, -k:]
+      topk_similarities = np.take_along_axis(similarities, indices, axis=1)
+      order = np.argsort(topk_similarities, axis=1)[:, ::-1]
+      indices = np.take_along_axis(indices, order, axis=1)
+      topk_similarities = np.take_along_axis(topk_similarities, order, axis=1)
+      if positions is not None:
+        indices = positions[indices]
+      results.extend(zip(indices, topk_similarities))
+    return results
+
+  def _topk_positions(
+    self, query: np.ndarray, k: int, positions: Optional[np.ndarray]
+  ) -> tuple[np.ndarray, np.ndarray]:
+    embeddings, _, _ = self._consolidate()
+    if positions is not None:
+      embeddings = embeddings.take(positions, axis=0)
 
     query = query.astype(embeddings.dtype)
     similarities: np.ndarray = np.dot(embeddings, query).reshape(-1)
     k = min(k, len(similarities))
+    if k <= 0:
+      return np.array([], dtype=np.int64), np.array([], dtype=similarities.dtype)
 
     # We do a partition + sort only top K to save time: O(n + klogk) instead of O(nlogn).
     indices = np.argpartition(similarities, -k)[-k:]
@@ -103,5 +241,26 @@ class NumpyVectorStore(VectorStore):
     indices = indices[np.argsort(similarities[indices])][::-1]
 
     topk_similarities = similarities[indices]
-    topk_keys = [keys[idx] for idx in indices]
-    return list(zip(topk_keys, topk_similarities))
+    if positions is not None:
+      indices = positions[indices]
+    return indices, topk_similarities
+
+
+def _save_segments(filepath: str, segments: Sequence[np.ndarray]) -> None:
+  """Save a list of arrays, concatenated along the first axis, as a single `.npy` file.
+
+  The segments are copied one at a time into a memory-mapped temporary file, which is then renamed.
+  The rename keeps memory-mapped readers of the previous file valid while the new one is written.
+  """
+  tmp_filepath = filepath + '.tmp'
+  shape = (sum(len(segment) for segment in segments), *segments[0].shape[1:])
+  out = np.lib.format.open_memmap(  # type: ignore
+    tmp_filepath, mode='w+', dtype=np.result_type(*segments), shape=shape
+  )
+  offset = 0
+  for segment in segments:
+    out[offset : offset + len(segment)] = segment
+    offset += len(segment)
+  out.flush()
+  del out
+  os.replace(tmp_filepath, filepath)
@@ -0,0 +1,134 @@
+"""QuantizedVectorStore class for storing vectors as int8 codes."""
+
+import os
+from typing import Optional
+
+import numpy as np
+from typing_extensions import override
+
+from ..schema import VectorKey
+from .vector_store_numpy import NumpyVectorStore
+
+_CODES_SUFFIX = '.codes.npy'
+_SCALES_SUFFIX = '.scales.npy'
+
+# The number of candidates, as a multiple of k, that are re-ranked with the float32 embeddings.
+RERANK_FACTOR = 4
+# The number of rows scored at once. This bounds the memory of the float32 copy of the codes, and
+# keeps the copy in the CPU cache.
+SCORE_BLOCK_SIZE = 4_096
+
+
+class QuantizedVectorStore(NumpyVectorStore):
+  """Stores vectors as int8 codes, with a float32 re-rank of the top candidates.
+
+  Each dimension is scalar-quantized to an int8 with its own scale, which is the largest absolute
+  value of that dimension divided by 127. Queries are scored against the codes, and the top
+  `RERANK_FACTOR * k` candidates are re-ranked exactly with the float32 embeddings.
+
+  The float32 embeddings are always memory-mapped when the store is loaded, so only the codes, a
+  quarter of the size of the embeddings, are held in RAM. `get()` returns the exact float32
+  embeddings.
+  """
+
+  name = 'quantized'
+
+  def __init__(self) -> None:
+    super().__init__()
+    # The int8 codes of the embeddings and the per-dimension scales. These are computed lazily, the
+    # first time we search the store.
+    self._codes: Optional[np.ndarray] = None
+    self._scales: Optional[np.ndarray] = None
+
+  @override
+  def save(self, base_path: str) -> None:
+    super().save(base_path)
+    codes, scales = self._get_codes()
+    for suffix, array in ((_CODES_SUFFIX, codes), (_SCALES_SUFFIX, scales)):
+      # Write to a temporary file and rename, which keeps memory-mapped readers valid.
+      with open(base_path + suffix + '.tmp', 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+      os.replace(base_path + suffix + '.tmp', base_path + suffix)
+
+  @override
+  def load(self, base_path: str) -> None:
+    super().load(base_path)
+    self._codes = None
+    self._scales = None
+    if os.path.exists(base_path + _CODES_SUFFIX):
+      self._codes = np.load(base_path + _CODES_SUFFIX, allow_pickle=False)
+      self._scales = np.load(base_path + _SCALES_SUFFIX, allow_pickle=False)
+
+  @override
+  def _load_embeddings(self, base_path: str, mmap_mode: Optional[str]) -> np.ndarray:
+    # The embeddings are only read for re-ranking and `get()`, so they always stay on disk.
+    return super()._load_embeddings(base_path, mmap_mode='r')
+
+  @override
+  def add(self, keys: list[VectorKey], embeddings: np.ndarray) -> None:
+    super().add(keys, embeddings)
+    self._codes = None
+    self._scales = None
+
+  def _get_codes(self) -> tuple[np.ndarray, np.ndarray]:
+    """Return the int8 codes of the embeddings, and the per-dimension scales."""
+    if self._codes is None or self._scales is None:
+      embeddings, _, _ = self._consolidate()
+      self._codes, self._scales = _quantize(embeddings)
+    return self._codes, self._scales
+
+  @override
+  def _topk_positions_batch(
+    self, queries: np.ndarray, k: int, positions: Optional[np.ndarray]
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    return [self._topk_positions(query, k, positions) for query in queries]
+
+  @override
+  def _topk_positions(
+    self, query: np.ndarray, k: int, positions: Optional[np.ndarray]
+  ) -> tuple[np.ndarray, np.ndarray]:
+    embeddings, _, _ = self._consolidate()
+    codes, scales = self._get_codes()
+    if positions is not None:
+      codes = codes.take(positions, axis=0)
+    k = min(k, len(codes))
+    if k <= 0:
+      return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    # Fold the scales into the query: sum(code * scale * query) = code . (scale * query).
+    query = query.astype(np.float32).reshape(-1)
+    scaled_query = scales * query
+    approx_similarities = np.empty(len(codes), dtype=np.float32)
+    block = np.empty((min(SCORE_BLOCK_SIZE, len(codes)), codes.shape[1]), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_BLOCK_SIZE):
+      end = min(start + SCORE_BLOCK_SIZE, len(codes))
+      block[: end - start] = codes[start:end]
+      np.dot(block[: end - start], scaled_query, out=approx_similarities[start:end])
+
+    num_candidates = min(k * RERANK_FACTOR, len(codes))
+    candidates = np.argpartition(approx_similarities, -num_candidates)[-num_candidates:]
+    if positions is not None:
+      candidates = positions[candidates]
+    # Sort the candidates so reads from the memory-mapped embeddings are sequential.
+    candidates = np.sort(candidates)
+
+    similarities = embeddings.take(candidates, axis=0) @ query
+    indices = np.argpartition(similarities, -k)[-k:]
+    indices = indices[np.argsort(similarities[indices])][::-1]
+    return candidates[indices], similarities[indices]
+
+
+def _quantize(embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """Quantize embeddings to int8 codes with per-dimension scales."""
+  scales = np.zeros(embeddings.shape[1], dtype=np.float32)
+  for start in range(0, len(embeddings), SCORE_BLOCK_SIZE):
+    block = np.abs(embeddings[start : start + SCORE_BLOCK_SIZE])
+    scales = np.maximum(scales, block.max(axis=0) / 127)
+  # Avoid dividing by zero for dimensions that are always zero.
+  scales[scales == 0] = 1
+
+  codes = np.empty(embeddings.shape, dtype=np.int8)
+  for start in range(0, len(embeddings), SCORE_BLOCK_SIZE):
+    block = embeddings[start : start + SCORE_BLOCK_SIZE] / scales
+    codes[start : start + SCORE_BLOCK_SIZE] = np.clip(np.rint(block), -127, 127)
+  return codes, scales
@@ -1,17 +1,54 @@
 """Tests the vector store interface."""
 
 import pathlib
-from typing import Type, cast
+import pickle
+import threading
+from typing import Optional, Type, cast
 
 import numpy as np
+import pandas as pd
 import pytest
+from pytest_mock import MockerFixture
 from sklearn.preprocessing import normalize
+from typing_extensions import override
 
+from ..schema import VectorKey
+from . import vector_store_hnsw, vector_store_ivf
 from .vector_store import VectorDBIndex, VectorStore
-from .vector_store_hnsw import HNSWVectorStore
+from .vector_store_hnsw import HNSWSettings, HNSWVectorStore
+from .vector_store_ivf import IVFVectorStore
 from .vector_store_numpy import NumpyVectorStore
+from .vector_store_quantized import QuantizedVectorStore
 
-ALL_STORES = [NumpyVectorStore, HNSWVectorStore]
+ALL_STORES = [NumpyVectorStore, HNSWVectorStore, QuantizedVectorStore, IVFVectorStore]
+
+
+class _KeyOnlyVectorStore(NumpyVectorStore):
+  """A vector store that can only be searched by key."""
+
+  @override
+  def get_positions(self, positions: np.ndarray) -> np.ndarray:
+    raise NotImplementedError
+
+  @override
+  def topk_positions(
+    self,
+    query: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    raise NotImplementedError
+
+  @override
+  def topk_positions_batch(
+    self,
+    queries: np.ndarray,
+    k: int,
+    positions: Optional[np.ndarray] = None,
+    ef: Optional[int] = None,
+  ) -> list[tuple[np.ndarray, np.ndarray]]:
+    raise NotImplementedError
 
 
 @pytest.mark.parametrize('store_cls', ALL_STORES)
@@ -98,6 +135,43 @@ class VectorStoreImplSuite:
     result = store.topk(query, k=10, keys=[('b', 0), ('a', 1), ('a', 0)])
     assert result == [(('a', 1), 9.0), (('a', 0), 8.0), (('b', 0), 3.0)]
 
+  def test_topk_batch(self, store_cls: Type[VectorStore]) -> None:
+    store = store_cls()
+    embedding = cast(np.ndarray, normalize(np.array([[1, 0], [0, 1], [1, 1]])))
+    store.add([('a',), ('b',), ('c',)], embedding)
+    queries = cast(np.ndarray, normalize(np.array([[0.9, 1], [1, 0], [0, 1]])))
+
+    results = store.topk_batch(queries, k=2)
+    assert [[key for key, _ in result] for result in results] == [
+      [('c',), ('b',)],
+      [('a',), ('c',)],
+      [('b',), ('c',)],
+    ]
+    assert results == [store.topk(query, k=2) for query in queries]
+
+    results = store.topk_batch(queries, k=2, keys=[('a',), ('b',)])
+    assert [[key for key, _ in result] for result in results] == [
+      [('b',), ('a',)],
+      [('a',), ('b',)],
+      [('b',), ('a',)],
+    ]
+
+  def test_topk_positions_batch(self, store_cls: Type[VectorStore]) -> None:
+    store = store_cls()
+    embedding = cast(np.ndarray, normalize(np.array([[1, 0], [0, 1], [1, 1]])))
+    store.add([('a',), ('b',), ('c',)], embedding)
+    queries = cast(np.ndarray, normalize(np.array([[0.9, 1], [1, 0], [0, 1]])))
+
+    for positions in (None, np.array([0, 1])):
+      results = store.topk_positions_batch(queries, k=2, positions=positions)
+      expected = [store.topk_positions(query, k=2, positions=positions) for query in queries]
+      assert len(results) == len(expected)
+      for (result_positions, result_scores), (expected_positions, expected_scores) in zip(
+        results, expected
+      ):
+        assert result_positions.tolist() == expected_positions.tolist()
+        assert result_scores.tolist() == pytest.approx(expected_scores.tolist())
+
 
 class VectorStoreWrapperSuite:
   def test_topk_with_missing_keys(self) -> None:
@@ -113,3 +187,444 @@ class VectorStoreWrapperSuite:
     query = np.array([1])
     result = store.topk(query, k=2, rowids=['a', 'b', 'c', 'd'])
     assert result == [(('c',), 12.0), (('b',), 10.0)]
+
+  @pytest.mark.parametrize('key_only_store', [False, True])
+  def test_topk_multiple_path_keys_per_row(self, key_only_store: bool) -> None:
+    store = VectorDBIndex('numpy')
+    if key_only_store:
+      store._vector_store = _KeyOnlyVectorStore()
+    all_spans = [
+      (('a', 0), [(0, 1), (1, 2)]),
+      (('a', 1), [(0, 1)]),
+      (('b', 0), [(0, 1)]),
+      (('c', 0), [(0, 1), (1, 2)]),
+    ]
+    embedding = np.array([[1], [5], [2], [4], [3], [0]])
+    store.add(all_spans, embedding)
+
+    query = np.array([1])
+    result = store.topk(query, k=2)
+    assert result == [(('a', 0), 5.0), (('b', 0), 4.0), (('a', 1), 2.0)]
+
+    result = store.topk(query, k=2, rowids=['c', 'b', 'd'])
+    assert result == [(('b', 0), 4.0), (('c', 0), 3.0)]
+
+    assert store.topk(query, k=2, rowids=['d']) == []
+
+  @pytest.mark.parametrize('key_only_store', [False, True])
+  def test_topk_batch(self, key_only_store: bool) -> None:
+    store = VectorDBIndex('numpy')
+    if key_only_store:
+      store._vector_store = _KeyOnlyVectorStore()
+    all_spans = [
+      (('a', 0), [(0, 1), (1, 2)]),
+      (('a', 1), [(0, 1)]),
+      (('b', 0), [(0, 1)]),
+      (('c', 0), [(0, 1), (1, 2)]),
+    ]
+    embedding = np.array([[1], [5], [2], [4], [3], [0]])
+    store.add(all_spans, embedding)
+
+    queries = np.array([[1], [-1]])
+    assert store.topk_batch(queries, k=2) == [
+      [(('a', 0), 5.0), (('b', 0), 4.0), (('a', 1), 2.0)],
+      [(('c', 0), 0.0), (('a', 0), -1.0), (('a', 1), -2.0)],
+    ]
+    assert store.topk_batch(queries, k=1, rowids=['c', 'b']) == [
+      [(('b', 0), 4.0)],
+      [(('c', 0), 0.0)],
+    ]
+    assert store.topk_batch(queries, k=2, rowids=['d']) == [[], []]
+
+  def test_topk_searches_more_spans_until_k_rows(self, mocker: MockerFixture) -> None:
+    store = VectorDBIndex('numpy')
+    # Row 'a' has many spans that are more similar to the query than any span of the other rows.
+    all_spans = [(('a',), [(i, i + 1) for i in range(20)])] + [
+      ((rowid,), [(0, 1)]) for rowid in ['b', 'c', 'd', 'e']
+    ]
+    embedding = np.array([[100 - i] for i in range(20)] + [[4], [3], [2], [1]])
+    store.add(all_spans, embedding)
+    topk_spy = mocker.spy(store, '_topk_positions_batch')
+
+    assert store.topk(np.array([1]), k=2) == [(('a',), 100.0), (('b',), 4.0)]
+    # The search starts from the mean number of spans per row, not from the 20 spans of 'a'.
+    assert [call.args[1] for call in topk_spy.call_args_list] == [10, 20, 24]
+
+    topk_spy.reset_mock()
+    assert store.topk(np.array([-1]), k=2) == [(('e',), -1.0), (('d',), -2.0)]
+    assert [call.args[1] for call in topk_spy.call_args_list] == [10]
+
+  def test_hnsw_settings_and_ef(self, tmp_path: pathlib.Path) -> None:
+    store = VectorDBIndex('hnsw', HNSWSettings(m=8, query_ef=10))
+    vector_store = cast(HNSWVectorStore, store.get_vector_store())
+    assert vector_store.settings == HNSWSettings(m=8, query_ef=10)
+
+    rng = np.random.default_rng(42)
+    embeddings = cast(np.ndarray, normalize(rng.normal(size=(500, 8)))).astype(np.float32)
+    store.add([((str(i),), [(0, 1)]) for i in range(500)], embeddings)
+
+    query = embeddings[0]
+    # With ef as large as the index, the search is exact.
+    expected = [
+      ((str(i),), pytest.approx(float(embeddings[i] @ query), abs=1e-5))
+      for i in np.argsort(embeddings @ query)[::-1][:20]
+    ]
+    assert store.topk(query, k=20, ef=500) == expected
+    assert store.topk_batch(query[np.newaxis], k=20, ef=500) == [expected]
+
+    # A query ef passed to a loaded index overrides the saved one. The build settings are kept.
+    store.save(str(tmp_path))
+    store = VectorDBIndex('hnsw', HNSWSettings(query_ef=30))
+    store.load(str(tmp_path))
+    vector_store = cast(HNSWVectorStore, store.get_vector_store())
+    assert vector_store.settings == HNSWSettings(m=8, query_ef=30)
+
+    with pytest.raises(ValueError, match='HNSW settings are not supported'):
+      VectorDBIndex('numpy', HNSWSettings())
+
+  @pytest.mark.parametrize('key_only_store', [False, True])
+  def test_get(self, key_only_store: bool) -> None:
+    store = VectorDBIndex('numpy')
+    if key_only_store:
+      store._vector_store = _KeyOnlyVectorStore()
+    all_spans = [
+      (('a', 0), [(0, 1), (1, 2)]),
+      (('a', 1), [(0, 3)]),
+      (('b', 0), [(2, 4)]),
+    ]
+    store.add(all_spans, np.array([[1], [2], [3], [4]]))
+
+    result = list(store.get([('b', 0), ('c', 0), ('a', 0)]))
+    assert [[sv['span'] for sv in span_vectors] for span_vectors in result] == [
+      [(2, 4)],
+      [],
+      [(0, 1), (1, 2)],
+    ]
+    assert [[sv['vector'].tolist() for sv in span_vectors] for span_vectors in result] == [
+      [[4]],
+      [],
+      [[1], [2]],
+    ]
+
+  def test_load_pickled_spans(self, tmp_path: pathlib.Path) -> None:
+    store = VectorDBIndex('numpy')
+    all_spans = [(('a',), [(0, 1), (1, 2)]), (('b',), [(0, 3)])]
+    store.add(all_spans, np.array([[1.0], [2.0], [3.0]]))
+    store.save(str(tmp_path))
+
+    # Older versions stored the spans as a pickled list.
+    for spans_file in tmp_path.glob('spans*.npy'):
+      spans_file.unlink()
+    with open(tmp_path / 'spans.pkl', 'wb') as f:
+      pickle.dump(all_spans, f)
+
+    loaded = VectorDBIndex('numpy')
+    loaded.load(str(tmp_path))
+    assert loaded.topk(np.array([1.0]), k=1) == [(('b',), 3.0)]
+    # The spans are migrated to arrays on load.
+    assert (tmp_path / 'spans.rowids.npy').exists()
+
+    loaded.save(str(tmp_path))
+    assert not (tmp_path / 'spans.pkl').exists()
+
+  def test_save_segments_load(self, tmp_path: pathlib.Path) -> None:
+    store = VectorDBIndex('numpy')
+    store.add([(('a',), [(0, 1), (2, 3)])], np.array([[1.0], [2.0]]))
+    store.save_segment(str(tmp_path))
+    store.add([(('b',), [(0, 1)])], np.array([[3.0]]))
+    store.save_segment(str(tmp_path))
+
+    assert not (tmp_path / 'spans.rowids.npy').exists()
+    assert (tmp_path / 'segments' / 'manifest.json').exists()
+
+    loaded = VectorDBIndex('numpy')
+    loaded.load(str(tmp_path))
+    assert loaded.get_vector_store().get().tolist() == [[1.0], [2.0], [3.0]]
+    assert loaded.topk(np.array([1.0]), k=2) == [(('b',), 3.0), (('a',), 2.0)]
+
+  def test_save_compacts_segments(self, tmp_path: pathlib.Path) -> None:
+    store = VectorDBIndex('numpy')
+    store.add([(('a',), [(0, 1)])], np.array([[1.0]]))
+    store.save_segment(str(tmp_path))
+    store.add([(('b',), [(0, 1)])], np.array([[2.0]]))
+    store.save(str(tmp_path))
+    assert not (tmp_path / 'segments').exists()
+
+    # Segments appended after a compaction are loaded on top of the compacted index.
+    store.add([(('c',), [(0, 1)])], np.array([[3.0]]))
+    store.save_segment(str(tmp_path))
+
+    loaded = VectorDBIndex('numpy')
+    loaded.load(str(tmp_path))
+    assert loaded.get_vector_store().get().tolist() == [[1.0], [2.0], [3.0]]
+
+  def test_new_index_ignores_stale_files(self, tmp_path: pathlib.Path) -> None:
+    old_store = VectorDBIndex('numpy')
+    old_store.add([(('a',), [(0, 1)]), (('b',), [(0, 1)])], np.array([[1.0], [2.0]]))
+    old_store.save(str(tmp_path))
+
+    store = VectorDBIndex('numpy')
+    store.add([(('c',), [(0, 1)])], np.array([[3.0]]))
+    store.save_segment(str(tmp_path))
+
+    loaded = VectorDBIndex('numpy')
+    loaded.load(str(tmp_path))
+    assert loaded.get_vector_store().get().tolist() == [[3.0]]
+
+
+class NumpyVectorStoreSuite:
+  def test_load_mmap(self, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv('VECTOR_STORE_MMAP', '1')
+    store = NumpyVectorStore()
+    store.add([('a', 0), ('b', 0), ('b', 1)], np.array([[1, 2], [3, 4], [5, 6]]))
+    store.save(str(tmp_path))
+
+    store = NumpyVectorStore()
+    store.load(str(tmp_path))
+
+    assert isinstance(store.get(), np.memmap)
+    np.testing.assert_array_equal(store.get([('b', 1), ('a', 0)]), np.array([[5, 6], [1, 2]]))
+    assert store.topk(np.array([0, 1]), k=2) == [(('b', 1), 6.0), (('b', 0), 4.0)]
+
+    # Adding to a memory-mapped store copies the data into RAM.
+    store.add([('c', 0)], np.array([[7, 8]]))
+    np.testing.assert_array_equal(store.get([('c', 0), ('a', 0)]), np.array([[7, 8], [1, 2]]))
+
+  def test_load_mmap_disabled(
+    self, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+  ) -> None:
+    monkeypatch.setenv('VECTOR_STORE_MMAP', '0')
+    store = NumpyVectorStore()
+    store.add([('a', 0)], np.array([[1, 2]]))
+    store.save(str(tmp_path))
+
+    store = NumpyVectorStore()
+    store.load(str(tmp_path))
+    assert not isinstance(store.get(), np.memmap)
+
+  def test_load_pickled_lookup(self, tmp_path: pathlib.Path) -> None:
+    # Older versions stored the key lookup as a pickled pandas series.
+    base_path = str(tmp_path / 'numpy')
+    np.save(base_path + '.matrix.npy', np.array([[1, 2], [3, 4]], dtype=np.float32))
+    pd.Series([0, 1], index=[('a', 0), ('b', 0)], dtype=np.int32).to_pickle(
+      base_path + '.lookup.pkl'
+    )
+
+    store = NumpyVectorStore()
+    store.load(base_path)
+
+    np.testing.assert_array_equal(store.get([('b', 0)]), np.array([[3, 4]]))
+    assert store.topk(np.array([1, 0]), k=1) == [(('b', 0), 3.0)]
+
+  def test_add_many_chunks_save_load(self, tmp_path: pathlib.Path) -> None:
+    store = NumpyVectorStore()
+    embeddings = np.arange(200, dtype=np.float32).reshape(100, 2)
+    keys: list[VectorKey] = [(f'row{i}', i % 3) for i in range(100)]
+    for i in range(0, 100, 7):
+      store.add(keys[i : i + 7], embeddings[i : i + 7])
+      # Saving in between adds writes all the chunks added so far.
+      store.save(str(tmp_path))
+    assert store.size() == 100
+
+    store = NumpyVectorStore()
+    store.load(str(tmp_path))
+    np.testing.assert_array_equal(store.get(), embeddings)
+    np.testing.assert_array_equal(store.get([('row42', 0), ('row7', 1)]), embeddings[[42, 7]])
+    assert store.topk(np.array([0, 1]), k=1) == [(('row99', 0), 199.0)]
+
+  def test_add_keys_of_different_lengths(self) -> None:
+    store = NumpyVectorStore()
+    with pytest.raises(ValueError, match='same length'):
+      store.add([('a', 0), ('b',)], np.array([[1, 2], [3, 4]]))
+
+
+class HNSWVectorStoreSuite:
+  def test_settings_save_load(self, tmp_path: pathlib.Path) -> None:
+    store = HNSWVectorStore(HNSWSettings(m=8, construction_ef=40, query_ef=20))
+    store.add([('a',), ('b',), ('c',)], np.array([[1, 0], [0, 1], [1, 1]]))
+    store.save(str(tmp_path))
+
+    store = HNSWVectorStore()
+    store.load(str(tmp_path))
+    assert store.settings == HNSWSettings(m=8, construction_ef=40, query_ef=20)
+
+  def test_topk_per_query_ef(self) -> None:
+    rng = np.random.default_rng(42)
+    embeddings = cast(np.ndarray, normalize(rng.normal(size=(500, 8)))).astype(np.float32)
+    store = HNSWVectorStore(HNSWSettings(query_ef=10))
+    store.add([(str(i),) for i in range(500)], embeddings)
+
+    query = embeddings[0]
+    # With ef as large as the index, the search is exact.
+    positions, _ = store.topk_positions(query, k=20, ef=500)
+    assert positions.tolist() == np.argsort(embeddings @ query)[::-1][:20].tolist()
+    assert store.topk(query, k=1, ef=500)[0][0] == ('0',)
+    # The default ef is restored after the query.
+    assert store._index is not None and store._index.ef == 10
+
+  @pytest.mark.parametrize(
+    'exact_search_limit,max_filter_candidates,filter_oversampling',
+    [(10_000, 1_000, 2), (0, 10_000, 2), (0, 10_000, 0.1), (0, 0, 2)],
+    ids=['exact', 'oversampled', 'oversampled_retry', 'exact_blocks'],
+  )
+  def test_topk_filtered(
+    self,
+    exact_search_limit: int,
+    max_filter_candidates: int,
+    filter_oversampling: float,
+    monkeypatch: pytest.MonkeyPatch,
+    mocker: MockerFixture,
+  ) -> None:
+    monkeypatch.setattr(vector_store_hnsw, 'EXACT_SEARCH_LIMIT', exact_search_limit)
+    monkeypatch.setattr(vector_store_hnsw, 'MAX_FILTER_CANDIDATES', max_filter_candidates)
+    monkeypatch.setattr(vector_store_hnsw, 'FILTER_OVERSAMPLING', filter_oversampling)
+    monkeypatch.setattr(vector_store_hnsw, 'EXACT_SEARCH_BLOCK_SIZE', 16)
+    rng = np.random.default_rng(42)
+    embeddings = cast(np.ndarray, normalize(rng.normal(size=(500, 8)))).astype(np.float32)
+    store = HNSWVectorStore()
+    store.add([(str(i),) for i in range(500)], embeddings)
+
+    keys: list[VectorKey] = [(str(i),) for i in range(0, 500, 10)]
+    result = store.topk(embeddings[1], k=5, keys=keys)
+    assert len(result) == 5
+    assert all(int(cast(str, key[0])) % 10 == 0 for key, _ in result)
+
+    positions, _ = store.topk_positions(embeddings[1], k=5, positions=np.arange(0, 500, 10))
+    assert [(str(position),) for position in positions.tolist()] == [key for key, _ in result]
+    assert store.topk(embeddings[1], k=5, keys=[]) == []
+
+    # The search over 50 of 500 vectors with ef=500 finds the exact top k, however it is done.
+    knn_query_spy = mocker.spy(store, '_knn_query')
+    positions, _ = store.topk_positions(embeddings[1], k=5, positions=np.arange(0, 500, 10), ef=500)
+    exact_positions = np.arange(0, 500, 10)[np.argsort(embeddings[::10] @ embeddings[1])[::-1][:5]]
+    assert positions.tolist() == exact_positions.tolist()
+    # Too few oversampled results are left after filtering, so the graph is searched again.
+    assert (knn_query_spy.call_count > 1) == (filter_oversampling < 1)
+
+  def test_concurrent_queries(self) -> None:
+    store = HNSWVectorStore()
+    store.add([('a',), ('b',)], np.array([[1.0, 0.0], [0.0, 1.0]]))
+
+    # Queries share the lock, so a query can run while another query holds it.
+    with store._lock.read():
+      result = store.topk(np.array([1.0, 0.0]), k=1)
+    assert result == [(('a',), pytest.approx(1.0))]
+
+    # Writes wait for the queries to finish.
+    added = threading.Event()
+
+    def add() -> None:
+      store.add([('c',)], np.array([[1.0, 1.0]]))
+      added.set()
+
+    with store._lock.read():
+      thread = threading.Thread(target=add)
+      thread.start()
+      assert not added.wait(timeout=0.1)
+    thread.join()
+    assert store.size() == 3
+
+
+class QuantizedVectorStoreSuite:
+  def test_save_load(self, tmp_path: pathlib.Path) -> None:
+    store = QuantizedVectorStore()
+    embeddings = np.random.default_rng(42).normal(size=(100, 8)).astype(np.float32)
+    store.add([(str(i),) for i in range(100)], embeddings)
+    store.save(str(tmp_path))
+
+    store = QuantizedVectorStore()
+    store.load(str(tmp_path))
+
+    # The float32 embeddings stay on disk, and only the int8 codes are read into memory.
+    assert isinstance(store.get(), np.memmap)
+    assert store._codes is not None and store._codes.dtype == np.int8
+    np.testing.assert_array_equal(store.get([('3',), ('7',)]), embeddings[[3, 7]])
+
+  def test_topk_matches_exact_search(self) -> None:
+    rng = np.random.default_rng(42)
+    embeddings = cast(np.ndarray, normalize(rng.normal(size=(1000, 16)))).astype(np.float32)
+    keys: list[VectorKey] = [(str(i),) for i in range(1000)]
+    quantized_store = QuantizedVectorStore()
+    quantized_store.add(keys, embeddings)
+    numpy_store = NumpyVectorStore()
+    numpy_store.add(keys, embeddings)
+
+    query = embeddings[0] + rng.normal(scale=0.1, size=16)
+    quantized_result = quantized_store.topk(query, k=10)
+    numpy_result = numpy_store.topk(query, k=10)
+    assert [key for key, _ in quantized_result] == [key for key, _ in numpy_result]
+    # Scores are re-ranked with the float32 embeddings, so they are exact.
+    assert [score for _, score in quantized_result] == pytest.approx(
+      [score for _, score in numpy_result], abs=1e-6
+    )
+
+
+class IVFVectorStoreSuite:
+  @pytest.fixture(autouse=True)
+  def set_min_index_size(self, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(vector_store_ivf, 'MIN_INDEX_SIZE', 100)
+
+  def _clustered_embeddings(self, num_vectors: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(8, 16))
+    embeddings = centers[rng.integers(0, 8, size=num_vectors)] + rng.normal(
+      scale=0.1, size=(num_vectors, 16)
+    )
+    return cast(np.ndarray, normalize(embeddings)).astype(np.float32)
+
+  def test_save_load_topk(self, tmp_path: pathlib.Path) -> None:
+    embeddings = self._clustered_embeddings(1000, seed=42)
+    keys: list[VectorKey] = [(str(i),) for i in range(1000)]
+    store = IVFVectorStore()
+    store.add(keys, embeddings)
+    store.save(str(tmp_path))
+
+    store = IVFVectorStore()
+    store.load(str(tmp_path))
+    assert isinstance(store._list_vectors, np.memmap)
+
+    numpy_store = NumpyVectorStore()
+    numpy_store.add(keys, embeddings)
+    # Probing every list is an exhaustive search.
+    store.nprobe = 1000
+    query = embeddings[0]
+    assert [key for key, _ in store.topk(query, k=10)] == [
+      key for key, _ in numpy_store.topk(query, k=10)
+    ]
+
+    store.nprobe = 2
+    result = store.topk(query, k=10)
+    assert len(result) == 10
+    assert result[0] == (('0',), pytest.approx(1.0))
+
+  def test_add_after_load(self, tmp_path: pathlib.Path) -> None:
+    embeddings = self._clustered_embeddings(1000, seed=42)
+    store = IVFVectorStore()
+    store.add([(str(i),) for i in range(1000)], embeddings)
+    store.save(str(tmp_path))
+
+    store = IVFVectorStore()
+    store.load(str(tmp_path))
+    new_embeddings = self._clustered_embeddings(10, seed=0)
+    store.add([(f'new{i}',) for i in range(10)], new_embeddings)
+
+    # New vectors are found before they are assigned to a list.
+    assert store.topk(new_embeddings[3], k=1)[0][0] == ('new3',)
+
+    # Saving assigns the new vectors to the existing lists.
+    centroids = store._centroids
+    store.save(str(tmp_path))
+    assert store._centroids is centroids
+    assert store._list_positions is not None and len(store._list_positions) == 1010
+    assert store.topk(new_embeddings[3], k=1)[0][0] == ('new3',)
+
+  def test_topk_with_keys(self, tmp_path: pathlib.Path) -> None:
+    embeddings = self._clustered_embeddings(1000, seed=42)
+    store = IVFVectorStore()
+    store.add([(str(i),) for i in range(1000)], embeddings)
+    store.save(str(tmp_path))
+
+    keys: list[VectorKey] = [(str(i),) for i in range(0, 1000, 2)]
+    result = store.topk(embeddings[1], k=5, keys=keys)
+    assert len(result) == 5
+    assert all(int(cast(str, key[0])) % 2 == 0 for key, _ in result)
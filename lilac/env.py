@@ -63,6 +63,13 @@ class LilacEnvironment(BaseModel):
     'take more RAM but be much faster during query time.'
   )
 
+  # Vector stores.
+  VECTOR_STORE_MMAP: str = PydanticField(
+    description='When set to 1, the numpy vector store memory-maps embedding indices from disk '
+    'instead of reading them into RAM. Multiple server or dask processes then share a single '
+    'page-cached copy of each index, and loading an index is nearly instant.'
+  )
+
   # Authentication.
   LILAC_AUTH_ENABLED: str = PydanticField(
     description='Set to true to enable read-only mode, disabling the ability to add datasets & '
@@ -1,6 +1,7 @@
 """Router for the dataset database."""
 import os
 from copy import copy
+from datetime import datetime
 from typing import Annotated, Any, Literal, Optional, Sequence, Union, cast
 
 from fastapi import APIRouter, HTTPException, Response
@@ -153,6 +154,7 @@ class SelectRowsOptions(BaseModel):
   limit: Optional[int] = None
   offset: Optional[int] = None
   combine_columns: Optional[bool] = None
+  cursor: Optional[str] = None
 
 
 class SelectRowsSchemaOptions(BaseModel):
@@ -170,13 +172,20 @@ class SelectRowsResponse(BaseModel):
 
   rows: list[dict]
   total_num_rows: int
+  next_cursor: Optional[str] = None
 
 
 def _exclude_none(obj: Any) -> Any:
+  """Drop `None` values and convert the rest to values that orjson serializes like pydantic."""
   if isinstance(obj, dict):
     return {k: _exclude_none(v) for k, v in obj.items() if v is not None}
   if isinstance(obj, list):
     return [_exclude_none(v) for v in obj]
+  if isinstance(obj, datetime):
+    # Also covers pandas timestamps, which orjson doesn't serialize.
+    return obj.isoformat()
+  if isinstance(obj, bytes):
+    return obj.decode('utf-8')
   return copy(obj)
 
 
@@ -204,10 +213,17 @@ def select_rows(
     offset=options.offset,
     combine_columns=options.combine_columns or False,
     user=user,
+    cursor=options.cursor,
   )
 
-  rows = [_exclude_none(row) for row in res]
-  return SelectRowsResponse(rows=rows, total_num_rows=res.total_num_rows)
+  response: dict[str, Any] = {
+    'rows': [_exclude_none(row) for row in res],
+    'total_num_rows': res.total_num_rows,
+  }
+  if res.next_cursor is not None:
+    response['next_cursor'] = res.next_cursor
+  # The rows are already JSON-ready, so skip validating them against the response model.
+  return cast(SelectRowsResponse, ORJSONResponse(response))
 
 
 @router.post('/{namespace}/{dataset_name}/select_rows_schema', response_model_exclude_none=True)
@@ -234,6 +250,8 @@ class SelectGroupsOptions(BaseModel):
   sort_order: Optional[SortOrder] = SortOrder.DESC
   limit: Optional[int] = 100
   bins: Optional[list[Bin]] = None
+  include_deleted: bool = False
+  approximate: bool = False
 
 
 @router.post('/{namespace}/{dataset_name}/select_groups')
@@ -252,6 +270,40 @@ def select_groups(
     options.sort_order,
     options.limit,
     options.bins,
+    include_deleted=options.include_deleted,
+    approximate=options.approximate,
+  )
+
+
+class SelectGroupsManyOptions(BaseModel):
+  """The request for the select groups many endpoint."""
+
+  leaf_paths: list[Path]
+  filters: Sequence[Filter] = []
+  sort_by: Optional[GroupsSortBy] = GroupsSortBy.COUNT
+  sort_order: Optional[SortOrder] = SortOrder.DESC
+  limit: Optional[int] = 100
+  include_deleted: bool = False
+  approximate: bool = False
+
+
+@router.post('/{namespace}/{dataset_name}/select_groups_many')
+def select_groups_many(
+  namespace: str, dataset_name: str, options: SelectGroupsManyOptions
+) -> list[SelectGroupsResult]:
+  """Select the groups of many leafs from the dataset database in one pass."""
+  dataset = get_dataset(namespace, dataset_name)
+  sanitized_filters = [
+    PyFilter(path=normalize_path(f.path), op=f.op, value=f.value) for f in (options.filters or [])
+  ]
+  return dataset.select_groups_many(
+    options.leaf_paths,
+    sanitized_filters,
+    options.sort_by,
+    options.sort_order,
+    options.limit,
+    include_deleted=options.include_deleted,
+    approximate=options.approximate,
   )
 
 
@@ -4,13 +4,16 @@ import asyncio
 import builtins
 import functools
 import multiprocessing
+import os
 import random
+import threading
 import time
 import traceback
 import uuid
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from enum import Enum
+from multiprocessing.queues import SimpleQueue
 from types import TracebackType
 from typing import (
   Any,
@@ -26,6 +29,7 @@ from typing import (
   cast,
 )
 
+import cloudpickle
 import dask
 import nest_asyncio
 import psutil
@@ -89,7 +93,7 @@ class TaskStepInfo(BaseModel):
   shard_progresses: list[tuple[int, tuple[int, int]]] = []
 
 
-TaskExecutionType = Literal['processes', 'threads']
+TaskExecutionType = Literal['processes', 'threads', 'process_pool']
 
 
 class TaskInfo(BaseModel):
@@ -129,13 +133,14 @@ class TaskManager:
 
   # Maps task_ids to their dask futures.
   _dask_futures: dict[str, list[DaskFuture]] = {}
-  # Maps thread task_ids to their futures.
+  # Maps thread and process pool task_ids to their futures.
   _thread_futures: dict[str, list[Future]] = {}
 
   # Maps a task_id to the count of shard completions.
   _task_shard_completions: dict[str, int] = {}
 
   _task_threadpools: dict[str, ThreadPoolExecutor] = {}
+  _task_process_pools: dict[str, ProcessPoolExecutor] = {}
 
   def __init__(self, dask_client: Optional[Client] = None) -> None:
     """By default, use a dask multi-processing client.
@@ -172,6 +177,10 @@ class TaskManager:
           # Clean up threaded events.
           if task_progress_topic in THREADED_EVENTS:
             del THREADED_EVENTS[task_progress_topic]
+        process_pool = self._task_process_pools.pop(task_id, None)
+        if process_pool:
+          # This can run in a callback thread of the pool, which can't wait for the pool to exit.
+          process_pool.shutdown(wait=False)
         continue
 
       if task_id in self._dask_futures:
@@ -271,11 +280,29 @@ class TaskManager:
             task_error = asyncio.get_event_loop().run_until_complete(task_error)
           raise task_error
 
-    # Wait for all thread futures.
+    # Wait for all thread and process pool futures.
     if thread_futures:
       for future in thread_futures:
         future.result()
 
+    # The processes of a pool are only used by one task, so they exit once it is done.
+    for task_id in task_ids:
+      process_pool = self._task_process_pools.pop(task_id, None)
+      if process_pool:
+        process_pool.shutdown()
+
+  def wait_shard(self, task_id: str, shard_id: int) -> None:
+    """Wait until a shard of a task from `execute_sharded` is completed, successfully or not.
+
+    Unlike `wait`, this does not raise the error of the shard, so it can be called from any thread.
+    """
+    # The futures of a dask task are removed once every shard is completed.
+    for dask_future in self._dask_futures.get(task_id, [])[shard_id : shard_id + 1]:
+      while not dask_future.done():
+        time.sleep(0.1)
+    for thread_future in self._thread_futures.get(task_id, [])[shard_id : shard_id + 1]:
+      thread_future.exception()
+
   def task_id(
     self,
     name: str,
@@ -366,6 +393,18 @@ class TaskManager:
       task_future.add_done_callback(
         lambda task_future: self._set_task_completed(task_id, task_future)
       )
+    elif type == 'process_pool':
+      if task_id in self._task_process_pools:
+        raise ValueError(f'Task {task_id} already exists.')
+      self._task_process_pools[task_id] = _create_process_pool(max_workers=1)
+      task_future = self._task_process_pools[task_id].submit(
+        _execute_pickled_task, cloudpickle.dumps((task, args))
+      )
+
+      task_future.add_done_callback(
+        lambda task_future: self._set_task_completed(task_id, task_future)
+      )
+      self._thread_futures[task_id] = [task_future]
 
   def execute_sharded(
     self,
@@ -374,7 +413,7 @@ class TaskManager:
     subtasks: list[tuple[TaskFn, list[Any]]],
   ) -> None:
     """Execute a task in multiple shards."""
-    if task_id in self._task_threadpools:
+    if task_id in self._task_threadpools or task_id in self._task_process_pools:
       raise ValueError(f'Task {task_id} already exists.')
 
     task_info = self._tasks[task_id]
@@ -384,6 +423,8 @@ class TaskManager:
     # Create the threadpool.
     if type == 'threads':
       self._task_threadpools[task_id] = ThreadPoolExecutor(max_workers=len(subtasks))
+    elif type == 'process_pool':
+      self._task_process_pools[task_id] = _create_process_pool(max_workers=len(subtasks))
 
     for i, (task, args) in enumerate(subtasks):
       if type == 'processes':
@@ -403,6 +444,19 @@ class TaskManager:
       elif type == 'threads':
         task_future = self._task_threadpools[task_id].submit(task, *args)
 
+        task_future.add_done_callback(
+          lambda task_future: self._set_task_shard_completed(
+            task_id, task_future, num_shards=len(subtasks)
+          )
+        )
+        thread_futures.append(task_future)
+      elif type == 'process_pool':
+        # Only the pickled task and its arguments are sent to the process, e.g. a dataset pickles
+        # to its constructor arguments, so each process opens the dataset's files itself.
+        task_future = self._task_process_pools[task_id].submit(
+          _execute_pickled_task, cloudpickle.dumps((task, args))
+        )
+
         task_future.add_done_callback(
           lambda task_future: self._set_task_shard_completed(
             task_id, task_future, num_shards=len(subtasks)
@@ -441,6 +495,82 @@ def get_is_dask_worker() -> bool:
     return False
 
 
+# Whether the current process is a worker of a process pool. Set by the initializer of the pool.
+_IS_PROCESS_POOL_WORKER = False
+# The queue a process pool worker sends its progress updates on, to the process of the task manager.
+_PROCESS_POOL_PROGRESS_QUEUE: Optional['SimpleQueue[Any]'] = None
+
+
+def get_is_process_pool_worker() -> bool:
+  """Returns True if the current process is a worker of a 'process_pool' task."""
+  return _IS_PROCESS_POOL_WORKER
+
+
+def _init_process_pool_worker(environ: dict[str, str], progress_queue: 'SimpleQueue[Any]') -> None:
+  global _IS_PROCESS_POOL_WORKER, _PROCESS_POOL_PROGRESS_QUEUE
+  _IS_PROCESS_POOL_WORKER = True
+  _PROCESS_POOL_PROGRESS_QUEUE = progress_queue
+  # The fork server may have started before the environment of this process changed, e.g. with
+  # `set_project_dir`.
+  os.environ.update(environ)
+
+
+class _ProcessPool(ProcessPoolExecutor):
+  """A process pool whose workers report their progress to the task manager of this process.
+
+  The progress of a task is kept in `THREADED_EVENTS` of this process, so a thread applies the
+  progress updates the workers send on a queue.
+  """
+
+  def __init__(self, max_workers: int, mp_context: multiprocessing.context.BaseContext) -> None:
+    self._progress_queue = mp_context.SimpleQueue()
+    super().__init__(
+      max_workers=max_workers,
+      mp_context=mp_context,
+      initializer=_init_process_pool_worker,
+      initargs=(dict(os.environ), self._progress_queue),
+    )
+    self._progress_thread = threading.Thread(target=self._apply_progress_updates, daemon=True)
+    self._progress_thread.start()
+
+  def _apply_progress_updates(self) -> None:
+    while (update := self._progress_queue.get()) is not None:
+      progress_fn, args, kwargs = update
+      try:
+        progress_fn(*args, **kwargs)
+      except Exception as e:
+        # Keep applying updates, so the workers never block on a full queue.
+        log(f'Failed to update the progress of a task: {e}')
+
+  def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+    super().shutdown(wait=wait, cancel_futures=cancel_futures)
+    # Apply the updates that were sent before the pool shut down.
+    self._progress_queue.put(None)
+    self._progress_thread.join()
+
+
+def _create_process_pool(max_workers: int) -> ProcessPoolExecutor:
+  """Creates a process pool for a single task."""
+  # The processes are not forked from this process, since that copies the locks of its threads, e.g.
+  # of the dask client and the duckdb connections, in whatever state they are in. When available,
+  # they are forked from a server process that imported lilac once, instead of spawning each one and
+  # importing lilac again.
+  mp_context: multiprocessing.context.BaseContext
+  if 'forkserver' in multiprocessing.get_all_start_methods():
+    forkserver_context = multiprocessing.get_context('forkserver')
+    forkserver_context.set_forkserver_preload([__name__.split('.')[0]])
+    mp_context = forkserver_context
+  else:
+    mp_context = multiprocessing.get_context('spawn')
+  return _ProcessPool(max_workers=max_workers, mp_context=mp_context)
+
+
+def _execute_pickled_task(pickled_task: bytes) -> None:
+  """Executes a task pickled with cloudpickle, so it can be a closure or a bound method."""
+  task, args = cloudpickle.loads(pickled_task)
+  task(*args)
+
+
 _TASK_MANAGER: Optional[TaskManager] = None
 
 
@@ -574,18 +704,7 @@ def report_progress(
     yield from it
     return
 
-  task_id, step_id = task_step_id
-
-  steps = get_worker_steps(task_id)
-  if not steps:
-    steps = [TaskStepInfo(description=step_description, progress=0.0)]
-  elif len(steps) <= step_id:
-    # If the step given exceeds the length of the last step, add a new step.
-    steps.append(TaskStepInfo(description=step_description, progress=0.0))
-  else:
-    steps[step_id].description = step_description
-    steps[step_id].progress = 0.0
-  set_worker_steps(task_id, steps)
+  _update_progress(_start_worker_step, task_step_id, step_description)
 
   estimated_len = max(1, estimated_len) if estimated_len else None
 
@@ -604,7 +723,8 @@ def report_progress(
     if estimated_len and cur_time - last_emit > emit_every_sec:
       elapsed_sec = cur_time - start_time
       it_per_sec = ((it_idx or 0) - (initial_id or 0.0)) / elapsed_sec
-      set_worker_task_progress(
+      _update_progress(
+        set_worker_task_progress,
         task_step_id=task_step_id,
         shard_id=shard_id,
         it_idx=it_idx,
@@ -618,7 +738,8 @@ def report_progress(
     it_idx += 1
 
   total_time = time.time() - start_time
-  set_worker_task_progress(
+  _update_progress(
+    set_worker_task_progress,
     task_step_id=task_step_id,
     it_idx=estimated_len if estimated_len else it_idx,
     shard_id=shard_id,
@@ -629,6 +750,32 @@ def report_progress(
   )
 
 
+def _update_progress(progress_fn: Callable[..., None], *args: Any, **kwargs: Any) -> None:
+  """Updates the progress of a task where the progress of all its shards is kept.
+
+  A process pool worker only sees its own shard, so it sends the update to the task manager.
+  """
+  if _PROCESS_POOL_PROGRESS_QUEUE is not None:
+    _PROCESS_POOL_PROGRESS_QUEUE.put((progress_fn, args, kwargs))
+  else:
+    progress_fn(*args, **kwargs)
+
+
+def _start_worker_step(task_step_id: TaskStepId, step_description: Optional[str]) -> None:
+  """Starts a step of a task, adding it if it doesn't exist yet."""
+  task_id, step_id = task_step_id
+  steps = get_worker_steps(task_id)
+  if not steps:
+    steps = [TaskStepInfo(description=step_description, progress=0.0)]
+  elif len(steps) <= step_id:
+    # If the step given exceeds the length of the last step, add a new step.
+    steps.append(TaskStepInfo(description=step_description, progress=0.0))
+  else:
+    steps[step_id].description = step_description
+    steps[step_id].progress = 0.0
+  set_worker_steps(task_id, steps)
+
+
 # These methods wrap the dask events so that we can use them in threads (global state) or in dask
 # using dask events.
 THREADED_EVENTS: dict[str, list[Any]] = {}
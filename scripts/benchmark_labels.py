@@ -0,0 +1,56 @@
+"""Benchmarks bulk labeling of a large dataset.
+
+Usage:
+poetry run python -m scripts.benchmark_labels
+
+Add:
+  --num_rows to change the size of the dataset.
+
+Labels are written through DuckDB's sqlite extension, which is downloaded the first time it is
+used.
+"""
+
+import os
+import tempfile
+
+import click
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lilac.config import DatasetConfig
+from lilac.load_dataset import create_dataset
+from lilac.schema import ROWID
+from lilac.sources.parquet_source import ParquetSource
+from lilac.utils import DebugTimer
+
+
+@click.command()
+@click.option(
+  '--num_rows', help='The number of rows to label.', type=int, default=1_000_000, show_default=True
+)
+def main(num_rows: int) -> None:
+  """Time set-based label writes, and reading the joined table afterwards."""
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    source_path = os.path.join(tmp_dir, 'source.parquet')
+    pq.write_table(pa.table({'text': [f'row {i}' for i in range(num_rows)]}), source_path)
+    config = DatasetConfig(
+      namespace='local', name='labels_benchmark', source=ParquetSource(filepaths=[source_path])
+    )
+    dataset = create_dataset(config, project_dir=tmp_dir)
+    dataset.manifest()
+
+    row_ids = [row[ROWID] for row in dataset.select_rows([ROWID])]
+
+    with DebugTimer(f'Labeling {num_rows:,} rows by filter'):
+      dataset.add_labels('filtered', filters=[('text', 'exists')])
+    with DebugTimer(f'Labeling {num_rows:,} rows by rowid'):
+      dataset.add_labels('by_rowid', row_ids=row_ids)
+    with DebugTimer(f'Relabeling {num_rows:,} rows by rowid'):
+      dataset.add_labels('by_rowid', row_ids=row_ids, value='false')
+    with DebugTimer('Rebuilding the joined table after labeling'):
+      dataset.manifest()
+    with DebugTimer(f'Removing {num_rows:,} labels by rowid'):
+      dataset.remove_labels('by_rowid', row_ids=row_ids)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+"""Benchmarks how reading the input of a sharded map scales with the number of shards.
+
+Usage:
+poetry run python -m scripts.benchmark_map_sharding
+
+Add:
+  --num_rows to change the size of the dataset.
+  --shard_counts to change the number of shards to time, comma separated.
+"""
+
+import os
+import tempfile
+import time
+
+import click
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lilac.config import DatasetConfig
+from lilac.data.dataset_duckdb import DatasetDuckDB, DuckDBQueryParams
+from lilac.load_dataset import create_dataset
+from lilac.sources.parquet_source import ParquetSource
+
+
+@click.command()
+@click.option(
+  '--num_rows',
+  help='The number of rows in the dataset.',
+  type=int,
+  default=2_000_000,
+  show_default=True,
+)
+@click.option(
+  '--shard_counts',
+  help='The shard counts to time, comma separated.',
+  type=str,
+  default='1,2,4,8,16,32,64',
+  show_default=True,
+)
+def main(num_rows: int, shard_counts: str) -> None:
+  """Time reading every shard of a map input, with and without a limit.
+
+  Without a limit, each shard reads a range of positions. With a limit, each shard is an offset
+  into the rows sorted by rowid, which was the only strategy before.
+  """
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    source_path = os.path.join(tmp_dir, 'source.parquet')
+    pq.write_table(pa.table({'text': [f'row {i}' for i in range(num_rows)]}), source_path)
+    config = DatasetConfig(
+      namespace='local', name='sharding_benchmark', source=ParquetSource(filepaths=[source_path])
+    )
+    dataset = create_dataset(config, project_dir=tmp_dir)
+    assert isinstance(dataset, DatasetDuckDB)
+    dataset.manifest()
+
+    # The total is the work of all the shards. The slowest shard bounds the time of the map when
+    # every shard runs in parallel, so it should shrink linearly with the number of shards.
+    print('shards | positions: total, slowest shard (s) | rowid offsets: total, slowest shard (s)')
+    for shard_count in [int(count) for count in shard_counts.split(',')]:
+      position_total, position_slowest = _time_shards(dataset, shard_count, DuckDBQueryParams())
+      offset_total, offset_slowest = _time_shards(
+        dataset, shard_count, DuckDBQueryParams(limit=num_rows)
+      )
+      print(
+        f'{shard_count:>6} | {position_total:>10.2f} {position_slowest:>10.2f} | '
+        f'{offset_total:>10.2f} {offset_slowest:>10.2f}'
+      )
+
+
+def _time_shards(
+  dataset: DatasetDuckDB, shard_count: int, query_options: DuckDBQueryParams
+) -> tuple[float, float]:
+  """Returns the total seconds to read the input of every shard, and of the slowest shard."""
+  shard_times: list[float] = []
+  num_rows = 0
+  for shard_id in range(shard_count):
+    start = time.perf_counter()
+    rows = dataset._select_iterable_values(
+      unnest_input_path=('text',),
+      query_options=query_options,
+      shard_id=shard_id,
+      shard_count=shard_count,
+    )
+    num_rows += sum(1 for _ in rows)
+    shard_times.append(time.perf_counter() - start)
+  assert num_rows == dataset.manifest().num_items
+  return sum(shard_times), max(shard_times)
+
+
+if __name__ == '__main__':
+  main()
@@ -7,10 +7,14 @@ import {
   deserializeRow,
   deserializeSchema,
   getSchemaLabels,
+  serializePath,
   type AddLabelsOptions,
   type LilacSchema,
   type Path,
   type RemoveLabelsOptions,
+  type SelectGroupsManyOptions,
+  type SelectGroupsOptions,
+  type SelectGroupsResult,
   type SelectRowsOptions,
   type SelectRowsResponse
 } from '$lilac';
@@ -204,7 +208,59 @@ export const querySelectRowsSchema = createApiQuery(
   }
 );
 
-export const querySelectGroups = createApiQuery(DatasetsService.selectGroups, DATASETS_TAG);
+const SELECT_GROUPS_BATCH_WINDOW_MS = 10;
+type LeafPath = SelectGroupsOptions['leaf_path'];
+// Create a cache of the batcher so we reuse the same batcher for the same dataset and options.
+const batchedSelectGroupsCache: Record<
+  string,
+  Batcher<Record<string, SelectGroupsResult>, LeafPath, SelectGroupsResult>
+> = {};
+function getSelectGroupsBatcher(
+  namespace: string,
+  datasetName: string,
+  selectGroupsManyOptions: Omit<SelectGroupsManyOptions, 'leaf_paths'>
+): Batcher<Record<string, SelectGroupsResult>, LeafPath, SelectGroupsResult> {
+  const key = `${namespace}/${datasetName}/${JSON.stringify(selectGroupsManyOptions)}`;
+  if (batchedSelectGroupsCache[key] == null) {
+    batchedSelectGroupsCache[key] = createBatcher({
+      fetcher: async (leafPaths: LeafPath[]) => {
+        const results = await DatasetsService.selectGroupsMany(namespace, datasetName, {
+          ...selectGroupsManyOptions,
+          leaf_paths: leafPaths
+        });
+        return Object.fromEntries(
+          leafPaths.map((leafPath, i) => [serializePath(leafPath), results[i]])
+        );
+      },
+      resolver: (items: Record<string, SelectGroupsResult>, leafPath: LeafPath) =>
+        items[serializePath(leafPath)],
+      scheduler: windowScheduler(SELECT_GROUPS_BATCH_WINDOW_MS)
+    });
+  }
+  return batchedSelectGroupsCache[key];
+}
+
+/**
+ * Selects the groups of a leaf. The histograms of a view share their options, so their requests
+ * are batched into a single select_groups_many request that scans the dataset once.
+ */
+export const querySelectGroups = createApiQuery(function selectGroups(
+  namespace: string,
+  datasetName: string,
+  options: SelectGroupsOptions
+) {
+  const {leaf_path, bins, ...selectGroupsManyOptions} = options;
+  // Only select_groups accepts explicit bins.
+  if (bins != null) {
+    return DatasetsService.selectGroups(namespace, datasetName, options);
+  }
+  return getSelectGroupsBatcher(namespace, datasetName, selectGroupsManyOptions).fetch(leaf_path);
+}, DATASETS_TAG);
+
+interface SelectRowsPageParam {
+  page: number;
+  cursor?: string | null;
+}
 
 export const infiniteQuerySelectRows = (
   namespace: string,
@@ -214,11 +270,16 @@ export const infiniteQuerySelectRows = (
 ): CreateInfiniteQueryResult<Awaited<ReturnType<typeof DatasetsService.selectRows>>, ApiError> =>
   createInfiniteQuery({
     queryKey: [DATASETS_TAG, 'selectRows', namespace, datasetName, selectRowOptions],
-    queryFn: ({pageParam = 0}) =>
+    queryFn: ({pageParam = {page: 0}}: {pageParam?: SelectRowsPageParam}) =>
       DatasetsService.selectRows(namespace, datasetName, {
         ...selectRowOptions,
         limit: selectRowOptions.limit || DEFAULT_SELECT_ROWS_LIMIT,
-        offset: pageParam * (selectRowOptions.limit || DEFAULT_SELECT_ROWS_LIMIT)
+        // The cursor of the previous page is cheaper to fetch from than an offset.
+        offset:
+          pageParam.cursor != null
+            ? undefined
+            : pageParam.page * (selectRowOptions.limit || DEFAULT_SELECT_ROWS_LIMIT),
+        cursor: pageParam.cursor
       }),
     select: data => ({
       ...data,
@@ -227,7 +288,10 @@ export const infiniteQuerySelectRows = (
         total_num_rows: page.total_num_rows
       }))
     }),
-    getNextPageParam: (_, pages) => pages.length,
+    getNextPageParam: (lastPage, pages): SelectRowsPageParam => ({
+      page: pages.length,
+      cursor: lastPage.next_cursor
+    }),
     enabled: !!schema
   });
 
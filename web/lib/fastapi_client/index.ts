@@ -62,6 +62,7 @@ export type { Schema } from './models/Schema';
 export type { ScoreBody } from './models/ScoreBody';
 export type { ScoreExample } from './models/ScoreExample';
 export type { SearchResultInfo } from './models/SearchResultInfo';
+export type { SelectGroupsManyOptions } from './models/SelectGroupsManyOptions';
 export type { SelectGroupsOptions } from './models/SelectGroupsOptions';
 export type { SelectGroupsResult } from './models/SelectGroupsResult';
 export type { SelectRowsOptions } from './models/SelectRowsOptions';
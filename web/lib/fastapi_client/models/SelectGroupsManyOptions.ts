@@ -0,0 +1,25 @@
+/* generated using openapi-typescript-codegen -- do no edit */
+/* istanbul ignore file */
+/* tslint:disable */
+/* eslint-disable */
+
+import type { BinaryFilter } from './BinaryFilter';
+import type { GroupsSortBy } from './GroupsSortBy';
+import type { ListFilter } from './ListFilter';
+import type { SortOrder } from './SortOrder';
+import type { StringFilter } from './StringFilter';
+import type { UnaryFilter } from './UnaryFilter';
+
+/**
+ * The request for the select groups many endpoint.
+ */
+export type SelectGroupsManyOptions = {
+    leaf_paths: Array<(Array<string> | string)>;
+    filters?: Array<(BinaryFilter | StringFilter | UnaryFilter | ListFilter)>;
+    sort_by?: (GroupsSortBy | null);
+    sort_order?: (SortOrder | null);
+    limit?: (number | null);
+    include_deleted?: boolean;
+    approximate?: boolean;
+};
+
@@ -20,5 +20,7 @@ export type SelectGroupsOptions = {
     sort_order?: (SortOrder | null);
     limit?: (number | null);
     bins?: (Array<any[]> | null);
+    include_deleted?: boolean;
+    approximate?: boolean;
 };
 
@@ -10,5 +10,7 @@ export type SelectGroupsResult = {
     too_many_distinct: boolean;
     counts: Array<any[]>;
     bins?: (Array<any[]> | null);
+    is_approximate?: boolean;
+    count_errors?: (Array<number> | null);
 };
 
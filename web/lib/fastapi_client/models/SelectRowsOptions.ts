@@ -26,5 +26,6 @@ export type SelectRowsOptions = {
     limit?: (number | null);
     offset?: (number | null);
     combine_columns?: (boolean | null);
+    cursor?: (string | null);
 };
 
@@ -12,6 +12,7 @@ import type { DeleteSignalResponse } from '../models/DeleteSignalResponse';
 import type { ExportOptions } from '../models/ExportOptions';
 import type { GetStatsOptions } from '../models/GetStatsOptions';
 import type { RemoveLabelsOptions } from '../models/RemoveLabelsOptions';
+import type { SelectGroupsManyOptions } from '../models/SelectGroupsManyOptions';
 import type { SelectGroupsOptions } from '../models/SelectGroupsOptions';
 import type { SelectGroupsResult } from '../models/SelectGroupsResult';
 import type { SelectRowsOptions } from '../models/SelectRowsOptions';
@@ -206,6 +207,35 @@ export class DatasetsService {
         });
     }
 
+    /**
+     * Select Groups Many
+     * Select the groups of many leafs from the dataset database in one pass.
+     * @param namespace
+     * @param datasetName
+     * @param requestBody
+     * @returns SelectGroupsResult Successful Response
+     * @throws ApiError
+     */
+    public static selectGroupsMany(
+        namespace: string,
+        datasetName: string,
+        requestBody: SelectGroupsManyOptions,
+    ): CancelablePromise<Array<SelectGroupsResult>> {
+        return __request(OpenAPI, {
+            method: 'POST',
+            url: '/api/v1/datasets/{namespace}/{dataset_name}/select_groups_many',
+            path: {
+                'namespace': namespace,
+                'dataset_name': datasetName,
+            },
+            body: requestBody,
+            mediaType: 'application/json',
+            errors: {
+                422: `Validation Error`,
+            },
+        });
+    }
+
     /**
      * Get Media
      * Get the media for the dataset.